@@ -0,0 +1,83 @@
+import os
+import fcntl
+import errno
+import threading
+import Queue
+
+
+# A function call run on a TaskRunner's worker threads. When it finishes,
+# done is set along with either result or error (the exception raised).
+class Task(object):
+
+    def __init__(self, description, function, args, on_done):
+        self.description = description
+        self.function = function
+        self.args = args
+        self.on_done = on_done
+        self.done = False
+        self.cancelled = False
+        self.result = None
+        self.error = None
+
+    # Marks the task as no longer wanted. A task that has not started is
+    # skipped; one already running finishes, but nobody looks at its result.
+    def cancel(self):
+        self.cancelled = True
+
+
+# Runs slow calls (database queries) on a few worker threads so that the
+# terminal stays responsive. Finished tasks are not handed back through a
+# callback on the worker thread: instead a byte is written to a pipe, whose
+# read end (fileno()) the UI waits on together with the keyboard, and the UI
+# thread then looks at the tasks it submitted.
+class TaskRunner(object):
+
+    def __init__(self, n_threads = 2):
+        self.n_threads = max(1, n_threads)
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.wake_read, self.wake_write = os.pipe()
+        flags = fcntl.fcntl(self.wake_read, fcntl.F_GETFL)
+        fcntl.fcntl(self.wake_read, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    # Queues function(*args) and returns its Task. on_done(result) is for the
+    # submitter to call once the task is done; the runner never calls it.
+    def submit(self, description, function, args = (), on_done = None):
+        task = Task(description, function, args, on_done)
+        with self.lock:
+            if not self.threads:
+                for i in range(self.n_threads):
+                    thread = threading.Thread(target = self.work)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+        self.queue.put(task)
+        return task
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            if task.cancelled:
+                continue
+            try:
+                task.result = task.function(*task.args)
+            except Exception as e:
+                task.error = e
+            task.done = True
+            os.write(self.wake_write, 'x')
+
+    # File descriptor that becomes readable when a task finishes
+    def fileno(self):
+        return self.wake_read
+
+    # Empties the pipe, once the finished tasks have been looked at
+    def clear_wake(self):
+        while True:
+            try:
+                if not os.read(self.wake_read, 4096):
+                    return
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
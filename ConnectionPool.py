@@ -0,0 +1,158 @@
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.extensions
+
+
+# A fixed-size pool of psycopg2 connections shared by every thread of the
+# process. Connections are opened lazily up to max_size; once that many are
+# checked out, callers block until one is returned. Idle connections are kept
+# open (up to max_size) rather than closed, so a burst of queries does not
+# reconnect every time.
+class ConnectionPool(object):
+
+    # connect_kwargs are passed straight to psycopg2.connect, e.g.
+    # dbname, user, password, host, port, keepalives_idle.
+    def __init__(self, min_size = 1, max_size = 1, **connect_kwargs):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Invalid pool size: min_size = " + str(min_size) + ", max_size = " + str(max_size))
+        self.min_size = min_size
+        self.max_size = max_size
+        self.connect_kwargs = connect_kwargs
+        self.idle = []
+        self.size = 0 # connections currently open, idle or checked out
+        self.condition = threading.Condition()
+        self.local = threading.local()
+
+        # statistics
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.connects = 0
+        self.discards = 0
+
+        for i in range(min_size):
+            self.idle.append(self.connect())
+            self.size += 1
+
+    def connect(self):
+        conn = psycopg2.connect(**self.connect_kwargs)
+        self.connects += 1
+        return conn
+
+    # Returns a connection from the pool, opening a new one if the pool has
+    # not reached max_size yet, and waiting for one to be returned otherwise.
+    def getconn(self):
+        with self.condition:
+            wait_start = None
+            while not self.idle and self.size >= self.max_size:
+                if wait_start == None:
+                    wait_start = time.time()
+                    self.waits += 1
+                self.condition.wait()
+            if wait_start != None:
+                waited = time.time() - wait_start
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+            conn = self.idle.pop() if self.idle else None
+            if conn == None:
+                self.size += 1
+            self.checked_out += 1
+            self.checkouts += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+
+        if conn == None:
+            try:
+                conn = self.connect()
+            except Exception:
+                with self.condition:
+                    self.size -= 1
+                    self.checked_out -= 1
+                    self.condition.notify()
+                raise
+        return conn
+
+    # Returns conn to the pool. Any transaction left open is rolled back so the
+    # next user starts clean. Broken connections (or close = True) are closed
+    # and dropped, and will be replaced by a fresh one on demand.
+    def putconn(self, conn, close = False):
+        if not close and not conn.closed:
+            status = conn.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+        close = close or bool(conn.closed)
+        if close:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+        with self.condition:
+            self.checked_out -= 1
+            if close:
+                self.size -= 1
+                self.discards += 1
+            else:
+                self.idle.append(conn)
+            self.condition.notify()
+
+    # Checks a connection out for the duration of a with block. Nested blocks
+    # on the same thread share the outer block's connection, so a helper
+    # method can call other helper methods without needing a second
+    # connection (and without deadlocking a pool of size 1).
+    @contextmanager
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn != None:
+            yield conn
+            return
+
+        conn = self.getconn()
+        self.local.conn = conn
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.local.conn = None
+            self.putconn(conn, close = broken)
+
+    # Returns a dictionary of pool statistics, for sizing the pool under load.
+    def stats(self):
+        with self.condition:
+            return {"min_size": self.min_size,
+                    "max_size": self.max_size,
+                    "open": self.size,
+                    "idle": len(self.idle),
+                    "checked_out": self.checked_out,
+                    "max_checked_out": self.max_checked_out,
+                    "checkouts": self.checkouts,
+                    "waits": self.waits,
+                    "wait_time": self.wait_time,
+                    "max_wait_time": self.max_wait_time,
+                    "connects": self.connects,
+                    "discards": self.discards}
+
+    # Closes every idle connection. Checked out connections are closed when
+    # they are returned.
+    def close_all(self):
+        with self.condition:
+            for conn in self.idle:
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+            self.size -= len(self.idle)
+            self.idle = []
+            self.min_size = 0
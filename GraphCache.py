@@ -0,0 +1,192 @@
+import json
+import threading
+import psycopg2
+from GraphEngine import FriendGraph
+
+CHANNEL = "social_graph"
+
+
+# Process-local copy of the social graph: friendships (in a FriendGraph),
+# pending friend requests, and the profiles of users whose friend lists were
+# shown. Loaded in bulk on first use and kept current by the NOTIFY events
+# that the triggers in migrations/004_graph_notify.sql send on every change
+# to friends, pendingFriends and profile.
+# Reads call refresh() first, which applies any notifications received
+# since the last read, so a change committed by another session is seen as
+# soon as its notification reaches this process.
+class GraphCache(object):
+
+    # connection = a function returning a connection context manager, such as
+    # ConnectionPool.connection
+    # listener = a NotificationListener
+    def __init__(self, connection, listener, graph = None):
+        self.connection = connection
+        self.listener = listener
+        self.graph = graph if graph != None else FriendGraph()
+        self.pending = {} # recipient's compact id -> set of requesters' compact ids
+        self.profiles = {} # user id -> profile record, password left out
+        self.profile_generation = 0
+        self.loaded = False
+        self.loading = False # a thread is in load()
+        self.queued = [] # payloads received during load(), applied after it
+        self.resets = 0 # number of times the listener reconnected
+        self.lock = threading.RLock()
+        listener.listen(CHANNEL, self.apply)
+        listener.on_reset(self.reset)
+
+    # Forgets everything, so that the next refresh() reloads it
+    def reset(self):
+        with self.lock:
+            self.loaded = False
+            self.resets += 1
+
+    # Applies pending notifications, loading the cache first if needed.
+    # Returns False if the cache cannot be used (e.g. the database is
+    # unreachable, or another thread is loading it), in which case callers
+    # should query the database instead.
+    # The listener is polled without holding self.lock, since it holds its
+    # own lock while calling apply(), which takes self.lock.
+    def refresh(self):
+        try:
+            # LISTEN happens in poll(), before load(), so nothing
+            # committed after the load's snapshot can be missed.
+            # Notifications for changes the load already saw are applied
+            # again, which is harmless.
+            self.listener.poll()
+            with self.lock:
+                if self.loaded:
+                    return True
+                if self.loading:
+                    return False
+                self.loading = True
+            self.load()
+        except psycopg2.Error:
+            with self.lock:
+                self.loaded = False
+            return False
+        return True
+
+    # Reads the tables into a new graph and pending map without holding
+    # self.lock, so that reads from other threads are not kept waiting, then
+    # swaps them in. Notifications received meanwhile are queued by apply()
+    # and applied on top.
+    def load(self):
+        with self.lock:
+            resets = self.resets
+        graph = FriendGraph()
+        pending = {}
+        try:
+            with self.connection() as conn:
+                # named (server side) cursors stream the tables instead of
+                # fetching every row into memory at once
+                cur = conn.cursor("graph_cache_friends")
+                cur.itersize = 10000
+                try:
+                    cur.execute("SELECT userID1, userID2 FROM friends;")
+                    graph.load(cur)
+                finally:
+                    cur.close()
+                cur = conn.cursor("graph_cache_pending")
+                cur.itersize = 10000
+                try:
+                    cur.execute("SELECT userID1, userID2 FROM pendingFriends;")
+                    for requester_id, recipient_id in cur:
+                        pending.setdefault(graph.get_or_add(recipient_id), set()).add(graph.get_or_add(requester_id))
+                finally:
+                    cur.close()
+                conn.commit()
+        except Exception:
+            with self.lock:
+                self.loading = False
+                self.queued = []
+            raise
+        with self.lock:
+            self.graph.replace(graph)
+            self.pending = pending
+            self.profiles = {}
+            self.profile_generation += 1
+            # notifications may have been lost if the listener reconnected
+            # during the load, so load again on the next refresh()
+            self.loaded = self.resets == resets
+            self.loading = False
+            queued, self.queued = self.queued, []
+            for payload in queued:
+                self.apply(payload)
+
+    # Applies the JSON payload of a social_graph notification
+    def apply(self, payload):
+        change = json.loads(payload)
+        table = change.get("table")
+        op = change.get("op")
+        with self.lock:
+            if self.loading:
+                self.queued.append(payload)
+            elif op == "TRUNCATE":
+                self.loaded = False
+            elif table == "friends":
+                if op == "INSERT":
+                    self.graph.add_friendship(change["id1"], change["id2"])
+                else:
+                    self.graph.remove_friendship(change["id1"], change["id2"])
+            elif table == "pendingfriends":
+                if op == "INSERT":
+                    self.add_pending(change["id1"], change["id2"])
+                else:
+                    self.remove_pending(change["id1"], change["id2"])
+            elif table == "profile":
+                self.profiles.pop(change["id1"], None)
+                self.profile_generation += 1
+
+    def add_pending(self, requester_id, recipient_id):
+        with self.lock, self.graph.lock:
+            requester = self.graph.get_or_add(requester_id)
+            recipient = self.graph.get_or_add(recipient_id)
+            self.pending.setdefault(recipient, set()).add(requester)
+
+    def remove_pending(self, requester_id, recipient_id):
+        with self.lock:
+            requester = self.graph.ids.get(requester_id)
+            recipient = self.graph.ids.get(recipient_id)
+            requesters = self.pending.get(recipient)
+            if requesters != None:
+                requesters.discard(requester)
+
+    # Returns True if requester_id has a pending friend request to recipient_id
+    def has_pending(self, requester_id, recipient_id):
+        with self.lock:
+            requester = self.graph.ids.get(requester_id)
+            recipient = self.graph.ids.get(recipient_id)
+            return requester in self.pending.get(recipient, ())
+
+    def are_friends(self, user_id1, user_id2):
+        return self.graph.are_friends(user_id1, user_id2)
+
+    def friends_of(self, user_id):
+        return self.graph.friends_of(user_id)
+
+    # Returns the profile records of user_ids, in the same order, leaving out
+    # users that do not exist. Records not cached yet are fetched with
+    # fetch(list of user ids), which returns records whose first field is the
+    # user id, and cached unless a profile changed while they were fetched.
+    def get_profiles(self, user_ids, fetch):
+        with self.lock:
+            generation = self.profile_generation
+            records = dict((user_id, self.profiles[user_id]) for user_id in user_ids if user_id in self.profiles)
+        missing = [user_id for user_id in user_ids if user_id not in records]
+        if missing:
+            fetched = dict((record[0], record) for record in fetch(missing))
+            records.update(fetched)
+            with self.lock:
+                if generation == self.profile_generation:
+                    self.profiles.update(fetched)
+        return [records[user_id] for user_id in user_ids if user_id in records]
+
+    # Returns a dictionary with the number of users, friendships, pending
+    # requests and profiles cached.
+    def stats(self):
+        with self.lock:
+            stats = self.graph.stats()
+            stats["pending_requests"] = sum(len(requesters) for requesters in self.pending.values())
+            stats["profiles"] = len(self.profiles)
+            stats["loaded"] = self.loaded
+            return stats
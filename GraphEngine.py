@@ -0,0 +1,167 @@
+import threading
+import time
+from array import array
+
+
+# In-memory copy of the (undirected) friendship graph for path queries such
+# as DatabaseHelper.three_degrees. User ids are mapped to compact integer ids
+# and each user's friends are kept in an array('i') of those ids, so a graph
+# with millions of friendships takes tens of megabytes rather than a Python
+# object per edge.
+class FriendGraph(object):
+
+    def __init__(self):
+        self.ids = {} # user id -> compact id
+        self.user_ids = [] # compact id -> user id
+        self.adjacency = [] # compact id -> array('i') of friends' compact ids
+        self.edges = 0
+        self.loaded_at = None
+        self.lock = threading.RLock()
+
+    # Replaces the graph with the friendships in rows, an iterable of
+    # (userID1, userID2) pairs such as a cursor over the friends table. The
+    # new graph is built aside, so the current one can still be read while
+    # rows are fetched.
+    def load(self, rows):
+        graph = FriendGraph()
+        for user_id1, user_id2 in rows:
+            u = graph.get_or_add(user_id1)
+            v = graph.get_or_add(user_id2)
+            graph.adjacency[u].append(v)
+            graph.adjacency[v].append(u)
+            graph.edges += 1
+        graph.loaded_at = time.time()
+        self.replace(graph)
+
+    # Takes over the contents of graph, which should not be used afterwards
+    def replace(self, graph):
+        with self.lock:
+            self.ids = graph.ids
+            self.user_ids = graph.user_ids
+            self.adjacency = graph.adjacency
+            self.edges = graph.edges
+            self.loaded_at = graph.loaded_at
+
+    # Returns the compact id of user_id, adding the user if it is new
+    def get_or_add(self, user_id):
+        u = self.ids.get(user_id)
+        if u == None:
+            u = len(self.user_ids)
+            self.ids[user_id] = u
+            self.user_ids.append(user_id)
+            self.adjacency.append(array('i'))
+        return u
+
+    def add_friendship(self, user_id1, user_id2):
+        with self.lock:
+            u = self.get_or_add(user_id1)
+            v = self.get_or_add(user_id2)
+            if v in self.adjacency[u]:
+                return
+            self.adjacency[u].append(v)
+            self.adjacency[v].append(u)
+            self.edges += 1
+
+    def remove_friendship(self, user_id1, user_id2):
+        with self.lock:
+            u = self.ids.get(user_id1)
+            v = self.ids.get(user_id2)
+            if u == None or v == None or v not in self.adjacency[u]:
+                return
+            self.adjacency[u].remove(v)
+            self.adjacency[v].remove(u)
+            self.edges -= 1
+
+    # Removes every friendship of user_id. The compact id is kept (ids are
+    # never reused) but has no friends left.
+    def remove_user(self, user_id):
+        with self.lock:
+            u = self.ids.get(user_id)
+            if u == None:
+                return
+            for v in self.adjacency[u]:
+                if v != u:
+                    self.adjacency[v].remove(u)
+            self.edges -= len(self.adjacency[u])
+            self.adjacency[u] = array('i')
+
+    def are_friends(self, user_id1, user_id2):
+        with self.lock:
+            u = self.ids.get(user_id1)
+            v = self.ids.get(user_id2)
+            return u != None and v != None and v in self.adjacency[u]
+
+    # Returns the user ids of the friends of user_id
+    def friends_of(self, user_id):
+        with self.lock:
+            u = self.ids.get(user_id)
+            if u == None:
+                return []
+            return [self.user_ids[v] for v in self.adjacency[u]]
+
+    # Returns a shortest list of user ids leading from source to target
+    # through friendships, both ends included, or None if there is no such
+    # path of at most max_hops friendships.
+    # The search runs breadth first from both ends at once, always expanding
+    # the smaller frontier by one level, and stops at the first meeting
+    # point, so it only visits the neighbourhoods of the two users rather
+    # than the whole graph.
+    def shortest_path(self, source, target, max_hops = 3):
+        with self.lock:
+            s = self.ids.get(source)
+            t = self.ids.get(target)
+            if s == None or t == None:
+                return None
+            if s == t:
+                return [source]
+            parents_s = {s: -1}
+            parents_t = {t: -1}
+            frontier_s = [s]
+            frontier_t = [t]
+            hops = 0
+            while frontier_s and frontier_t and hops < max_hops:
+                if len(frontier_s) <= len(frontier_t):
+                    frontier_s, meeting = self.expand(frontier_s, parents_s, parents_t)
+                else:
+                    frontier_t, meeting = self.expand(frontier_t, parents_t, parents_s)
+                hops += 1
+                if meeting != None:
+                    return self.build_path(meeting, parents_s, parents_t)
+            return None
+
+    # Visits the neighbours of frontier not yet in parents. Returns the next
+    # frontier, and the first neighbour already reached from the other end
+    # (or None).
+    def expand(self, frontier, parents, other_parents):
+        adjacency = self.adjacency
+        next_frontier = []
+        for u in frontier:
+            for v in adjacency[u]:
+                if v in parents:
+                    continue
+                parents[v] = u
+                if v in other_parents:
+                    return next_frontier, v
+                next_frontier.append(v)
+        return next_frontier, None
+
+    def build_path(self, meeting, parents_s, parents_t):
+        path = []
+        u = meeting
+        while u != -1:
+            path.append(u)
+            u = parents_s[u]
+        path.reverse()
+        u = parents_t[meeting]
+        while u != -1:
+            path.append(u)
+            u = parents_t[u]
+        return [self.user_ids[u] for u in path]
+
+    # Returns a dictionary with the number of users and friendships loaded
+    # and when the graph was loaded.
+    def stats(self):
+        with self.lock:
+            return {"users": len(self.user_ids),
+                    "friendships": self.edges,
+                    "loaded_at": self.loaded_at}
@@ -0,0 +1,202 @@
+import math
+import bisect
+
+# Generators of synthetic friendship graphs and activity, for populate.py.
+# Every graph generator takes a random.Random and yields friendships as
+# (userID1, userID2) pairs of user numbers 1..n_users with userID1 < userID2,
+# each at most once, in time proportional to the number of friendships
+# rather than to the number of possible pairs.
+
+MODELS = ['uniform', 'preferential', 'small-world', 'communities']
+
+
+# Yields the indices, in increasing order, of the items of a sequence of n
+# that are each picked independently with probability p, by drawing the
+# length of the gap to the next picked item from the geometric distribution
+# (Batagelj and Brandes, "Efficient generation of large random networks").
+def bernoulli_indices(rng, n, p):
+    if p <= 0:
+        return
+    if p >= 1:
+        for k in xrange(n):
+            yield k
+        return
+    log_q = math.log(1.0 - p)
+    k = -1
+    while True:
+        k += 1 + int(math.log(1.0 - rng.random()) / log_q)
+        if k >= n:
+            return
+        yield k
+
+
+# Erdos-Renyi G(n, p), with p chosen to give n_friendships on average
+def uniform(rng, n_users, n_friendships):
+    n_pairs = n_users * (n_users - 1) / 2
+    if n_pairs == 0:
+        return
+    for pair in random_pairs(rng, n_users, float(n_friendships) / n_pairs):
+        yield pair
+
+
+# Yields each pair of users 1..n_users independently with probability p
+def random_pairs(rng, n_users, p):
+    n_pairs = n_users * (n_users - 1) / 2
+    # pair number k is (w, v) with k = v * (v - 1) / 2 + w and w < v
+    v = 1
+    w = -1
+    last = -1
+    for k in bernoulli_indices(rng, n_pairs, p):
+        w += k - last
+        last = k
+        while w >= v:
+            w -= v
+            v += 1
+        yield (w + 1, v + 1)
+
+
+# Barabasi-Albert preferential attachment: users join one at a time and
+# befriend existing users with probability proportional to how many friends
+# they already have, which gives a few users very large friend lists.
+def preferential(rng, n_users, n_friendships):
+    m = max(1, min(int(round(float(n_friendships) / n_users)), n_users - 1))
+    # every user appears here once per friendship it is in, so a uniform
+    # pick from it is a pick weighted by number of friends
+    ends = []
+    for v in xrange(1, m + 1):
+        yield (v, m + 1)
+        ends.extend([v, m + 1])
+    for v in xrange(m + 2, n_users + 1):
+        targets = set()
+        while len(targets) < m:
+            targets.add(ends[int(rng.random() * len(ends))])
+        for u in targets:
+            yield (u, v)
+            ends.extend([u, v])
+
+
+# Watts-Strogatz small world: a ring where every user is friends with its k
+# nearest users on each side, with each friendship moved to a random user
+# with probability rewire. Clustered, but with short paths between any two
+# users.
+def small_world(rng, n_users, n_friendships, rewire = 0.1):
+    k = max(1, min(int(round(float(n_friendships) / n_users)), (n_users - 1) / 2))
+    seen = set()
+    for u in xrange(n_users):
+        for j in xrange(1, k + 1):
+            v = (u + j) % n_users
+            if rng.random() < rewire:
+                v = int(rng.random() * n_users)
+            pair = (min(u, v), max(u, v))
+            if u == v or pair in seen:
+                continue
+            seen.add(pair)
+            yield (pair[0] + 1, pair[1] + 1)
+
+
+# Stochastic block model: users are split into n_communities blocks of
+# consecutive numbers, and a fraction mixing of the friendships are between
+# blocks, the rest within them.
+def communities(rng, n_users, n_friendships, n_communities = None, mixing = 0.1):
+    if n_communities == None:
+        n_communities = max(1, n_users / 100)
+    n_communities = max(1, min(n_communities, n_users))
+    bounds = [n_users * b / n_communities for b in xrange(n_communities + 1)]
+    sizes = [bounds[b + 1] - bounds[b] for b in xrange(n_communities)]
+    pairs_in = sum([s * (s - 1) / 2 for s in sizes])
+    pairs_out = n_users * (n_users - 1) / 2 - pairs_in
+    p_in = (1 - mixing) * n_friendships / pairs_in if pairs_in else 0.0
+    p_out = mixing * n_friendships / pairs_out if pairs_out else 0.0
+    for b in xrange(n_communities):
+        for u, v in random_pairs(rng, sizes[b], p_in):
+            yield (bounds[b] + u, bounds[b] + v)
+    # pairs between blocks are picked from all pairs, skipping those within a
+    # block, in one pass rather than one per pair of blocks
+    for u, v in random_pairs(rng, n_users, p_out):
+        if bisect.bisect_right(bounds, u - 1) != bisect.bisect_right(bounds, v - 1):
+            yield (u, v)
+
+
+# Yields the friendships of the given model, plus celebrity_friends
+# friendships for each of users 1..n_celebrities (fewer for those the model
+# already gave friends)
+def friendships(model, rng, n_users, n_friendships, n_celebrities = 0, celebrity_friends = 0):
+    generator = {'uniform': uniform,
+                 'preferential': preferential,
+                 'small-world': small_world,
+                 'communities': communities}[model]
+    n_celebrities = min(n_celebrities, n_users)
+    # only the celebrities' friends are remembered, to avoid repeating a
+    # friendship when adding theirs
+    friends = dict((c, set()) for c in xrange(1, n_celebrities + 1))
+    for u, v in generator(rng, n_users, n_friendships):
+        if u <= n_celebrities:
+            friends[u].add(v)
+        if v <= n_celebrities:
+            friends[v].add(u)
+        yield (u, v)
+    for c in xrange(1, n_celebrities + 1):
+        wanted = min(celebrity_friends, n_users - 1) - len(friends[c])
+        while wanted > 0:
+            v = 1 + int(rng.random() * n_users)
+            if v == c or v in friends[c]:
+                continue
+            friends[c].add(v)
+            if v <= n_celebrities:
+                friends[v].add(c)
+            wanted -= 1
+            yield (min(c, v), max(c, v))
+
+
+# Picks a user number in 1..n_users with rand(), a uniform random number
+# generator. Skew 1 is uniform; with a higher skew, low user numbers are
+# picked more and more often (with skew s, the first n_users / 10**s users
+# are picked a tenth of the time).
+def skewed_user(rand, n_users, skew = 1.0):
+    return 1 + int(n_users * rand() ** skew)
+
+
+# Sizes of groups: the first n_huge groups have huge_size members, and a
+# fraction full of the others are filled to their limit. Returns (limit,
+# number of members) of group number group.
+def group_size(rng, group, n_users, n_huge = 0, huge_size = 0, full = 0.0):
+    if group <= n_huge:
+        limit = max(2, min(huge_size, n_users))
+        return (limit, limit)
+    limit = rng.randint(10, 25)
+    if rng.random() < full:
+        return (limit, min(limit, n_users))
+    return (limit, min(rng.randint(2, limit), n_users))
+
+
+# Picks the senders of messages and when they are sent. Senders are picked
+# with skewed_user, and a fraction bursts of messages start a burst: the
+# same sender sending on average mean_burst messages within a few minutes.
+class BurstySenders(object):
+
+    def __init__(self, rng, n_users, n_days, skew = 1.0, bursts = 0.0, mean_burst = 20):
+        self.rand = rng.random
+        self.n_users = n_users
+        self.n_days = n_days
+        self.skew = skew
+        self.bursts = bursts
+        self.mean_burst = mean_burst
+        self.burst_left = 0
+        self.sender = None
+        self.day = 0
+        self.second = 0
+
+    # Returns (sender, day number in 0..n_days - 1, second of the day)
+    def next(self):
+        rand = self.rand
+        if self.burst_left > 0:
+            self.burst_left -= 1
+            self.second = min(self.second + int(rand() * 20), 86399)
+            return (self.sender, self.day, self.second)
+        sender = skewed_user(rand, self.n_users, self.skew)
+        day = int(rand() * self.n_days)
+        second = int(rand() * 86400)
+        if self.bursts and rand() < self.bursts:
+            self.burst_left = int(rand() * 2 * self.mean_burst)
+            self.sender, self.day, self.second = sender, day, second
+        return (sender, day, second)
@@ -1,4 +1,4 @@
-import sys,tty,termios
+import sys,termios,os,select,errno,atexit
 
 
 class bcolors:
@@ -11,25 +11,134 @@ class bcolors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
-class _Getch:
-    def __call__(self):
-            fd = sys.stdin.fileno()
-            old_settings = termios.tcgetattr(fd)
-            try:
-                tty.setraw(sys.stdin.fileno())
-                ch = sys.stdin.read(1)
-                if ch == '\x03': # CTRL-C
+# Keys, as returned by get() and peek(). Other keys are returned as typed.
+UP = '\x1b[A'
+DOWN = '\x1b[B'
+RIGHT = '\x1b[C'
+LEFT = '\x1b[D'
+HOME = '\x1b[H'
+END = '\x1b[F'
+PAGE_UP = '\x1b[5~'
+PAGE_DOWN = '\x1b[6~'
+ESCAPE = '\x1b'
+
+# other sequences terminals send for the keys above
+KEY_ALIASES = {'\x1bOA': UP, '\x1bOB': DOWN, '\x1bOC': RIGHT, '\x1bOD': LEFT,
+               '\x1bOH': HOME, '\x1bOF': END,
+               '\x1b[1~': HOME, '\x1b[7~': HOME, '\x1b[4~': END, '\x1b[8~': END}
+
+# seconds to wait for the rest of an escape sequence before taking what has
+# arrived, e.g. a lone ESC, as a key
+ESCAPE_TIMEOUT = 0.05
+
+
+# Splits the first key off data, returning (key, rest), or (None, data) if
+# data ends in the middle of an escape sequence
+def split_key(data):
+    if data[0] != '\x1b':
+        return (data[0], data[1:])
+    if len(data) == 1:
+        return (None, data)
+    if data[1] == '[': # CSI: parameters, then a final byte in @..~
+        for i in range(2, len(data)):
+            if '@' <= data[i] <= '~':
+                return (data[:i + 1], data[i + 1:])
+        return (None, data)
+    if data[1] == 'O': # SS3: one more byte
+        if len(data) < 3:
+            return (None, data)
+        return (data[:3], data[3:])
+    return (ESCAPE, data[1:])
+
+
+# The keyboard, kept in raw mode from the first key read until the program
+# exits, instead of switching modes around every key. Output processing is
+# left on, so that printing '\n' still starts a new line. Whatever has been
+# typed is read in one go into a buffer, from which keys are taken one at a
+# time.
+class Keyboard(object):
+    __instance = None
+
+    def __init__(self):
+        if Keyboard.__instance != None:
+            raise Exception("An instance of Keyboard already exists. Use get_instance() instead.")
+        Keyboard.__instance = self
+        self.fd = sys.stdin.fileno()
+        self.buffer = ''
+        self.old_settings = termios.tcgetattr(self.fd)
+        mode = termios.tcgetattr(self.fd)
+        mode[0] &= ~(termios.BRKINT | termios.ICRNL | termios.INPCK | termios.ISTRIP | termios.IXON)
+        mode[2] = (mode[2] & ~(termios.CSIZE | termios.PARENB)) | termios.CS8
+        mode[3] &= ~(termios.ECHO | termios.ICANON | termios.IEXTEN | termios.ISIG)
+        mode[6][termios.VMIN] = 1
+        mode[6][termios.VTIME] = 0
+        termios.tcsetattr(self.fd, termios.TCSAFLUSH, mode)
+        atexit.register(self.restore)
+
+    @staticmethod
+    def get_instance():
+        if Keyboard.__instance == None:
+            Keyboard()
+        return Keyboard.__instance
+
+    def restore(self):
+        termios.tcsetattr(self.fd, termios.TCSADRAIN, self.old_settings)
+
+    # Waits up to timeout seconds (None = for ever) for input, or for one of
+    # wake_fds to become readable, and adds whatever was typed to the buffer.
+    # Returns True if anything was.
+    def read(self, wake_fds = (), timeout = None):
+        try:
+            readable, _, _ = select.select([self.fd] + list(wake_fds), [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR: # e.g. the terminal was resized
+                return False
+            raise
+        if self.fd not in readable:
+            return False
+        # read the file descriptor directly so that nothing is left in a
+        # buffer that select() cannot see
+        data = os.read(self.fd, 1024)
+        if data == '': # end of input
+            sys.exit(0)
+        self.buffer += data
+        return True
+
+    # Returns (next key in the buffer, rest of the buffer), or (None, '') if
+    # the buffer is empty
+    def split(self):
+        if not self.buffer:
+            return (None, '')
+        key, rest = split_key(self.buffer)
+        if key == None:
+            if self.read((), ESCAPE_TIMEOUT):
+                return self.split()
+            key, rest = self.buffer, ''
+        return (KEY_ALIASES.get(key, key), rest)
+
+    def get(self, wake_fds = ()):
+        while True:
+            key, rest = self.split()
+            if key != None:
+                self.buffer = rest
+                if key == '\x03': # CTRL-C
                     sys.exit(0)
-                elif (ch == '\x1b'):
-                    ch += sys.stdin.read(2)
-            finally:
-                termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
-            return ch
-
-def get():
-        inkey = _Getch()
-        while(1):
-            k=inkey()
-            if k != '':
-                break
-        return k
+                return key
+            if not self.read(wake_fds):
+                return None
+
+    def peek(self):
+        if not self.buffer:
+            self.read((), 0)
+        return self.split()[0]
+
+# Returns the next key pressed, or None if one of wake_fds became readable
+# or the terminal was resized first.
+def get(wake_fds = ()):
+        return Keyboard.get_instance().get(wake_fds)
+
+# Returns the next key if it has already been pressed, without taking it or
+# waiting for it, or None. E.g. while a key is held down, the repeats pile up
+# faster than screens are drawn, and can all be handled before the next one.
+def peek():
+        return Keyboard.get_instance().peek()
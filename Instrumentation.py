@@ -0,0 +1,224 @@
+import json
+import time
+import types
+import threading
+import functools
+from collections import deque
+import psycopg2
+import psycopg2.extensions
+
+# upper bounds of the histogram buckets; the last bucket is everything above
+TIME_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+ROW_BUCKETS = [0, 1, 10, 100, 1000, 10000, 100000]
+
+# DatabaseHelper methods that are not timed: the plumbing every other method
+# goes through, and the ones reading the instrumentation itself
+SKIP_METHODS = set(["__init__", "cursor", "execute", "get_instrumentation_report",
+                    "dump_instrumentation_report"])
+
+
+def bucket_label(bounds, value):
+    for bound in bounds:
+        if value <= bound:
+            return "<=" + str(bound)
+    return ">" + str(bounds[-1])
+
+
+# Calls, errors, total/maximum time and histograms of time and rows for one
+# method or statement.
+class Timing(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.time_histogram = {}
+        self.row_histogram = {}
+
+    def add(self, ms, rows, error):
+        self.calls += 1
+        self.errors += 1 if error else 0
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.rows += rows
+        label = bucket_label(TIME_BUCKETS_MS, ms)
+        self.time_histogram[label] = self.time_histogram.get(label, 0) + 1
+        label = bucket_label(ROW_BUCKETS, rows)
+        self.row_histogram[label] = self.row_histogram.get(label, 0) + 1
+
+    def to_dictionary(self):
+        return {"calls": self.calls,
+                "errors": self.errors,
+                "total_ms": self.total_ms,
+                "mean_ms": self.total_ms / self.calls if self.calls else 0.0,
+                "max_ms": self.max_ms,
+                "rows": self.rows,
+                "time_histogram_ms": self.time_histogram,
+                "row_histogram": self.row_histogram}
+
+
+# Times every DatabaseHelper method and every statement it executes, and
+# logs statements slower than slow_query_ms, optionally with the plan from
+# EXPLAIN (ANALYZE, BUFFERS).
+# Nothing is instrumented until enable() is called: it replaces the methods
+# of the class with timed wrappers, and disable() puts the originals back,
+# so a disabled Instrumentation costs nothing at all.
+class Instrumentation(object):
+
+    def __init__(self, slow_query_ms = 200, explain_slow = False, slow_log_size = 1000):
+        self.slow_query_ms = slow_query_ms
+        self.explain_slow = explain_slow
+        self.methods = {}
+        self.statements = {}
+        self.slow_queries = deque(maxlen = slow_log_size)
+        self.started_at = time.time()
+        self.originals = {}
+        self.helper_class = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def enable(self, helper_class):
+        if self.helper_class != None:
+            return
+        self.helper_class = helper_class
+        for name, function in helper_class.__dict__.items():
+            if not isinstance(function, types.FunctionType) or name in SKIP_METHODS:
+                continue
+            self.originals[name] = function
+            setattr(helper_class, name, self.wrap_method(name, function))
+        execute = helper_class.__dict__["execute"]
+        self.originals["execute"] = execute
+        setattr(helper_class, "execute", self.wrap_execute(execute))
+
+    def disable(self):
+        if self.helper_class == None:
+            return
+        for name, function in self.originals.items():
+            setattr(self.helper_class, name, function)
+        self.originals = {}
+        self.helper_class = None
+
+    def reset(self):
+        with self.lock:
+            self.methods = {}
+            self.statements = {}
+            self.slow_queries.clear()
+            self.started_at = time.time()
+
+    # Rows are counted per method call on a per-thread stack, so that a
+    # method's rows include those of the methods it calls.
+    def wrap_method(self, name, function):
+        instrumentation = self
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            stack = instrumentation.get_row_stack()
+            stack.append(0)
+            start = time.time()
+            error = True
+            try:
+                result = function(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                ms = (time.time() - start) * 1000
+                rows = stack.pop()
+                if stack:
+                    stack[-1] += rows
+                instrumentation.record(instrumentation.methods, name, ms, rows, error)
+        return timed
+
+    def wrap_execute(self, execute):
+        instrumentation = self
+        @functools.wraps(execute)
+        def timed_execute(helper, cur, name, SQL, data = ()):
+            start = time.time()
+            error = True
+            try:
+                execute(helper, cur, name, SQL, data)
+                error = False
+            finally:
+                ms = (time.time() - start) * 1000
+                rows = max(cur.rowcount, 0)
+                stack = instrumentation.get_row_stack()
+                if stack:
+                    stack[-1] += rows
+                instrumentation.record(instrumentation.statements, name, ms, rows, error)
+                if ms >= instrumentation.slow_query_ms:
+                    instrumentation.log_slow_query(cur, name, SQL, data, ms, rows, error)
+        return timed_execute
+
+    def get_row_stack(self):
+        stack = getattr(self.local, "rows", None)
+        if stack == None:
+            stack = self.local.rows = []
+        return stack
+
+    def record(self, timings, name, ms, rows, error):
+        with self.lock:
+            timing = timings.get(name)
+            if timing == None:
+                timing = timings[name] = Timing()
+            timing.add(ms, rows, error)
+
+    def log_slow_query(self, cur, name, SQL, data, ms, rows, error):
+        entry = {"time": time.time(),
+                 "statement": name,
+                 "sql": " ".join(SQL.split()),
+                 "parameters": [repr(value) for value in data],
+                 "ms": ms,
+                 "rows": rows,
+                 "error": error}
+        if self.explain_slow and not error:
+            entry["plan"] = self.explain(cur, SQL, data)
+        with self.lock:
+            self.slow_queries.append(entry)
+
+    # Runs EXPLAIN (ANALYZE, BUFFERS) of SQL on cur's connection, inside a
+    # savepoint (or, in autocommit mode, a transaction) that is rolled back, so that statements that modify data
+    # are executed for real but leave no trace, and the caller's transaction
+    # is left as it was. A second cursor is used so that the results waiting
+    # on cur are not replaced.
+    def explain(self, cur, SQL, data):
+        conn = cur.connection
+        if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            return "not captured: transaction aborted"
+        explain_cur = conn.cursor()
+        try:
+            if conn.autocommit: # no transaction to make a savepoint in
+                explain_cur.execute("BEGIN;")
+            else:
+                explain_cur.execute("SAVEPOINT instrumentation_explain;")
+            try:
+                explain_cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + SQL.strip().rstrip(';'), data)
+                plan = explain_cur.fetchone()[0]
+            except psycopg2.Error as e:
+                plan = "not captured: " + str(e).strip()
+            if conn.autocommit:
+                explain_cur.execute("ROLLBACK;")
+            else:
+                explain_cur.execute("ROLLBACK TO SAVEPOINT instrumentation_explain;")
+                explain_cur.execute("RELEASE SAVEPOINT instrumentation_explain;")
+        except psycopg2.Error as e:
+            plan = "not captured: " + str(e).strip()
+        finally:
+            explain_cur.close()
+        return plan
+
+    # Returns everything measured so far as a dictionary that can be
+    # serialised to JSON.
+    def report(self):
+        with self.lock:
+            return {"started_at": self.started_at,
+                    "generated_at": time.time(),
+                    "slow_query_ms": self.slow_query_ms,
+                    "methods": dict((name, timing.to_dictionary()) for name, timing in self.methods.items()),
+                    "statements": dict((name, timing.to_dictionary()) for name, timing in self.statements.items()),
+                    "slow_queries": list(self.slow_queries)}
+
+    def dump(self, path):
+        report = self.report()
+        with open(path, "w") as report_file:
+            json.dump(report, report_file, indent = 2, sort_keys = True, default = str)
+        return path
@@ -0,0 +1,96 @@
+import threading
+import psycopg2
+import psycopg2.extensions
+
+
+# Receives PostgreSQL NOTIFY events on a dedicated connection (outside the
+# connection pool, since it must stay LISTENing) and passes their payloads to
+# the callbacks registered for each channel. Nothing runs in the background:
+# pending notifications are read whenever poll() is called, which is cheap
+# enough to do before every cached read.
+class NotificationListener(object):
+
+    # connect_kwargs are passed straight to psycopg2.connect
+    def __init__(self, **connect_kwargs):
+        self.connect_kwargs = connect_kwargs
+        self.conn = None
+        self.channels = {} # channel -> list of callbacks taking the payload
+        self.reset_callbacks = []
+        self.lock = threading.RLock()
+
+    # Calls callback(payload) for every notification on channel
+    def listen(self, channel, callback):
+        with self.lock:
+            callbacks = self.channels.setdefault(channel, [])
+            callbacks.append(callback)
+            if len(callbacks) == 1 and self.conn != None:
+                self.execute_listen(channel)
+
+    # Stops calling the callbacks registered for channel
+    def unlisten(self, channel):
+        with self.lock:
+            if self.channels.pop(channel, None) != None and self.conn != None:
+                cur = self.conn.cursor()
+                try:
+                    cur.execute('UNLISTEN "' + channel.replace('"', '""') + '";')
+                except psycopg2.Error:
+                    pass
+                finally:
+                    cur.close()
+
+    # Calls callback() every time the listener (re)connects. Notifications
+    # sent while it was disconnected are lost, so anything built from them
+    # must be reloaded from the database.
+    def on_reset(self, callback):
+        with self.lock:
+            self.reset_callbacks.append(callback)
+
+    def connect(self):
+        conn = psycopg2.connect(**self.connect_kwargs)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        self.conn = conn
+        for channel in self.channels.keys():
+            self.execute_listen(channel)
+        for callback in self.reset_callbacks:
+            callback()
+
+    def execute_listen(self, channel):
+        cur = self.conn.cursor()
+        try:
+            cur.execute('LISTEN "' + channel.replace('"', '""') + '";')
+        finally:
+            cur.close()
+
+    # Returns the file descriptor of the listening connection, for select(),
+    # or None if it is not connected.
+    def fileno(self):
+        conn = self.conn
+        if conn == None or conn.closed:
+            return None
+        return conn.fileno()
+
+    # Connects if needed, then dispatches every notification received so
+    # far. Raises psycopg2.Error if the connection fails; the next call
+    # reconnects.
+    def poll(self):
+        with self.lock:
+            try:
+                if self.conn == None:
+                    self.connect()
+                self.conn.poll()
+                while self.conn.notifies:
+                    notify = self.conn.notifies.pop(0)
+                    for callback in self.channels.get(notify.channel, []):
+                        callback(notify.payload)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self.close()
+                raise
+
+    def close(self):
+        with self.lock:
+            if self.conn != None:
+                try:
+                    self.conn.close()
+                except psycopg2.Error:
+                    pass
+                self.conn = None
@@ -0,0 +1,56 @@
+# In-memory copy of information_schema.columns, used to validate forms
+# against the schema without a database round trip per submit. DatabaseHelper
+# loads every table at once with preload() when it is created; a table missing
+# from it (or invalidated since) is loaded the first time it is asked for.
+# Tables are kept until invalidate() is called, e.g. after a migration.
+class SchemaCatalog(object):
+
+    # cursor = a function returning a cursor context manager, such as
+    # DatabaseHelper.cursor
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.tables = {}
+
+    # Loads the columns of every user table in one query.
+    def preload(self):
+        SQL = "SELECT table_name, column_name, is_nullable, character_maximum_length, data_type, column_default\
+               FROM information_schema.columns\
+               WHERE table_schema NOT IN ('pg_catalog', 'information_schema')\
+               ORDER BY table_name, ordinal_position;"
+        with self.cursor() as cur:
+            cur.execute(SQL)
+            results = cur.fetchall()
+        tables = {}
+        for result in results:
+            tables.setdefault(result[0], []).append(SchemaCatalog.column_record_to_dictionary(result[1:]))
+        self.tables = tables
+
+    # Returns a list of dictionaries describing the columns of table_name, with
+    # keys name, nullable, max_length, data_type and default.
+    def get_columns(self, table_name):
+        columns = self.tables.get(table_name)
+        if columns == None:
+            SQL = "SELECT column_name, is_nullable, character_maximum_length, data_type, column_default\
+                   FROM information_schema.columns WHERE table_name = %s ORDER BY ordinal_position;"
+            with self.cursor() as cur:
+                cur.execute(SQL, (table_name,))
+                results = cur.fetchall()
+            columns = [SchemaCatalog.column_record_to_dictionary(result) for result in results]
+            self.tables[table_name] = columns
+        return columns
+
+    # Forgets the cached columns of table_name, or of every table if
+    # table_name is None, so that they are reloaded on next use.
+    def invalidate(self, table_name = None):
+        if table_name == None:
+            self.tables = {}
+        else:
+            self.tables.pop(table_name, None)
+
+    @staticmethod
+    def column_record_to_dictionary(result):
+        return {"name": result[0],
+                "nullable": result[1] == 'YES',
+                "max_length": result[2],
+                "data_type": result[3],
+                "default": result[4]}
@@ -0,0 +1,70 @@
+import sys
+
+
+# The terminal as last drawn. Menus and forms build each frame off screen,
+# a line at a time with emit(), between begin_frame() and end_frame(), which
+# compares the frame with the previous one and writes only the lines that
+# changed, each at its own row, in a single write.
+class Screen(object):
+    __instance = None
+
+    def __init__(self):
+        if Screen.__instance != None:
+            raise Exception("An instance of Screen already exists. Use get_instance() instead.")
+        Screen.__instance = self
+        self.lines = []
+        self.previous = None # the lines on screen, None if unknown
+        self.size = None
+
+    @staticmethod
+    def get_instance():
+        if Screen.__instance == None:
+            Screen()
+        return Screen.__instance
+
+    def begin_frame(self, rows, columns):
+        if (rows, columns) != self.size:
+            self.invalidate()
+        self.size = (rows, columns)
+        self.lines = []
+
+    # Appends a line, which should fill the width of the terminal, to the
+    # frame being built. Unicode lines are encoded for the terminal, so that
+    # they can be joined with lines of (UTF-8) bytes, e.g. from the database.
+    def emit(self, line):
+        if isinstance(line, unicode):
+            line = line.encode(getattr(sys.stdout, 'encoding', None) or 'utf-8', 'replace')
+        self.lines.append(line)
+
+    # Forgets what is on screen, so that the next frame is drawn in full, e.g.
+    # after something else has written to the terminal
+    def invalidate(self):
+        self.previous = None
+
+    def end_frame(self):
+        rows, columns = self.size
+        if len(self.lines) > rows - 1:
+            # taller than the terminal: scroll through it as a whole, leaving
+            # its last rows on screen
+            out = [line + '\n' for line in self.lines]
+            self.previous = None
+        else:
+            out = []
+            if self.previous == None:
+                out.append('\x1b[H\x1b[2J')
+                self.previous = []
+            for row, line in enumerate(self.lines):
+                if row < len(self.previous) and self.previous[row] == line:
+                    continue
+                out.append('\x1b[' + str(row + 1) + ';1H\x1b[2K' + line)
+            for row in range(len(self.lines), len(self.previous)):
+                out.append('\x1b[' + str(row + 1) + ';1H\x1b[2K')
+            # leave the cursor on the last row, below the frame
+            out.append('\x1b[' + str(rows) + ';1H')
+            self.previous = self.lines
+        self.lines = []
+        self.write(''.join(out))
+
+    def write(self, text):
+        sys.stdout.write(text)
+        sys.stdout.flush()
@@ -0,0 +1,95 @@
+import re
+import threading
+import psycopg2
+import psycopg2.extensions
+
+PLACEHOLDER = re.compile(r"%%|%s")
+INVALID_SQL_STATEMENT_NAME = '26000'
+
+
+# Connection class that remembers which statements have been PREPAREd on it.
+# Prepared statements live as long as the server session, so a reconnect
+# (i.e. a new connection object) starts with an empty set and everything is
+# prepared again on first use.
+class PreparedConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super(PreparedConnection, self).__init__(*args, **kwargs)
+        self.prepared_statements = set()
+
+
+# Keeps the text of each named statement, PREPAREs it on a connection the
+# first time it is executed there, and EXECUTEs it by name afterwards, so the
+# server parses and plans it once per connection instead of on every call.
+class StatementRegistry(object):
+
+    def __init__(self):
+        self.statements = {} # name -> (sql, prepared sql, number of parameters)
+        self.calls = {}
+        self.prepares = {}
+        self.lock = threading.Lock()
+
+    # Registers sql, written with psycopg2 %s placeholders, under name. A name
+    # always refers to the same text: connections keep their prepared copy
+    # for the whole session.
+    def register(self, name, sql):
+        count = [0]
+        def to_positional(match):
+            if match.group(0) == '%%':
+                return '%'
+            count[0] += 1
+            return '$' + str(count[0])
+        prepared_sql = PLACEHOLDER.sub(to_positional, sql).strip().rstrip(';')
+        with self.lock:
+            statement = self.statements.get(name)
+            if statement != None and statement[0] != sql:
+                raise ValueError("Statement " + name + " is already registered with different SQL.")
+            self.statements[name] = (sql, prepared_sql, count[0])
+            self.calls.setdefault(name, 0)
+            self.prepares.setdefault(name, 0)
+        return self.statements[name]
+
+    # Executes the statement name (registering it as sql first if needed) on
+    # cur with the parameters in data. Results are read from cur as usual.
+    def execute(self, cur, name, sql, data = ()):
+        statement = self.statements.get(name)
+        if statement == None or statement[0] is not sql and statement[0] != sql:
+            statement = self.register(name, sql)
+        sql, prepared_sql, n_params = statement
+        self.calls[name] += 1
+
+        conn = cur.connection
+        prepared = getattr(conn, "prepared_statements", None)
+        if prepared == None: # not a PreparedConnection, run it as plain SQL
+            cur.execute(sql, data)
+            return
+
+        outside_transaction = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        try:
+            self.execute_prepared(cur, prepared, name, prepared_sql, n_params, data)
+        except psycopg2.Error as e:
+            if e.pgcode != INVALID_SQL_STATEMENT_NAME:
+                raise
+            # the session lost its prepared statements (e.g. DISCARD ALL).
+            # Only safe to retry if nothing else in the transaction is lost.
+            prepared.clear()
+            if not outside_transaction:
+                raise
+            conn.rollback()
+            self.execute_prepared(cur, prepared, name, prepared_sql, n_params, data)
+
+    def execute_prepared(self, cur, prepared, name, prepared_sql, n_params, data):
+        if name not in prepared:
+            cur.execute("PREPARE " + name + " AS " + prepared_sql)
+            prepared.add(name)
+            self.prepares[name] += 1
+        if n_params:
+            cur.execute("EXECUTE " + name + " (" + ", ".join(["%s"] * n_params) + ")", data)
+        else:
+            cur.execute("EXECUTE " + name)
+
+    # Returns a dictionary mapping statement names to dictionaries with the
+    # number of calls and the number of times it was (re)prepared.
+    def stats(self):
+        with self.lock:
+            return dict((name, {"calls": self.calls[name], "prepares": self.prepares[name]})
+                        for name in self.calls.keys())
@@ -0,0 +1,68 @@
+import os
+import sys
+import fcntl
+import termios
+import struct
+import signal
+
+
+# Size of the terminal, shared by everything that draws on it. It is read
+# with the TIOCGWINSZ ioctl the first time it is needed and then kept until
+# the terminal is resized (SIGWINCH), rather than asked for on every frame.
+class TerminalGeometry(object):
+    __instance = None
+    default_size = (24, 80)
+
+    def __init__(self):
+        if TerminalGeometry.__instance != None:
+            raise Exception("An instance of TerminalGeometry already exists. Use get_instance() instead.")
+        TerminalGeometry.__instance = self
+        self.size = None
+        self.resized = False
+        # must be called from the main thread, as signal handlers can only
+        # be installed there
+        signal.signal(signal.SIGWINCH, self.on_resize)
+        # restart reads from the keyboard interrupted by a resize
+        signal.siginterrupt(signal.SIGWINCH, False)
+
+    @staticmethod
+    def get_instance():
+        if TerminalGeometry.__instance == None:
+            TerminalGeometry()
+        return TerminalGeometry.__instance
+
+    # Returns (rows, columns)
+    def get_rows_columns(self):
+        if self.size == None:
+            self.size = self.read_size()
+        return self.size
+
+    def get_columns(self):
+        return self.get_rows_columns()[1]
+
+    # Asks the terminal on stdout, stdin or stderr for its size, falling back
+    # to $LINES and $COLUMNS, then to 24x80, e.g. when output is redirected
+    def read_size(self):
+        for stream in (sys.stdout, sys.stdin, sys.stderr):
+            try:
+                packed = fcntl.ioctl(stream.fileno(), termios.TIOCGWINSZ, struct.pack('HHHH', 0, 0, 0, 0))
+                rows, columns = struct.unpack('HHHH', packed)[:2]
+            except (IOError, OSError, ValueError, AttributeError):
+                continue
+            if rows > 0 and columns > 0:
+                return (rows, columns)
+        try:
+            return (int(os.environ['LINES']), int(os.environ['COLUMNS']))
+        except (KeyError, ValueError):
+            return TerminalGeometry.default_size
+
+    # SIGWINCH handler: the size is read again when next needed
+    def on_resize(self, signum, frame):
+        self.size = None
+        self.resized = True
+
+    # Returns whether the terminal was resized since the last call
+    def take_resize(self):
+        resized = self.resized
+        self.resized = False
+        return resized
@@ -0,0 +1,77 @@
+from collections import OrderedDict
+
+# Wrapping of text into the rows of a box of '#', shared by menus and forms.
+# Wrapped text is remembered for the most recently used (text, indentation,
+# width), so that redrawing a screen, or measuring how many rows an option
+# takes and then drawing it, lays each text out once.
+
+CACHE_SIZE = 1024
+
+
+# A dictionary holding at most max_size entries, dropping the least recently
+# used one to make room for a new one
+class LRUCache(object):
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    # Returns the value for key, or None
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value != None:
+            self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last = False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+cache = LRUCache(CACHE_SIZE)
+
+
+# Returns the rows showing text indented by indentation in a box columns
+# wide, as a tuple of strings. Every line of text takes at least a row, and
+# is cut into as many as it needs. A leading newline is dropped.
+def indented_rows(text, indentation, columns):
+    if (text == ''):
+        return ()
+    key = (text, indentation, columns)
+    rows = cache.get(key)
+    if rows != None:
+        return rows
+    if (text[0] == '\n'):
+        text = text[1:]
+    rows = []
+    text_width = max(1, columns - indentation - 2)
+    for line in text.split('\n'):
+        while True:
+            row = '#' + ' ' * (indentation - 1)
+            row += line[0:text_width]
+            n_spaces = columns - len(row) - 2
+            row += (" " * n_spaces) + " #"
+            rows.append(row)
+            line = line[text_width:]
+            if (line == ''):
+                break
+    rows = tuple(rows)
+    cache.put(key, rows)
+    return rows
+
+
+# Splits text to be shown after a field's name, which takes indentation
+# columns, into the part that fits on the field's row (up to the first
+# newline) and the rows below it (see indented_rows)
+def wrap(text, indentation, columns):
+    space_remaining = max(0, columns - indentation - 2)
+    first_new_line = text.find('\n', 0)
+    if (first_new_line == -1):
+        first_new_line = space_remaining
+    stop = min(first_new_line, space_remaining)
+    return (text[0 : stop], indented_rows(text[stop : ], indentation, columns))
@@ -1,7 +1,21 @@
 import psycopg2
+import psycopg2.extensions
 import time
+import threading
 import datetime
 import sys
+import os
+import json
+import atexit
+import signal
+from contextlib import contextmanager
+from ConnectionPool import ConnectionPool
+from SchemaCatalog import SchemaCatalog
+from StatementRegistry import StatementRegistry, PreparedConnection
+from GraphEngine import FriendGraph
+from GraphCache import GraphCache
+from NotificationListener import NotificationListener
+from Instrumentation import Instrumentation
 
 class Status:
     CONN_FAIL = 0
@@ -20,6 +34,7 @@ class Status:
     REQUEST_NONEXISTENT = 13
     GROUP_LIMIT_REACHED = 14
     UPDATE_SUCCESS = 15
+    ALREADY_FRIENDS = 16
 
 
     @staticmethod
@@ -56,18 +71,86 @@ class Status:
             return "The group's limit has been reached."
         if status == Status.UPDATE_SUCCESS:
             return "Successfully updated record."
+        if status == Status.ALREADY_FRIENDS:
+            return "You are already friends."
 
 class DatabaseHelper:
     __instance = None
 
+    # Connection settings. Change them with DatabaseHelper.configure() before the
+    # first call to get_instance(), or through SOCIAL_CLUB_<SETTING> environment
+    # variables, e.g. SOCIAL_CLUB_POOL_MAX=8.
+    # database, user, password = default to sys.argv[1], sys.argv[2], sys.argv[3]
+    # dsn = a full libpq connection string, used instead of the settings below
+    # unix_socket = directory of the server's unix socket, used instead of host/port
+    # pool_min, pool_max = number of connections kept open / allowed at once.
+    # pool_max should exceed worker_threads, so the UI thread is not kept
+    # waiting for a connection by background queries.
+    # worker_threads = number of threads running slow queries in the
+    # background (see Views.Menu.run_in_background)
+    # keepalives_* = TCP keepalive settings, see the libpq documentation
+    # three_degrees_max_hops = longest path three_degrees looks for
+    # friend_graph_max_age = seconds before the in-memory friend graph is
+    # reloaded from the database, 0 to never reload it. Not used while the
+    # graph cache is on.
+    # instrument = 1 to time every method and statement (see Instrumentation.py)
+    # slow_query_ms = statements at least this slow are logged when instrumenting
+    # explain_slow = 1 to also capture EXPLAIN (ANALYZE, BUFFERS) of slow statements
+    # instrument_report = JSON file the report is written to at exit and on SIGUSR1
+    # graph_cache = 1 to serve friend lists and checks from memory, kept
+    # current through NOTIFY (needs migrations/004_graph_notify.sql), 0 to
+    # query the database every time
+    # group_fanout = "write" to copy group messages to every member's mailbox
+    # when they are sent, "read" to store them once and find them through
+    # group membership when mailboxes are read (needs
+    # migrations/006_group_fanout.sql), "" for the database's default
+    settings = {"database": None,
+                "user": None,
+                "password": None,
+                "dsn": None,
+                "host": "127.0.0.1",
+                "port": None,
+                "unix_socket": None,
+                "pool_min": 1,
+                "pool_max": 3,
+                "worker_threads": 2,
+                "keepalives": 1,
+                "keepalives_idle": 60,
+                "keepalives_interval": 10,
+                "keepalives_count": 5,
+                "three_degrees_max_hops": 3,
+                "friend_graph_max_age": 300,
+                "graph_cache": 1,
+                "instrument": 0,
+                "slow_query_ms": 200,
+                "explain_slow": 0,
+                "instrument_report": "",
+                "group_fanout": ""}
+
+    # search_for_user only matches prefixes of keywords shorter than this
+    SEARCH_MIN_SUBSTRING = 3
+
     def __init__(self):
         if DatabaseHelper.__instance != None:
             raise Exception("An instance of DatabaseHelper already exists. Use get_instance() instead.")
         else:
             DatabaseHelper.__instance = self
-            self.conn = psycopg2.connect("dbname=" + sys.argv[1] + " user=" + sys.argv[2] + " password=" + sys.argv[3] + " host=127.0.0.1")
-            self.conn.set_client_encoding('UTF8')
-            self.cur = self.conn.cursor()
+            settings = DatabaseHelper.get_settings()
+            self.pool = ConnectionPool(settings["pool_min"], settings["pool_max"],
+                                       **DatabaseHelper.connection_arguments(settings))
+            self.schema_catalog = SchemaCatalog(lambda: self.cursor(readonly = True))
+            self.schema_catalog.preload()
+            self.statements = StatementRegistry()
+            self.instrumentation = None
+            if settings["instrument"]:
+                self.enable_instrumentation(settings)
+            self.friend_graph = FriendGraph()
+            self.three_degrees_max_hops = settings["three_degrees_max_hops"]
+            self.friend_graph_max_age = settings["friend_graph_max_age"]
+            self.listener = NotificationListener(**DatabaseHelper.connection_arguments(settings))
+            self.graph_cache = None
+            if settings["graph_cache"]:
+                self.graph_cache = GraphCache(self.pool.connection, self.listener, self.friend_graph)
 
     @staticmethod
     def get_instance():
@@ -75,52 +158,247 @@ class DatabaseHelper:
             DatabaseHelper()
         return DatabaseHelper.__instance
 
+    # Overrides connection settings, e.g. DatabaseHelper.configure(pool_max = 8).
+    # Must be called before the instance is created.
+    @staticmethod
+    def configure(**settings):
+        if DatabaseHelper.__instance != None:
+            raise Exception("DatabaseHelper is already connected. Call configure() before get_instance().")
+        for key in settings.keys():
+            if key not in DatabaseHelper.settings:
+                raise KeyError("Unknown DatabaseHelper setting: " + key)
+        DatabaseHelper.settings.update(settings)
+
+    # Returns the settings, with any SOCIAL_CLUB_<SETTING> environment variables
+    # applied on top.
+    @staticmethod
+    def get_settings():
+        settings = dict(DatabaseHelper.settings)
+        for key in settings.keys():
+            value = os.environ.get("SOCIAL_CLUB_" + key.upper())
+            if value == None:
+                continue
+            if isinstance(settings[key], int):
+                value = int(value)
+            settings[key] = value
+        return settings
+
+    # Returns the keyword arguments to pass to psycopg2.connect
+    @staticmethod
+    def connection_arguments(settings):
+        if settings["dsn"]:
+            args = {"dsn": settings["dsn"], "client_encoding": "UTF8",
+                    "connection_factory": PreparedConnection}
+            DatabaseHelper.add_session_options(args, settings)
+            return args
+        args = {"dbname": settings["database"] or sys.argv[1],
+                "user": settings["user"] or sys.argv[2],
+                "password": settings["password"] or sys.argv[3],
+                "client_encoding": "UTF8",
+                "connection_factory": PreparedConnection}
+        if settings["unix_socket"]:
+            args["host"] = settings["unix_socket"]
+        else:
+            args["host"] = settings["host"]
+            for key in ["keepalives", "keepalives_idle", "keepalives_interval", "keepalives_count"]:
+                args[key] = settings[key]
+        if settings["port"]:
+            args["port"] = settings["port"]
+        DatabaseHelper.add_session_options(args, settings)
+        return args
+
+    # Sets the server settings the triggers look at for every session
+    @staticmethod
+    def add_session_options(args, settings):
+        if settings["group_fanout"]:
+            if settings["group_fanout"] not in ["read", "write"]:
+                raise ValueError("group_fanout must be read or write: " + settings["group_fanout"])
+            args["options"] = "-c social_club.group_fanout=" + settings["group_fanout"]
+
+    # Use as "with self.cursor() as cur:". Checks a connection out of the pool
+    # for the duration of the block and returns it afterwards. Anything not
+    # committed with cur.connection.commit() is rolled back.
+    # readonly = True runs each statement on its own, in autocommit mode, for
+    # blocks that only read: this saves the BEGIN before the first statement
+    # and the ROLLBACK when the connection is returned. A block nested in
+    # another one keeps the outer block's mode.
+    @contextmanager
+    def cursor(self, readonly = False):
+        with self.pool.connection() as conn:
+            switch = conn.autocommit != readonly and \
+                conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            if switch:
+                conn.autocommit = readonly
+            cur = conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+                if switch and conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.autocommit = not readonly
+
+    # Runs the statement registered as name on cur. The statement is
+    # PREPAREd once per connection and EXECUTEd by name on later calls.
+    def execute(self, cur, name, SQL, data = ()):
+        self.statements.execute(cur, name, SQL, data)
+
+    # Returns a dictionary of connection pool statistics (checked out
+    # connections, waits, total wait time, ...).
+    def get_pool_stats(self):
+        return self.pool.stats()
+
+    # Returns a dictionary mapping each prepared statement's name to its
+    # number of calls and (re)prepares.
+    def get_statement_stats(self):
+        return self.statements.stats()
+
+    # Returns True if reads can be served by the graph cache, after applying
+    # any changes other sessions have made since the last read.
+    def use_graph_cache(self):
+        return self.graph_cache != None and self.graph_cache.refresh()
+
+    # Returns a dictionary with the sizes of the graph cache, or None if it
+    # is off.
+    def get_graph_cache_stats(self):
+        if self.graph_cache == None:
+            return None
+        return self.graph_cache.stats()
+
+    # Calls callback(message dictionary) for every message user_id receives
+    # from now on, as it is delivered (see migrations/005_inbox_notify.sql).
+    # Callbacks run from poll_notifications.
+    def watch_inbox(self, user_id, callback):
+        def on_notify(payload):
+            callback(self.inbox_payload_to_dictionary(payload))
+        try:
+            self.listener.listen(DatabaseHelper.inbox_channel(user_id), on_notify)
+        except psycopg2.Error:
+            self.listener.close() # LISTENs again on reconnect
+        self.poll_notifications()
+
+    def unwatch_inbox(self, user_id):
+        self.listener.unlisten(DatabaseHelper.inbox_channel(user_id))
+
+    @staticmethod
+    def inbox_channel(user_id):
+        return "inbox:" + user_id
+
+    # Turns the JSON payload of an inbox notification into a dictionary like
+    # those of message_records_to_dictionaries
+    def inbox_payload_to_dictionary(self, payload):
+        message = {}
+        for key, value in json.loads(payload).items():
+            # psycopg2 returns strings as UTF-8 encoded str, do the same
+            message[str(key)] = value.encode("utf-8") if isinstance(value, unicode) else value
+        message["dateSent"] = datetime.datetime.utcfromtimestamp(message["dateSent"])
+        return message
+
+    # Dispatches the notifications received so far (new messages, graph cache
+    # changes). Returns False if the listening connection failed; the next
+    # call reconnects.
+    def poll_notifications(self):
+        try:
+            self.listener.poll()
+        except psycopg2.Error:
+            return False
+        return True
+
+    # Returns a list of file descriptors that become readable when
+    # notifications arrive, to wait on with select() alongside the keyboard.
+    def get_notification_fds(self):
+        fd = self.listener.fileno()
+        if fd == None:
+            return []
+        return [fd]
+
+    def enable_instrumentation(self, settings):
+        self.instrumentation = Instrumentation(settings["slow_query_ms"], settings["explain_slow"])
+        self.instrumentation.enable(DatabaseHelper)
+        path = settings["instrument_report"]
+        if path:
+            atexit.register(self.dump_instrumentation_report, path)
+            try:
+                signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump_instrumentation_report(path))
+            except ValueError: # signals can only be handled from the main thread
+                pass
+
+    # Returns a dictionary of method and statement timings and slow queries,
+    # or None if instrumentation is off.
+    def get_instrumentation_report(self):
+        if self.instrumentation == None:
+            return None
+        return self.instrumentation.report()
+
+    # Writes the instrumentation report to the JSON file path. Returns the
+    # path, or None if instrumentation is off.
+    def dump_instrumentation_report(self, path):
+        if self.instrumentation == None:
+            return None
+        return self.instrumentation.dump(path)
+
+    # Returns the in-memory friend graph. With the graph cache on, it is
+    # kept current by notifications; otherwise it is (re)loaded from the
+    # friends table if it has not been loaded yet or is older than
+    # friend_graph_max_age. Raises psycopg2.Error if it cannot be loaded.
+    def get_friend_graph(self):
+        if self.use_graph_cache():
+            return self.friend_graph
+        graph = self.friend_graph
+        loaded_at = graph.loaded_at
+        if loaded_at == None or (self.friend_graph_max_age and time.time() - loaded_at > self.friend_graph_max_age):
+            with self.pool.connection() as conn:
+                # a named (server side) cursor streams the table instead of
+                # fetching every row into memory at once
+                cur = conn.cursor("friend_graph")
+                cur.itersize = 10000
+                try:
+                    cur.execute("SELECT userID1, userID2 FROM friends;")
+                    graph.load(cur)
+                finally:
+                    cur.close()
+                conn.commit()
+        return graph
+
     # Returns a dictionary whose keys are the attributes in the relation
     # table_name, and whose values are True or False depending on whether the
     # attribute can be null or not.
     def get_attributes_nullabities(self, table_name):
-        SQL =  "SELECT column_name, is_nullable FROM information_schema.columns WHERE table_name = %s"
-        data = (table_name,)
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
         dict = {}
-        for result in results:
-            dict[result[0]] = True if result[1] == 'YES' else False
+        for column in self.schema_catalog.get_columns(table_name):
+            dict[column["name"]] = column["nullable"]
         return dict
 
     # Returns a dictionary whose keys are the attributes in the relation
     # table_name, and whose values are the maximum lengths of the attributes.
     # Will only return attributes that have a maximum length specified.
     def get_attributes_lengths(self, table_name):
-        SQL =  "SELECT column_name, character_maximum_length FROM information_schema.columns WHERE table_name = %s"
-        data = (table_name,)
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
         dict = {}
-        for result in results:
-            if result[1]:
-                dict[result[0]] = result[1]
+        for column in self.schema_catalog.get_columns(table_name):
+            if column["max_length"]:
+                dict[column["name"]] = column["max_length"]
         return dict
 
     # Returns a list of any attributes in the relation table_name that have
     # a data type of date
     def get_date_attributes(self, table_name):
-        SQL =  "SELECT column_name, data_type FROM information_schema.columns WHERE table_name = %s"
-        data = (table_name,)
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
         lst = []
-        for result in results:
-            if result[1] == 'date':
-                lst.append(result[0])
+        for column in self.schema_catalog.get_columns(table_name):
+            if column["data_type"] == 'date':
+                lst.append(column["name"])
         return lst
 
+    # Forgets cached schema metadata for table_name (or for every table if
+    # table_name is None). Call after altering a table's columns.
+    def invalidate_schema_cache(self, table_name = None):
+        self.schema_catalog.invalidate(table_name)
+
     # Returns True if a username already exists in the database, False otherwise.
     def check_username_exists(self, username):
         SQL = "SELECT * FROM profile WHERE userID = %s"
         data = (username,)
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "check_username_exists", SQL, data)
+            results = cur.fetchall()
         if not results:
             return False
         return True
@@ -129,8 +407,9 @@ class DatabaseHelper:
     def check_group_id_exists(self, group_id):
         SQL = "SELECT * FROM groups WHERE gid = %s"
         data = (group_id,)
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "check_group_id_exists", SQL, data)
+            results = cur.fetchall()
         if not results:
             return False
         return True
@@ -138,8 +417,9 @@ class DatabaseHelper:
     # Returns True if an email already exists in the database, False otherwise.
     def check_email_exists(self, email):
         SQL = "SELECT * FROM profile WHERE email = %s"
-        self.cur.execute(SQL, (email,))
-        results = self.cur.fetchall()
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "check_email_exists", SQL, (email,))
+            results = cur.fetchall()
         if not results:
             return False
         return True
@@ -216,8 +496,9 @@ class DatabaseHelper:
     # matches given_password. Returns True if so, false otherwise.
     def check_passwords_match(self, given_username, given_password):
         SQL = "SELECT * FROM profile WHERE userID = %s"
-        self.cur.execute(SQL, (given_username,))
-        results = self.cur.fetchall()
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "check_passwords_match", SQL, (given_username,))
+            results = cur.fetchall()
         if not results:
             return False
         result = self.profile_records_to_dictionaries(results)[0]
@@ -237,43 +518,61 @@ class DatabaseHelper:
         sql = 'INSERT INTO profile(userID, fname, lname, email, password, DOB, lastlogin)\
                 VALUES (%s, %s, %s, %s, %s, %s, %s);'
         data = (username, f_name, l_name, email, password, DOB, lastlogin)
-        try:
-			self.cur.execute(sql,data)
-			self.conn.commit()
-        except psycopg2.IntegrityError:
-            self.conn.rollback()
-            return Status.DATABASE_ERROR
+        with self.cursor() as cur:
+            try:
+                self.execute(cur, "create_new_user", sql, data)
+                cur.connection.commit()
+            except psycopg2.IntegrityError:
+                cur.connection.rollback()
+                return Status.DATABASE_ERROR
         return Status.CREATE_SUCCESS
 
     # Check if a friendship exists between user_id1 and user_id2. Returns True
     # if they are friends, False otherwise.
     def check_friendship_exists(self, user_id1, user_id2):
+        if self.use_graph_cache():
+            return self.graph_cache.are_friends(user_id1, user_id2)
         SQL = "SELECT * FROM friends WHERE (userID1 = %s AND userID2 = %s) OR (userID1 = %s AND userID2 = %s);"
         data = ((user_id1, user_id2, user_id2, user_id1))
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "check_friendship_exists", SQL, data)
+            results = cur.fetchall()
         if not results:
             return False
         return True
 
     # Returns all friends of the user_id
     def get_all_friends(self, user_id):
-        SQL = "WITH a AS (SELECT userid1 as friendid FROM friends WHERE userid2 = %s),\
-                    b AS (SELECT userid2 as friendid FROM friends WHERE userid1 = %s),\
-                    c AS (SELECT * FROM a UNION SELECT * FROM b)\
-               SELECT userid, fname, lname, email, '', dob, lastlogin FROM c JOIN profile ON c.friendid = profile.userid;"
-        data = (user_id, user_id)
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
+        if self.use_graph_cache():
+            results = self.graph_cache.get_profiles(self.graph_cache.friends_of(user_id), self.get_friend_profiles)
+        else:
+            SQL = "WITH a AS (SELECT userid1 as friendid FROM friends WHERE userid2 = %s),\
+                        b AS (SELECT userid2 as friendid FROM friends WHERE userid1 = %s),\
+                        c AS (SELECT * FROM a UNION SELECT * FROM b)\
+                   SELECT userid, fname, lname, email, '', dob, lastlogin FROM c JOIN profile ON c.friendid = profile.userid;"
+            data = (user_id, user_id)
+            with self.cursor(readonly = True) as cur:
+                self.execute(cur, "get_all_friends", SQL, data)
+                results = cur.fetchall()
         if not results:
             return None
         return self.profile_records_to_dictionaries(results)
 
+    # Returns the profile records (without passwords) of the users in the
+    # list user_ids, for the graph cache.
+    def get_friend_profiles(self, user_ids):
+        SQL = "SELECT userid, fname, lname, email, '', dob, lastlogin FROM profile WHERE userid = ANY(CAST(%s AS varchar[]));"
+        data = (list(user_ids),)
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "get_friend_profiles", SQL, data)
+            return cur.fetchall()
+
     # returns None if there is no corresponding name
     def get_names_from_user_id(self, user_id):
         SQL = "SELECT fname, lname FROM profile WHERE userID = %s"
-        self.cur.execute(SQL, (user_id,))
-        results = self.cur.fetchall()
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "get_names_from_user_id", SQL, (user_id,))
+            results = cur.fetchall()
         if not results:
             return None
         return(results[0])
@@ -282,8 +581,9 @@ class DatabaseHelper:
     def get_group_name_from_group_id(self, group_id):
         SQL = "SELECT name FROM groups WHERE gid = %s"
         data = (group_id,)
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "get_group_name_from_group_id", SQL, data)
+            results = cur.fetchall()
         if not results:
             return None
         name, = results[0]
@@ -292,10 +592,13 @@ class DatabaseHelper:
     # returns true if user_id1 has a friend request from user_id2.
     # In database, userID2 is recipient.
     def check_has_pending_friend_request_from(self, user_id1, user_id2):
+        if self.use_graph_cache():
+            return self.graph_cache.has_pending(user_id2, user_id1)
         SQL = "SELECT * FROM pendingfriends WHERE userID2 = %s AND userID1 = %s;"
         data = (user_id1, user_id2)
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "check_has_pending_friend_request_from", SQL, data)
+            results = cur.fetchall()
         if not results:
             return False
         return True
@@ -304,8 +607,9 @@ class DatabaseHelper:
     def check_has_pending_join_request_from(self, group_id, user_id):
         SQL = "SELECT * FROM pendinggroupmembers WHERE gid = %s AND userid = %s;"
         data = (group_id, user_id)
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "check_has_pending_join_request_from", SQL, data)
+            results = cur.fetchall()
         if not results:
             return False
         return True
@@ -314,8 +618,9 @@ class DatabaseHelper:
     def check_is_group_manager(self, user_id, group_id):
         SQL = "SELECT * FROM groupmembership WHERE userID = %s AND gID = %s AND role = 'manager';"
         data = (user_id, group_id)
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "check_is_group_manager", SQL, data)
+            results = cur.fetchall()
         if not results:
             return False
         return True
@@ -324,8 +629,9 @@ class DatabaseHelper:
     def check_is_group_member(self, user_id, group_id):
         SQL = "SELECT * FROM groupmembership WHERE userID = %s AND gID = %s AND role = 'member';"
         data = (user_id, group_id)
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "check_is_group_member", SQL, data)
+            results = cur.fetchall()
         if not results:
             return False
         return True
@@ -334,8 +640,9 @@ class DatabaseHelper:
     def check_is_group_member_or_manager(self, user_id, group_id):
         SQL = "SELECT role FROM groupmembership WHERE userID = %s AND gID = %s;"
         data = (user_id, group_id)
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "check_is_group_member_or_manager", SQL, data)
+            results = cur.fetchall()
         if not results:
             return False
         role, = results[0]
@@ -344,29 +651,35 @@ class DatabaseHelper:
     # Inserts a friend request from user_id1 to user_id2 into pendingfriends
     def insert_friend_request(self, user_id1, user_id2, message):
         if message == None:
+            name = "insert_friend_request_default_message"
             SQL = "INSERT INTO pendingfriends (userid1, userid2) VALUES (%s, %s);"
             data = (user_id1, user_id2)
         else:
+            name = "insert_friend_request"
             SQL = "INSERT INTO pendingfriends VALUES (%s, %s, %s);"
             data = (user_id1, user_id2, message)
-        try:
-			self.cur.execute(SQL,data)
-			self.conn.commit()
-        except psycopg2.IntegrityError:
-            self.conn.rollback()
-            return Status.DATABASE_ERROR
+        with self.cursor() as cur:
+            try:
+                self.execute(cur, name, SQL, data)
+                cur.connection.commit()
+            except psycopg2.IntegrityError:
+                cur.connection.rollback()
+                return Status.DATABASE_ERROR
+        if self.graph_cache != None:
+            self.graph_cache.add_pending(user_id1, user_id2)
         return Status.INSERT_SUCCESS
 
     # Inserts a group join request from user_id to group_id
     def insert_group_join_request(self, user_id, group_id, message):
         SQL = "INSERT INTO pendinggroupmembers VALUES (%s, %s, %s);"
         data = (group_id, user_id, message)
-        try:
-			self.cur.execute(SQL,data)
-			self.conn.commit()
-        except psycopg2.IntegrityError:
-            self.conn.rollback()
-            return Status.DATABASE_ERROR
+        with self.cursor() as cur:
+            try:
+                self.execute(cur, "insert_group_join_request", SQL, data)
+                cur.connection.commit()
+            except psycopg2.IntegrityError:
+                cur.connection.rollback()
+                return Status.DATABASE_ERROR
         return Status.INSERT_SUCCESS
 
     # inserts a message from user_id1 to user_id2
@@ -374,24 +687,26 @@ class DatabaseHelper:
     def insert_message_to_user(self, user_id1, user_id2, message):
         SQL = "INSERT INTO messages (fromuserid, touserid, message) VALUES (%s, %s, %s);"
         data = (user_id1, user_id2, message)
-        try:
-			self.cur.execute(SQL,data)
-			self.conn.commit()
-        except psycopg2.IntegrityError as e:
-            print(str(e))
-            self.conn.rollback()
-            return Status.DATABASE_ERROR
+        with self.cursor() as cur:
+            try:
+                self.execute(cur, "insert_message_to_user", SQL, data)
+                cur.connection.commit()
+            except psycopg2.IntegrityError as e:
+                print(str(e))
+                cur.connection.rollback()
+                return Status.DATABASE_ERROR
         return Status.INSERT_SUCCESS
 
     def insert_message_to_group(self, user_id, group_id, message):
         SQL = "INSERT INTO messages (fromuserid, togroupid, message) VALUES (%s, %s, %s);"
         data = (user_id, group_id, message)
-        try:
-			self.cur.execute(SQL,data)
-			self.conn.commit()
-        except psycopg2.IntegrityError:
-            self.conn.rollback()
-            return Status.DATABASE_ERROR
+        with self.cursor() as cur:
+            try:
+                self.execute(cur, "insert_message_to_group", SQL, data)
+                cur.connection.commit()
+            except psycopg2.IntegrityError:
+                cur.connection.rollback()
+                return Status.DATABASE_ERROR
         return Status.INSERT_SUCCESS
 
     # Create a new group with user_id as the manager
@@ -400,37 +715,125 @@ class DatabaseHelper:
         data1 = (group_id, group_name, limit, description)
         SQL2 = "INSERT INTO groupmembership VALUES (%s, %s, %s);"
         data2 = (group_id, user_id, 'manager')
-        try:
-            self.cur.execute(SQL1,data1)
-            self.cur.execute(SQL2,data2)
-            self.conn.commit()
-        except psycopg2.IntegrityError:
-            self.conn.rollback()
-            return Status.DATABASE_ERROR
+        with self.cursor() as cur:
+            try:
+                self.execute(cur, "create_group_group", SQL1, data1)
+                self.execute(cur, "create_group_manager", SQL2, data2)
+                cur.connection.commit()
+            except psycopg2.IntegrityError:
+                cur.connection.rollback()
+                return Status.DATABASE_ERROR
         return Status.INSERT_SUCCESS
 
 
     # Returns the default value for attribute in the relation with
     # name table_name, or None if there is no default value for attribute.
     def get_default_value(self, table_name, attribute):
-        SQL =  "SELECT column_name, column_default FROM information_schema.columns WHERE table_name = %s AND column_name = %s;"
-        data = (table_name, attribute)
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
-        if not results:
-            return None
-        return results[0][1]
+        for column in self.schema_catalog.get_columns(table_name):
+            if column["name"] == attribute:
+                return column["default"]
+        return None
 
     # Returns a list of dictionaries of users found by a search with keywoard
-    def search_for_user(self, keyword):
-        SQL =  "SELECT * FROM profile WHERE LOWER(userid) LIKE %s OR LOWER(fname) LIKE %s OR LOWER(lname) LIKE %s OR LOWER(email) LIKE %s;"
-        keyword = '%' + keyword.lower() + '%'
-        data = (keyword, keyword, keyword, keyword)
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
-        if not results:
+    # Results are ranked: an exact username match first (rank 0), then
+    # username prefix matches (rank 1), first name prefix matches (rank 2),
+    # last name prefix matches (rank 3), then any other match of the
+    # username, names or email (rank 4). Prefix matches are ordered by the
+    # matching column, the others by username. Each dictionary has extra keys
+    # "rank" and "search_after". Pass limit to get at most that many, and
+    # after = the "search_after" of the last result to get the next ones.
+    # Each rank is a query of its own, reading rows in order from an index
+    # (see migrations/002_user_search.sql) and stopping at the limit, so that
+    # a short keyword matching many users is as fast as a long one.
+    # Keywords shorter than SEARCH_MIN_SUBSTRING only match prefixes, since
+    # the trigram indexes cannot serve them.
+    def search_for_user(self, keyword, after = None, limit = None):
+        keyword = keyword.lower()
+        if isinstance(keyword, unicode):
+            keyword = keyword.encode('utf-8')
+        ranks = [0, 1, 2, 3]
+        if len(keyword) >= DatabaseHelper.SEARCH_MIN_SUBSTRING:
+            ranks.append(4)
+        profiles = []
+        for rank in ranks:
+            if after != None and rank < after[0]:
+                continue
+            remaining = None
+            if limit != None:
+                remaining = limit - len(profiles)
+                if remaining <= 0:
+                    break
+            rank_after = None
+            if after != None and rank == after[0]:
+                rank_after = after[1:]
+            profiles += self.search_for_user_rank(rank, keyword, rank_after, remaining)
+        if not profiles:
             return None
-        return self.profile_records_to_dictionaries(results)
+        return profiles
+
+    # The columns whose prefixes ranks 1, 2 and 3 of search_for_user match
+    SEARCH_PREFIX_COLUMNS = {1: "userID", 2: "fname", 3: "lname"}
+    # Sorts after every string starting with a given prefix (the UTF-8
+    # encoding of the largest code point), in the byte order of the
+    # text_pattern_ops indexes
+    SEARCH_PREFIX_END = '\xf4\x8f\xbf\xbf'
+
+    # Returns search_for_user's results of one rank, after = (sort key,
+    # userID) of the last result of that rank already returned, or None.
+    def search_for_user_rank(self, rank, keyword, after, limit):
+        escaped = keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        prefix = escaped + '%'
+        if rank == 0:
+            sort_key = "LOWER(userID)"
+            condition = "LOWER(userID) = %s"
+            data = (keyword,)
+            if after != None:
+                condition += " AND userID > %s"
+                data += (after[1],)
+            order = "userID"
+        elif rank in DatabaseHelper.SEARCH_PREFIX_COLUMNS:
+            # a range of the column's index, starting after the last result
+            sort_key = "LOWER(" + DatabaseHelper.SEARCH_PREFIX_COLUMNS[rank] + ")"
+            condition = sort_key + " ~>=~ %s AND " + sort_key + " ~<=~ %s"
+            if after == None:
+                data = (keyword, keyword + DatabaseHelper.SEARCH_PREFIX_END)
+            else:
+                condition += " AND (" + sort_key + " ~>~ %s OR userID > %s)"
+                data = (after[0], keyword + DatabaseHelper.SEARCH_PREFIX_END) + tuple(after)
+            # leave out the users found by the ranks before
+            if rank == 1:
+                condition += " AND LOWER(userID) <> %s"
+                data += (keyword,)
+            else:
+                condition += " AND (LOWER(userID) LIKE %s) IS NOT TRUE"
+                data += (prefix,)
+            if rank == 3:
+                condition += " AND (LOWER(fname) LIKE %s) IS NOT TRUE"
+                data += (prefix,)
+            order = sort_key + " USING ~<~, userID"
+        else:
+            sort_key = "userID"
+            contains = '%' + escaped + '%'
+            condition = "(LOWER(userid) LIKE %s OR LOWER(fname) LIKE %s OR LOWER(lname) LIKE %s OR LOWER(email) LIKE %s)\
+                         AND (LOWER(userid) LIKE %s OR LOWER(fname) LIKE %s OR LOWER(lname) LIKE %s) IS NOT TRUE"
+            data = (contains, contains, contains, contains, prefix, prefix, prefix)
+            if after != None:
+                condition += " AND userID > %s"
+                data += (after[1],)
+            order = "userID"
+        name = "search_for_user_" + str(rank)
+        if after != None:
+            name += "_after"
+        SQL = "SELECT userID, fname, lname, email, password, DOB, lastlogin, " + sort_key + " FROM profile\
+               WHERE " + condition + " ORDER BY " + order + " LIMIT %s;"
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, name, SQL, data + (limit,))
+            results = cur.fetchall()
+        profiles = self.profile_records_to_dictionaries(results)
+        for profile, result in zip(profiles, results):
+            profile["rank"] = rank
+            profile["search_after"] = (rank, result[7], profile["userID"])
+        return profiles
 
     # Returns a list of dictionaries of unconfirmed friend requests for a given user
     # In database, userID2 is recipient.
@@ -438,8 +841,9 @@ class DatabaseHelper:
         SQL =  "WITH a AS (SELECT * FROM pendingfriends WHERE userid2 = %s)\
                SELECT userid2, userid1, fname, lname, message FROM a JOIN profile ON a.userid1 = profile.userid;"
         data = (user_id,)
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "get_unconfirmed_friend_requests", SQL, data)
+            results = cur.fetchall()
         if not results:
             return None
         return self.pendingfriends_records_to_dictionaries(results)
@@ -448,116 +852,235 @@ class DatabaseHelper:
     def delete_friend_request(self, user_id1, user_id2):
         SQL = "DELETE FROM pendingfriends WHERE userID1 = %s and userID2 = %s;"
         data = (user_id1, user_id2)
-        try:
-			self.cur.execute(SQL,data)
-			self.conn.commit()
-        except psycopg2.IntegrityError:
-            self.conn.rollback()
-            return Status.DATABASE_ERROR
+        with self.cursor() as cur:
+            try:
+                self.execute(cur, "delete_friend_request", SQL, data)
+                cur.connection.commit()
+            except psycopg2.IntegrityError:
+                cur.connection.rollback()
+                return Status.DATABASE_ERROR
+        if self.graph_cache != None:
+            self.graph_cache.remove_pending(user_id1, user_id2)
         return Status.DELETE_SUCCESS
 
     # Deletes a pending group join request from user_id1 to group_id
     def delete_group_join_request(self, user_id, group_id):
         SQL = "DELETE FROM pendinggroupmembers WHERE userID = %s and gid = %s;"
         data = (user_id, group_id)
-        try:
-			self.cur.execute(SQL,data)
-			self.conn.commit()
-        except psycopg2.IntegrityError:
-            self.conn.rollback()
-            return Status.DATABASE_ERROR
+        with self.cursor() as cur:
+            try:
+                self.execute(cur, "delete_group_join_request", SQL, data)
+                cur.connection.commit()
+            except psycopg2.IntegrityError:
+                cur.connection.rollback()
+                return Status.DATABASE_ERROR
         return Status.DELETE_SUCCESS
 
     # Inserts a friendship between user_id1 and user_id2, provided there is a
     # request from user_id1 to user_id2
     def create_friendship(self, user_id1, user_id2, message = None):
-        SQL = "SELECT * FROM pendingfriends WHERE userID1 = %s and userID2 = %s"
-        data = (user_id1, user_id2)
-        self.cur.execute(SQL,data)
-        res = self.cur.fetchall()
-        if not res:
-            return Status.REQUEST_NONEXISTENT
-        # delete the old friend request
-        SQL = "DELETE FROM pendingfriends WHERE userID1 = %s and userID2 = %s;"
-        data = (user_id1, user_id2)
-        try:
-			self.cur.execute(SQL,data)
-        except psycopg2.IntegrityError:
-            return Status.DELETE_ERROR
-        # insert the new friendship
-        SQL = "INSERT INTO friends (userID1, userID2, friendshipdate) VALUES(%s, %s, %s);"
-        accept_date = datetime.date.today()
-        data = (user_id1, user_id2, accept_date)
-        try:
-			self.cur.execute(SQL,data)
-			self.conn.commit()
-        except psycopg2.IntegrityError:
-            self.conn.rollback()
-            return Status.DATABASE_ERROR
+        with self.cursor() as cur:
+            SQL = "SELECT * FROM pendingfriends WHERE userID1 = %s and userID2 = %s"
+            data = (user_id1, user_id2)
+            self.execute(cur, "create_friendship_select", SQL, data)
+            res = cur.fetchall()
+            if not res:
+                return Status.REQUEST_NONEXISTENT
+            # delete the old friend request
+            SQL = "DELETE FROM pendingfriends WHERE userID1 = %s and userID2 = %s;"
+            data = (user_id1, user_id2)
+            try:
+                self.execute(cur, "create_friendship_delete", SQL, data)
+            except psycopg2.IntegrityError:
+                return Status.DELETE_ERROR
+            # insert the new friendship
+            SQL = "INSERT INTO friends (userID1, userID2, friendshipdate) VALUES(%s, %s, %s);"
+            accept_date = datetime.date.today()
+            data = (user_id1, user_id2, accept_date)
+            try:
+                self.execute(cur, "create_friendship_insert", SQL, data)
+                cur.connection.commit()
+            except psycopg2.IntegrityError:
+                cur.connection.rollback()
+                return Status.DATABASE_ERROR
+        self.friend_graph.add_friendship(user_id1, user_id2)
+        if self.graph_cache != None:
+            self.graph_cache.remove_pending(user_id1, user_id2)
         return Status.INSERT_SUCCESS
 
     # Returns the group limit of a group
     def get_group_limit(self, group_id):
         SQL = "SELECT lmt FROM groups WHERE gID = %s"
         data = (group_id,)
-        self.cur.execute(SQL, data)
-        limit = self.cur.fetchall()
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "get_group_limit", SQL, data)
+            limit = cur.fetchall()
         if not limit:
             return 0
         return limit
 
-    # Returns the number of members in a group
+    # Returns the number of members in a group, as kept in groups.member_count
+    # by the group_lmt trigger
     def get_group_member_count(self, group_id):
-        SQL = "SELECT COUNT(userID) FROM groupmembership WHERE gID = %s"
+        SQL = "SELECT COALESCE((SELECT member_count FROM groups WHERE gID = %s), 0)"
         data = (group_id,)
-        self.cur.execute(SQL, data)
-        member_count = self.cur.fetchall()
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "get_group_member_count", SQL, data)
+            member_count = cur.fetchall()
         return member_count
 
     # Returns true if the group has reached its limit, false otherwise
     def check_group_limit_reached(self, group_id):
-        limit = self.get_group_limit(group_id)
-        member_count = self.get_group_member_count(group_id)
-        return limit == member_count
+        SQL = "SELECT member_count >= lmt FROM groups WHERE gID = %s"
+        data = (group_id,)
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "check_group_limit_reached", SQL, data)
+            result = cur.fetchone()
+        return result != None and result[0]
 
     # Adds a user_id to a group group_id, provided there is a request to join
     # the group
     def add_group_member(self, user_id, group_id):
-        if self.check_group_limit_reached(group_id):
-            return Status.GROUP_LIMIT_REACHED
-
-        SQL = "DELETE FROM pendinggroupmembers WHERE userID = %s and gID = %s RETURNING gID;"
-        data = (user_id, group_id)
-        try:
-			self.cur.execute(SQL,data)
-        except psycopg2.IntegrityError:
-            return Status.DATABASE_ERROR
-
-        results = self.cur.fetchall()
-        if not results:
-            return Status.REQUEST_NONEXISTENT
-
-        SQL = "INSERT INTO groupmembership VALUES(%s, %s, 'member');"
-        data = (group_id, user_id)
-        try:
-			self.cur.execute(SQL,data)
-			self.conn.commit()
-        except psycopg2.IntegrityError:
-            self.conn.rollback()
-            return Status.DATABASE_ERROR
+        with self.cursor() as cur:
+            # the group stays locked until the member is inserted, so that
+            # another manager cannot fill it in the meantime
+            SQL = "SELECT member_count >= lmt FROM groups WHERE gID = %s FOR UPDATE;"
+            self.execute(cur, "add_group_member_lock", SQL, (group_id,))
+            result = cur.fetchone()
+            if result != None and result[0]:
+                cur.connection.rollback()
+                return Status.GROUP_LIMIT_REACHED
+
+            SQL = "DELETE FROM pendinggroupmembers WHERE userID = %s and gID = %s RETURNING gID;"
+            data = (user_id, group_id)
+            try:
+                self.execute(cur, "add_group_member_delete", SQL, data)
+            except psycopg2.IntegrityError:
+                return Status.DATABASE_ERROR
+
+            results = cur.fetchall()
+            if not results:
+                return Status.REQUEST_NONEXISTENT
+
+            SQL = "INSERT INTO groupmembership VALUES(%s, %s, 'member');"
+            data = (group_id, user_id)
+            try:
+                self.execute(cur, "add_group_member_insert", SQL, data)
+                cur.connection.commit()
+            except psycopg2.IntegrityError:
+                cur.connection.rollback()
+                return Status.DATABASE_ERROR
 
         return Status.INSERT_SUCCESS
 
-    # Accepts all of user_id's current pending requests
+    # Accepts all of user_id's current pending requests in a single statement.
+    # Returns a dictionary mapping each requester's user id to
+    # Status.INSERT_SUCCESS, or to Status.ALREADY_FRIENDS for requests the
+    # reverse_friend trigger (or the primary key) would reject. Rejected
+    # requests are left pending. Returns Status.DATABASE_ERROR if nothing
+    # could be accepted.
     def accept_all_friend_requests(self, user_id):
-        pending = self.get_unconfirmed_friend_requests(user_id)
-        if pending == None:
-            return Status.INSERT_SUCCESS
-        for request in pending:
-            res = self.create_friendship(request["userID1"], request["userID2"])
-            if not res == Status.INSERT_SUCCESS:
-                return res
-        return Status.INSERT_SUCCESS
+        SQL = "WITH pending AS (SELECT p.userID1, p.userID2,\
+                                       EXISTS (SELECT 1 FROM friends f WHERE (f.userID1 = p.userID2 AND f.userID2 = p.userID1)\
+                                                                          OR (f.userID1 = p.userID1 AND f.userID2 = p.userID2)) AS rejected\
+                                FROM pendingFriends p WHERE p.userID2 = %s FOR UPDATE OF p),\
+                    accepted AS (DELETE FROM pendingFriends d USING pending\
+                                 WHERE d.userID1 = pending.userID1 AND d.userID2 = pending.userID2 AND NOT pending.rejected\
+                                 RETURNING d.userID1, d.userID2),\
+                    inserted AS (INSERT INTO friends (userID1, userID2, friendshipDate)\
+                                 SELECT userID1, userID2, CAST(%s AS date) FROM accepted RETURNING userID1)\
+               SELECT pending.userID1, inserted.userID1 IS NOT NULL FROM pending LEFT JOIN inserted ON inserted.userID1 = pending.userID1;"
+        data = (user_id, datetime.date.today())
+        with self.cursor() as cur:
+            try:
+                self.execute(cur, "accept_all_friend_requests", SQL, data)
+                results = cur.fetchall()
+                cur.connection.commit()
+            except (psycopg2.IntegrityError, psycopg2.InternalError):
+                cur.connection.rollback()
+                return Status.DATABASE_ERROR
+        outcomes = {}
+        for requester_id, accepted in results:
+            outcomes[requester_id] = Status.INSERT_SUCCESS if accepted else Status.ALREADY_FRIENDS
+            if accepted:
+                self.friend_graph.add_friendship(requester_id, user_id)
+                if self.graph_cache != None:
+                    self.graph_cache.remove_pending(requester_id, user_id)
+        return outcomes
+
+    # Accepts the pending join requests of every group managed by manager_id,
+    # admitting as many as fit under each group's limit, all in one
+    # transaction. Returns a dictionary mapping (requester user id, group id)
+    # to Status.INSERT_SUCCESS, or Status.GROUP_LIMIT_REACHED for requests that
+    # did not fit (those stay pending). Returns Status.DATABASE_ERROR if
+    # nothing could be accepted.
+    def accept_all_group_join_requests(self, manager_id):
+        # lock the groups first so that the member counts below cannot change
+        # before the new members are inserted
+        SQL1 = "SELECT groups.gID FROM groups JOIN groupMembership ON groupMembership.gID = groups.gID\
+                WHERE groupMembership.userID = %s AND groupMembership.role = 'manager' FOR UPDATE OF groups;"
+        SQL2 = "WITH managed AS (SELECT groups.gID, groups.lmt, groups.member_count FROM groups JOIN groupMembership ON groupMembership.gID = groups.gID\
+                                 WHERE groupMembership.userID = %s AND groupMembership.role = 'manager'),\
+                     ranked AS (SELECT p.gID, p.userID,\
+                                       row_number() OVER (PARTITION BY p.gID ORDER BY p.userID) <= managed.lmt - managed.member_count AS admitted\
+                                FROM pendingGroupMembers p JOIN managed ON managed.gID = p.gID),\
+                     accepted AS (DELETE FROM pendingGroupMembers d USING ranked\
+                                  WHERE d.gID = ranked.gID AND d.userID = ranked.userID AND ranked.admitted\
+                                  RETURNING d.gID, d.userID),\
+                     inserted AS (INSERT INTO groupMembership (gID, userID, role)\
+                                  SELECT gID, userID, 'member' FROM accepted RETURNING gID, userID)\
+                SELECT ranked.userID, ranked.gID, inserted.userID IS NOT NULL\
+                FROM ranked LEFT JOIN inserted ON inserted.gID = ranked.gID AND inserted.userID = ranked.userID;"
+        data = (manager_id,)
+        with self.cursor() as cur:
+            try:
+                self.execute(cur, "accept_all_group_join_requests_lock", SQL1, data)
+                self.execute(cur, "accept_all_group_join_requests", SQL2, data)
+                results = cur.fetchall()
+                cur.connection.commit()
+            except (psycopg2.IntegrityError, psycopg2.InternalError):
+                cur.connection.rollback()
+                return Status.DATABASE_ERROR
+        outcomes = {}
+        for requester_id, group_id, admitted in results:
+            outcomes[(requester_id, group_id)] = Status.INSERT_SUCCESS if admitted else Status.GROUP_LIMIT_REACHED
+        return outcomes
+
+    # Deletes the pending join requests of every group managed by manager_id
+    # in one statement. Returns a dictionary mapping (requester user id,
+    # group id) to Status.DELETE_SUCCESS, or Status.DATABASE_ERROR.
+    def delete_all_group_join_requests(self, manager_id):
+        SQL = "DELETE FROM pendingGroupMembers p USING groupMembership m\
+               WHERE m.gID = p.gID AND m.userID = %s AND m.role = 'manager' RETURNING p.userID, p.gID;"
+        data = (manager_id,)
+        with self.cursor() as cur:
+            try:
+                self.execute(cur, "delete_all_group_join_requests", SQL, data)
+                results = cur.fetchall()
+                cur.connection.commit()
+            except psycopg2.IntegrityError:
+                cur.connection.rollback()
+                return Status.DATABASE_ERROR
+        return dict(((requester_id, group_id), Status.DELETE_SUCCESS) for requester_id, group_id in results)
+
+    # Deletes all of user_id's pending friend requests in one statement. Returns
+    # a dictionary mapping each requester's user id to Status.DELETE_SUCCESS,
+    # or Status.DATABASE_ERROR.
+    def delete_all_friend_requests(self, user_id):
+        SQL = "DELETE FROM pendingFriends WHERE userID2 = %s RETURNING userID1;"
+        data = (user_id,)
+        with self.cursor() as cur:
+            try:
+                self.execute(cur, "delete_all_friend_requests", SQL, data)
+                results = cur.fetchall()
+                cur.connection.commit()
+            except psycopg2.IntegrityError:
+                cur.connection.rollback()
+                return Status.DATABASE_ERROR
+        if self.graph_cache != None:
+            for requester_id, in results:
+                self.graph_cache.remove_pending(requester_id, user_id)
+        return dict((requester_id, Status.DELETE_SUCCESS) for requester_id, in results)
 
     # Returns a list of dictionaries of unconfirmed group join requests for any groups managed by a
     # given user.
@@ -568,8 +1091,9 @@ class DatabaseHelper:
                SELECT managerid, c.userid, fname, lname, message, gid, name, lmt, description FROM c JOIN profile ON c.userid = profile.userid;"
 
         data = (user_id,)
-        self.cur.execute(SQL, data)
-        results = self.cur.fetchall()
+        with self.cursor(readonly = True) as cur:
+            self.execute(cur, "get_unconfirmed_group_join_requests", SQL, data)
+            results = cur.fetchall()
         if not results:
             return None
         return self.pendinggroupmembers_records_to_dictionaries(results)
@@ -578,115 +1102,129 @@ class DatabaseHelper:
     def update_last_login(self, user_id, timestamp):
         SQL = "UPDATE profile SET lastlogin = %s WHERE userid = %s;"
         data = (timestamp, user_id)
-        try:
-			self.cur.execute(SQL,data)
-			self.conn.commit()
-        except psycopg2.IntegrityError:
-            self.conn.rollback()
-            return Status.DATABASE_ERROR
+        with self.cursor() as cur:
+            try:
+                self.execute(cur, "update_last_login", SQL, data)
+                cur.connection.commit()
+            except psycopg2.IntegrityError:
+                cur.connection.rollback()
+                return Status.DATABASE_ERROR
         return Status.UPDATE_SUCCESS
 
 	#given the user-IDs of two users A and B, find if there exists a path between these two users  with at most 3 hops between  the  two  users
-    def three_degrees(self, user_id1, user_id2):
-        uid1 = str(user_id1)
-        uid2 = str(user_id2)
-
-        # check for 1 hop:
-
-        # check for 2 hops:
-
-        #check for 3 hops;
-		#hops are repeated, e.g. uid1 -> uid2 -> uid1, but all of these are a maximum of 3 hops away, so doesn't matter
-        SQL = "WITH friends_both_directions AS ((SELECT userID1, userID2 FROM friends) UNION (SELECT userID2, userID1 FROM friends)),\
-                        three_hops AS (SELECT * FROM friends NATURAL JOIN (SELECT userID1 as userID2, userID2 as userID3 FROM friends_both_directions) as fbd1 NATURAL JOIN (SELECT userID1 as userID3, userID2 as userID4 FROM friends_both_directions) as fbd2 WHERE friends.userID1 = %s )\
-               SELECT * from three_hops WHERE userID2 = %s OR userID3 = %s OR userID4 = %s;"
-
-        data = (user_id1, user_id2, user_id2, user_id2)
+    # Returns a shortest list of user ids leading from user_id1 to user_id2
+    # through friendships (both included), or None if they are more than
+    # max_hops (default three_degrees_max_hops) friendships apart. The search
+    # runs on the in-memory friend graph, see GraphEngine.FriendGraph.
+    def three_degrees(self, user_id1, user_id2, max_hops = None):
+        if max_hops == None:
+            max_hops = self.three_degrees_max_hops
         try:
-			self.cur.execute(SQL,data)
-        except psycopg2.IntegrityError:
+            graph = self.get_friend_graph()
+        except psycopg2.Error:
             return Status.DATABASE_ERROR
-
-        results = self.cur.fetchall()
-        if not results:
-            return False
-            #return Status.REQUEST_NONEXISTENT
-        else:
-            return True
+        return graph.shortest_path(str(user_id1), str(user_id2), max_hops)
 
 	# display the top-k users  who  have  sent  or  received  the  highest  number  of  messages during the last x days
+    # Users are returned in rank order, as User objects with messages_sent and
+    # messages_received set. The counts come from the userActivity counters,
+    # so only the x most recent days of counters are read, plus the
+    # fanoutOnRead group messages of those days, which are counted for the
+    # members who would have received them (see
+    # migrations/006_group_fanout.sql).
     def topUsers(self, k, x):
-        ks = str(k)
-        xs = str(x)+" days"
-        #MESSAGES SENT = messages.fromUserID, MESSAGES RECEIVED = messages.toUserID + messageRecipient.toUserID
-        #FIX - ADD USER DETAILS, e.g. NAME
-        SQL = "WITH a AS (SELECT userID, count(userID) as counts FROM ((SELECT fromUserID as userID, dateSent FROM messages) UNION (SELECT toUserID as userID, dateSent FROM messages)\
-               UNION (SELECT messageRecipient.toUserID as userID, dateSent FROM messages INNER JOIN messageRecipient USING (msgID))) AS db1\
-               WHERE dateSent > CURRENT_DATE-INTERVAL %s\
-               GROUP BY userID\
-               ORDER BY counts DESC\
-               LIMIT %s)\
-               SELECT profile.* FROM a NATURAL JOIN profile;"
-
-        data = (xs, ks)
-        try:
-			self.cur.execute(SQL,data)
-        except psycopg2.IntegrityError:
-            return Status.DATABASE_ERROR
-
-        results = self.cur.fetchall()
-        return User.get_user_objects(self.profile_records_to_dictionaries(results))
+        SQL = "SELECT profile.*, a.sent, a.received FROM\
+                   (SELECT userID, sum(sent) AS sent, sum(received) AS received FROM\
+                        (SELECT userID, sent, received FROM userActivity\
+                         WHERE day >= CURRENT_DATE - CAST(%s AS integer)\
+                         UNION ALL\
+                         SELECT groupMembership.userID, 0, 1 FROM messages\
+                         JOIN groupMembership ON groupMembership.gID = messages.toGroupID AND messages.msgID > groupMembership.joinedAfter\
+                         WHERE messages.fanoutOnRead AND messages.dateSent >= CURRENT_DATE - CAST(%s AS integer)\
+                         AND messages.fromUserID IS DISTINCT FROM groupMembership.userID) AS activity\
+                    GROUP BY userID\
+                    ORDER BY sum(sent + received) DESC, userID\
+                    LIMIT %s) AS a\
+               JOIN profile USING (userID)\
+               ORDER BY a.sent + a.received DESC, userID;"
+
+        data = (int(x), int(x), int(k))
+        with self.cursor(readonly = True) as cur:
+            try:
+                self.execute(cur, "topusers", SQL, data)
+            except psycopg2.IntegrityError:
+                return Status.DATABASE_ERROR
+
+            results = cur.fetchall()
+        users = User.get_user_objects(self.profile_records_to_dictionaries(results))
+        for user, result in zip(users, results):
+            user.messages_sent = result[7]
+            user.messages_received = result[8]
+        return users
 
     def send_group_message_to(self, user_id, group_id, message):
         user_ids = str(user_id)
         group_ids = str(group_id)
         messages = str(message)
 
-        SQL = "INSERT INTO messages(fromUserID, toGroupID, message) SELECT %s as fromUserID, %s as toGroupID, %s as message FROM groupMembership WHERE groupMembership.gID = %s AND groupMembership.userID = %s;"
+        SQL = "INSERT INTO messages(fromUserID, toGroupID, message) SELECT CAST(%s AS varchar) as fromUserID, CAST(%s AS varchar) as toGroupID, CAST(%s AS varchar) as message FROM groupMembership WHERE groupMembership.gID = %s AND groupMembership.userID = %s;"
         data = (user_ids, group_ids, messages, group_ids, user_ids)
 
-        try:
-			self.cur.execute(SQL,data)
-			self.conn.commit()
-        except psycopg2.IntegrityError:
-            self.conn.rollback()
-            #return Status.DATABASE_ERROR
-            return False
+        with self.cursor() as cur:
+            try:
+                self.execute(cur, "send_group_message_to", SQL, data)
+                cur.connection.commit()
+            except psycopg2.IntegrityError:
+                cur.connection.rollback()
+                #return Status.DATABASE_ERROR
+                return False
 
-        results = self.cur.rowcount
+            results = cur.rowcount
         return results
         #return Status.INSERT_SUCCESS
 
 	#when a user selects this option, all contents of his/her messages should be returned
-    def display_messages(self, userID):
-        userIDs = str(userID)
-        SQL = "SELECT * FROM messages WHERE messages.fromUserID = %s OR messages.toUserID = %s OR\
-         messages.msgID IN (SELECT msgID FROM messageRecipient WHERE toUserID = %s)\
-         ORDER BY dateSent DESC;"
-        data = (userID, userID, userID)
-        try:
-			self.cur.execute(SQL,data)
-        except psycopg2.IntegrityError:
-            return Status.DATABASE_ERROR
-
-        results = self.cur.fetchall()
-        return self.message_records_to_dictionaries(results)
+    # Messages are returned newest first. To fetch them a page at a time, pass
+    # limit, and pass before = (dateSent, msgID) of the last message of the
+    # previous page to get the next one.
+    def display_messages(self, userID, before = None, limit = None):
+        return self.fetch_message_page("display_messages", userID, "", (), before, limit)
 
 	#same as display_messages, but only the messages since last login should be displayed
-    def display_new_messages(self, userID):
-        userIDs = str(userID)
-        SQL = "SELECT * FROM messages WHERE (messages.fromUserID = %s OR messages.toUserID = %s OR messages.msgID\
-               IN (SELECT msgID FROM messageRecipient WHERE toUserID = %s)) \
-               AND messages.dateSent > (SELECT lastlogin FROM profile WHERE userID = %s)\
-               ORDER BY dateSent DESC;"
-
-        data = (userID, userID, userID, userID)
-        try:
-			self.cur.execute(SQL,data)
-        except psycopg2.IntegrityError:
-            return Status.DATABASE_ERROR
-
-        results = self.cur.fetchall()
+    def display_new_messages(self, userID, before = None, limit = None):
+        condition = " AND {0}.dateSent > (SELECT lastlogin FROM profile WHERE userID = %s)"
+        return self.fetch_message_page("display_new_messages", userID, condition, (userID,), before, limit)
+
+    # Returns a page of userID's mailbox, newest first, keeping only the
+    # messages that satisfy condition, an SQL condition on {0}.dateSent
+    # (with data as its parameters). The mailbox is the user's rows in
+    # mailbox, together with the fanoutOnRead messages of the groups they are
+    # in (see migrations/006_group_fanout.sql). Both are read in the order of
+    # an index, mailbox_user_date and messages_group_fanout, each group's
+    # messages being read only as far as the page needs.
+    def fetch_message_page(self, name, userID, condition, data, before, limit):
+        if before != None:
+            name += "_before"
+            condition += " AND ({0}.dateSent, {0}.msgID) < (%s, %s)"
+            data += tuple(before)
+        SQL = "(SELECT messages.* FROM mailbox JOIN messages ON messages.msgID = mailbox.msgID WHERE mailbox.userID = %s"\
+              + condition.format("mailbox") + " ORDER BY mailbox.dateSent DESC, mailbox.msgID DESC LIMIT %s)\
+               UNION ALL\
+               (SELECT m.* FROM groupMembership CROSS JOIN LATERAL\
+                    (SELECT messages.* FROM messages\
+                     WHERE messages.toGroupID = groupMembership.gID AND messages.fanoutOnRead\
+                     AND messages.msgID > groupMembership.joinedAfter AND messages.fromUserID IS DISTINCT FROM groupMembership.userID"\
+              + condition.format("messages") + " ORDER BY messages.dateSent DESC, messages.msgID DESC LIMIT %s) AS m\
+                WHERE groupMembership.userID = %s)\
+               ORDER BY dateSent DESC, msgID DESC LIMIT %s;"
+        data = (userID,) + data + (limit,) + data + (limit, userID, limit)
+        with self.cursor(readonly = True) as cur:
+            try:
+                self.execute(cur, name, SQL, data)
+            except psycopg2.IntegrityError:
+                return Status.DATABASE_ERROR
+
+            results = cur.fetchall()
         return self.message_records_to_dictionaries(results)
 
     def drop_user(self, user_id):
@@ -694,17 +1232,54 @@ class DatabaseHelper:
         SQL = "DELETE FROM profile WHERE userID = %s;"
         data = (user_ids,)
 
-        try:
-			self.cur.execute(SQL,data)
-			self.conn.commit()
-        except psycopg2.IntegrityError:
-            self.conn.rollback()
-            #return Status.DATABASE_ERROR
-            return False
-
-        results = self.cur.rowcount
+        with self.cursor() as cur:
+            try:
+                self.execute(cur, "drop_user", SQL, data)
+                cur.connection.commit()
+            except psycopg2.IntegrityError:
+                cur.connection.rollback()
+                #return Status.DATABASE_ERROR
+                return False
+
+            results = cur.rowcount
+        if results:
+            self.friend_graph.remove_user(user_ids)
         return results
 
+    # Deletes every profile in user_ids in one statement, so that messages
+    # left without owners are purged once rather than once per user. Returns
+    # the number of profiles deleted, or False if the deletion failed.
+    def drop_users(self, user_ids):
+        SQL = "DELETE FROM profile WHERE userID = ANY(CAST(%s AS varchar[])) RETURNING userID;"
+        data = ([str(user_id) for user_id in user_ids],)
+
+        with self.cursor() as cur:
+            try:
+                self.execute(cur, "drop_users", SQL, data)
+                results = cur.fetchall()
+                cur.connection.commit()
+            except psycopg2.IntegrityError:
+                cur.connection.rollback()
+                return False
+        for (user_id,) in results:
+            self.friend_graph.remove_user(user_id)
+        return len(results)
+
+    # Deletes messages with no sender or recipients left, batch_size at a
+    # time, each batch in its own transaction. Only needed after deletions
+    # made with the delete_messages triggers disabled, e.g. during bulk
+    # maintenance. Returns the number of messages deleted.
+    def purge_orphan_messages(self, batch_size = 1000):
+        purged = 0
+        while True:
+            with self.cursor() as cur:
+                self.execute(cur, "purge_orphan_messages", "SELECT purge_orphan_messages(CAST(%s AS integer));", (batch_size,))
+                count = cur.fetchone()[0]
+                cur.connection.commit()
+            purged += count
+            if count < batch_size:
+                return purged
+
     def logout(self):
         return
 
@@ -743,12 +1318,13 @@ class Request:
         return lst
 
 class Message:
-    def __init__(self, sender_id, recipient_id, group_id, message, date):
+    def __init__(self, sender_id, recipient_id, group_id, message, date, message_id = None):
         self.sender_id = sender_id
         self.recipient_id = recipient_id
         self.group_id = group_id
         self.message = message
         self.date = date
+        self.message_id = message_id
 
     # Given a list of dictionaries of join messages,
     # returns a list of Message objects with the relevant attributes set.
@@ -758,11 +1334,67 @@ class Message:
         if not messages:
             return lst
         for message in messages:
-            lst.append(Message(message["fromUserID"], message["toUserID"], message["toGroupID"], message["message"], message["dateSent"]))
+            lst.append(Message(message["fromUserID"], message["toUserID"], message["toGroupID"], message["message"], message["dateSent"],
+                               message_id = message["msgID"]))
         return lst
 
+# Loads the results of a user search lazily, best matches first, one page at
+# a time.
+class UserSearch:
+    def __init__(self, keyword, page_size = 25):
+        self.keyword = keyword
+        self.page_size = page_size
+        self.last_key = None # "search_after" of the last result loaded
+        self.exhausted = False
+        self.db_helper = DatabaseHelper.get_instance()
+
+    # Returns the next page of User objects, or an empty list once every
+    # result has been loaded.
+    def next_page(self):
+        if self.exhausted:
+            return []
+        profiles = self.db_helper.search_for_user(self.keyword, after = self.last_key, limit = self.page_size)
+        if not profiles:
+            profiles = []
+        if len(profiles) < self.page_size:
+            self.exhausted = True
+        if profiles:
+            self.last_key = profiles[-1]["search_after"]
+        return User.get_user_objects(profiles)
+
+# Loads a user's messages lazily, newest first, one page at a time, so that
+# only the messages actually scrolled to are ever fetched.
+class MessageFeed:
+    def __init__(self, user_id, new_only = False, page_size = 50):
+        self.user_id = user_id
+        self.new_only = new_only
+        self.page_size = page_size
+        self.last_key = None # (dateSent, msgID) of the last message loaded
+        self.exhausted = False
+        self.db_helper = DatabaseHelper.get_instance()
+
+    # Returns the next page of Message objects, or an empty list once every
+    # message has been loaded.
+    def next_page(self):
+        if self.exhausted:
+            return []
+        if self.new_only:
+            records = self.db_helper.display_new_messages(self.user_id, before = self.last_key, limit = self.page_size)
+        else:
+            records = self.db_helper.display_messages(self.user_id, before = self.last_key, limit = self.page_size)
+        if records == Status.DATABASE_ERROR:
+            records = []
+        if len(records) < self.page_size:
+            self.exhausted = True
+        if records:
+            self.last_key = (records[-1]["dateSent"], records[-1]["msgID"])
+        return Message.get_message_objects(records)
+
 
 class User:
+    # the user logged in to this session, whose new messages are shown as
+    # they arrive
+    session_user = None
 
     def __init__(self, user_id = '', f_name = '', l_name = '', email = '', dob = '', lastlogin = None):
         self.user_id = user_id
@@ -772,6 +1404,13 @@ class User:
         self.dob = dob
         self.lastlogin = lastlogin
         self.logged_in = False
+        self.messages_sent = None # set by DatabaseHelper.topUsers
+        self.messages_received = None
+        self.unread_messages = [] # Messages received since the user last opened their messages
+        self.message_alerts = [] # Messages received but not shown in a notification yet
+        # on_message_received can be called from a worker thread (through
+        # DatabaseHelper.poll_notifications) while the UI thread reads them
+        self.messages_lock = threading.Lock()
 
         self.db_helper = DatabaseHelper.get_instance()
 
@@ -786,9 +1425,17 @@ class User:
         self.email = result["email"]
         self.lastlogin = result["lastlogin"]
         self.logged_in = True
+        with self.messages_lock:
+            self.unread_messages = []
+            self.message_alerts = []
+        self.db_helper.watch_inbox(self.user_id, self.on_message_received)
+        User.session_user = self
         return Status.LOGIN_SUCCESS
 
     def log_out(self):
+        self.db_helper.unwatch_inbox(self.user_id)
+        if User.session_user is self:
+            User.session_user = None
         ts = time.time()
         lastlogin = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
         self.db_helper.update_last_login(self.user_id, lastlogin)
@@ -843,11 +1490,39 @@ class User:
     def get_pending_group_join_requests(self):
         return Request.get_request_objects(self.db_helper.get_unconfirmed_group_join_requests(self.user_id))
 
-    # Accepts all of the users friend requests. Returns True if successful, false otherwise.
+    # Accepts all of the users friend requests. Returns a dictionary mapping
+    # each requester's user_id to Status.INSERT_SUCCESS or the reason their
+    # request could not be accepted, or None if the database could not be updated.
     def accept_all_friend_requests(self):
-        if not self.db_helper.accept_all_friend_requests(self.user_id) == Status.INSERT_SUCCESS:
-            return False
-        return True
+        outcomes = self.db_helper.accept_all_friend_requests(self.user_id)
+        if outcomes == Status.DATABASE_ERROR:
+            return None
+        return outcomes
+
+    # Deletes all of the users friend requests. Returns a dictionary mapping
+    # each requester's user_id to Status.DELETE_SUCCESS, or None on error.
+    def delete_all_friend_requests(self):
+        outcomes = self.db_helper.delete_all_friend_requests(self.user_id)
+        if outcomes == Status.DATABASE_ERROR:
+            return None
+        return outcomes
+
+    # Accepts the join requests of all groups this user manages, as far as the
+    # groups' limits allow. Returns a dictionary mapping (user_id, group_id) to
+    # Status.INSERT_SUCCESS or Status.GROUP_LIMIT_REACHED, or None on error.
+    def accept_all_group_join_requests(self):
+        outcomes = self.db_helper.accept_all_group_join_requests(self.user_id)
+        if outcomes == Status.DATABASE_ERROR:
+            return None
+        return outcomes
+
+    # Deletes the join requests of all groups this user manages. Returns a
+    # dictionary mapping (user_id, group_id) to Status.DELETE_SUCCESS, or None on error.
+    def delete_all_group_join_requests(self):
+        outcomes = self.db_helper.delete_all_group_join_requests(self.user_id)
+        if outcomes == Status.DATABASE_ERROR:
+            return None
+        return outcomes
 
     # Accepts a friend request from user_id. Returns True if successful, false otherwise.
     def accept_friend_request_from(self, user_id):
@@ -923,6 +1598,33 @@ class User:
     def get_new_messages(self):
         return Message.get_message_objects(self.db_helper.display_new_messages(self.user_id))
 
+    def on_message_received(self, message):
+        message, = Message.get_message_objects([message])
+        with self.messages_lock:
+            self.unread_messages.append(message)
+            self.message_alerts.append(message)
+
+    # Returns the Messages received since the last call, for notifications
+    def take_message_alerts(self):
+        with self.messages_lock:
+            alerts = self.message_alerts
+            self.message_alerts = []
+        return alerts
+
+    def get_unread_count(self):
+        with self.messages_lock:
+            return len(self.unread_messages)
+
+    def mark_messages_read(self):
+        with self.messages_lock:
+            self.unread_messages = []
+            self.message_alerts = []
+
+    # Returns a MessageFeed that loads this user's messages (or only the new
+    # ones) a page at a time.
+    def get_message_feed(self, new_only = False):
+        return MessageFeed(self.user_id, new_only = new_only)
+
     # Given a list of dictionaries of user profiles,
     # returns a list of User objects with the user_id, f_name, l_name, email attributes set.
     @staticmethod
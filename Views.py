@@ -1,17 +1,22 @@
-import os
 import IO
 import string
 import sys
 from abc import ABCMeta, abstractmethod
-from UserContext import User, Status, DatabaseHelper, Request, Message
+from UserContext import User, Status, DatabaseHelper, Request, Message, UserSearch
+from BackgroundTasks import TaskRunner
+from TerminalGeometry import TerminalGeometry
+from Screen import Screen
+import TextLayout
 import time, threading
 from datetime import datetime, date
 import re
+import bisect
 
 # Abstract Class
 # Must implement process_selection
 class Menu(object):
     __metaclass__ = ABCMeta
+    task_runner = None # shared by every menu, see run_in_background
     # user = User object can be None
     # name = title to be displayed at the top of the menu
     # options = list of options to be displayed on the menu
@@ -31,16 +36,22 @@ class Menu(object):
         self.user = user
         self.error_messages = []
         self.notifications = []
+        self.tasks = [] # background tasks started by this menu, see run_in_background
         self.options_title = options_title
         self.pointer = u'\u25b8'
         self.cursor = u'\u258d'
         self.down_arrow = u'\u25bc'
+        self.reset_layout()
         self.last_window = self.get_initial_display_window()
 
 
+    # Adds a line to the frame being displayed, see Screen
+    def emit(self, line):
+        Screen.get_instance().emit(line)
+
     def print_horizontal_bar(self, columns, show = True):
         if show:
-            print('#' * columns)
+            self.emit('#' * columns)
         return 1
 
     def print_centered(self, columns, string, highlight_color = None, show = True):
@@ -48,35 +59,19 @@ class Menu(object):
         remainder = (columns - 2 - len(string))%2
         if highlight_color:
             if show:
-                print('#' + ' ' * n_spaces + highlight_color + string + IO.bcolors.ENDC + ' ' * (n_spaces + remainder) + "#")
+                self.emit('#' + ' ' * n_spaces + highlight_color + string + IO.bcolors.ENDC + ' ' * (n_spaces + remainder) + "#")
         else:
             if show:
-                print('#' + ' ' * n_spaces + string + ' ' * (n_spaces + remainder) + "#")
+                self.emit('#' + ' ' * n_spaces + string + ' ' * (n_spaces + remainder) + "#")
         return 1
 
     def print_with_indent(self, indentation, text, show = True):
-            if (text == ''):
-                return 0
-            if (text[0] == '\n'):
-                text = text[1:]
-            rows, columns = os.popen('stty size', 'r').read().split()
-            columns = int(columns)
-            n_lines_printed = 0
-            text_width = columns - indentation - 2
-            lines = text.split('\n')
-            for line in lines:
-                while True:
-                    line_to_print = '#' + ' ' * (indentation - 1)
-                    line_to_print += line[0:text_width]
-                    n_spaces = columns - len(line_to_print) - 2
-                    line_to_print += (" " * n_spaces) + " #"
-                    if show:
-                        print(line_to_print)
-                    n_lines_printed += 1
-                    line = line[text_width:]
-                    if (line == ''):
-                        break
-            return n_lines_printed
+            columns = TerminalGeometry.get_instance().get_columns()
+            rows = TextLayout.indented_rows(text, indentation, columns)
+            if show:
+                for row in rows:
+                    self.emit(row)
+            return len(rows)
 
 
     def print_multiline(self, columns, field, text, highlighted, bulleted,
@@ -98,35 +93,26 @@ class Menu(object):
 
             if editing:
                 text += self.cursor
+            to_append, rows = TextLayout.wrap(text, indentation, columns)
+            n_lines_printed += 1 + len(rows)
+            if not show:
+                return n_lines_printed
             # print the first line
-            text_width = indentation + 2 # ends with a ' #'
-            #text_width = len(line) + 2 # ends with a ' #'
-            word_start_index = 0
-            current_word_index = 0
-            first_new_line = text.find('\n', 0)
-            space_remaining = max(0, columns - text_width)
-
-            if (first_new_line == -1):
-                first_new_line = space_remaining
-            stop = min(first_new_line, space_remaining)
-            to_append = text[0 : stop]
             line += to_append
             n_spaces = columns - len(line) - 2
             if highlighted:
                 n_spaces += (len(highlight_color) + len(IO.bcolors.ENDC))
             line += ' ' * n_spaces
             line += " #"
-            if show:
-                print(line)
-            n_lines_printed += 1
-            text = text[stop : ]
-            n_lines_printed += self.print_with_indent(indentation, text, show = show)
+            self.emit(line)
+            for row in rows:
+                self.emit(row)
             return n_lines_printed
 
 
     def print_empty_space(self, columns, show = True):
         if show:
-            print('#' + " "*(columns - 2) + '#')
+            self.emit('#' + " "*(columns - 2) + '#')
         return 1
 
     def print_single_line(self, columns, field, text, highlighted, bulleted,
@@ -154,16 +140,13 @@ class Menu(object):
 
             n_spaces = cols_available_for_response - len(text_to_print)
             if show:
-                print(start + text_to_print + ' ' * (n_spaces) + " #")
+                self.emit(start + text_to_print + ' ' * (n_spaces) + " #")
 
             return 1
 
 
     def get_rows_columns(self):
-            rows, columns = os.popen('stty size', 'r').read().split()
-            rows = int(rows)
-            columns = int(columns)
-            return (rows, columns)
+            return TerminalGeometry.get_instance().get_rows_columns()
 
     def display_notification (self, columns, error_message, show = True):
         return self.print_multiline(columns, "NOTIFICATION", error_message, True, False,
@@ -171,11 +154,12 @@ class Menu(object):
 
     def display_notifications(self, columns, show = True):
         n_rows_printed = 0
-        if self.notifications:
+        notifications = self.notifications + ["Loading " + task.description + "..." for task in self.tasks]
+        if notifications:
             n_rows_printed = self.print_empty_space(columns, show = show)
-        for notification in self.notifications:
+        for notification in notifications:
             n_rows_printed += self.display_notification(columns, notification, show = show)
-        if self.notifications:
+        if notifications:
             n_rows_printed += self.print_empty_space(columns, show = show)
             n_rows_printed += self.print_horizontal_bar(columns, show = show)
         return n_rows_printed
@@ -191,6 +175,9 @@ class Menu(object):
         # print username and email address
         #n_rows_printed += self.print_single_line(columns, "Username", user.user_id, False, False, False)
         n_rows_printed += self.print_single_line(columns, "Email", user.email, False, False, False, show = show)
+        if user.messages_sent != None:
+            counts = str(user.messages_sent) + " sent, " + str(user.messages_received) + " received"
+            n_rows_printed += self.print_single_line(columns, "Messages", counts, False, False, False, show = show)
         n_rows_printed += self.print_empty_space(columns, show = show)
         return n_rows_printed
 
@@ -277,19 +264,35 @@ class Menu(object):
             return self.print_centered(columns, self.options_title, show = show)
         return 0
 
-    def get_bottom_range(self, current_option, option_heights, rows_available):
-        range_start = current_option + 1
+    # Returns the window of options ending with current_option that fills
+    # rows_available, or the initial window if it reaches the first option
+    def get_bottom_range(self, columns, current_option, rows_available):
         range_end = current_option + 1
-
-        total_lines = 0
-        while (range_start > 0 and (total_lines + option_heights[range_start - 1] <= rows_available)):
-            total_lines += option_heights[range_start - 1]
+        prefix = self.get_height_prefix(columns, range_end)
+        # every option takes at least a row
+        lowest = max(0, range_end - rows_available)
+        range_start = bisect.bisect_left(prefix, prefix[range_end] - rows_available, lowest, range_end + 1)
+        while range_start < range_end and self.get_rows_between(columns, range_start, range_end) > rows_available:
+            range_start += 1
+        while range_start > 0 and self.get_rows_between(columns, range_start - 1, range_end) <= rows_available:
             range_start -= 1
 
         if range_start == 0:
             return self.get_initial_display_window()
         return (range_start, range_end)
 
+    # Returns the end of the longest window of options starting at range_start
+    # that fits in rows_available
+    def get_top_range_end(self, columns, range_start, rows_available):
+        last = max(range_start, min(len(self.options), range_start + rows_available))
+        prefix = self.get_height_prefix(columns, last)
+        range_end = max(range_start, bisect.bisect_right(prefix, prefix[range_start] + rows_available, range_start, last + 1) - 1)
+        while range_end > range_start and self.get_rows_between(columns, range_start, range_end) > rows_available:
+            range_end -= 1
+        while range_end < last and self.get_rows_between(columns, range_start, range_end + 1) <= rows_available:
+            range_end += 1
+        return range_end
+
 
     def display_all_options_(self, columns, rows_available, show = True):
         current_option = self.current_option
@@ -300,51 +303,88 @@ class Menu(object):
         #print(range_start, range_end)
         if current_option in range(range_start, range_end):
             # check if they still fit
-            option_heights = self.get_option_heights(columns, 0, len(self.options))
-            total_lines = sum(self.get_option_heights(columns, range_start, range_end))
+            total_lines = self.get_rows_between(columns, range_start, range_end)
             if not total_lines <= rows_available:
-                range_start, range_end = self.get_bottom_range(current_option, option_heights, rows_available)
+                range_start, range_end = self.get_bottom_range(columns, current_option, rows_available)
             else: # maybe there's more space
-                while (range_end < len(self.options) and (total_lines + option_heights[range_end] <= rows_available)):
-                    total_lines += option_heights[range_end]
-                    range_end += 1
+                range_end = self.get_top_range_end(columns, range_start, rows_available)
                 #print(1, range_start, range_end)
         else:
             #print(2, current_option, range_start, range_end)
-            option_heights = self.get_option_heights(columns, 0, len(self.options))
-            range_start, range_end = self.get_bottom_range(current_option, option_heights, rows_available)
+            range_start, range_end = self.get_bottom_range(columns, current_option, rows_available)
 
+        # the window reaches the last option loaded so far, load the next ones
+        if range_end == len(self.options) and self.has_more_options():
+            self.last_window = (range_start, range_end)
+            self.load_more_options()
+            return self.display_all_options_(columns, rows_available, show = show)
 
         n_rows_printed = 0
         for i in range(range_start, range_end):
             selected = i == self.current_option
-            option = self.options[i]
-            if (isinstance(option, str)):
-                n_rows_printed += self.display_string_option(columns, option, selected, show = show)
-            elif (isinstance(option, User)):
-                n_rows_printed += self.display_user_instance(columns, option, selected, show = show)
-            elif (isinstance(option, Request)):
-                n_rows_printed += self.display_request_instance(columns, option, selected, show = show)
-            elif (isinstance(option, Message)):
-                n_rows_printed += self.display_message_instance(columns, option, selected, show = show)
+            n_rows_printed += self.display_option(columns, self.options[i], selected, show = show)
 
         self.last_window = (range_start, range_end)
         return n_rows_printed
 
+    def display_option(self, columns, option, selected, show = True):
+        if (isinstance(option, str)):
+            return self.display_string_option(columns, option, selected, show = show)
+        elif (isinstance(option, User)):
+            return self.display_user_instance(columns, option, selected, show = show)
+        elif (isinstance(option, Request)):
+            return self.display_request_instance(columns, option, selected, show = show)
+        elif (isinstance(option, Message)):
+            return self.display_message_instance(columns, option, selected, show = show)
+        return 0
+
+    # Returns the number of rows option i takes, remembered for each option,
+    # width and selection state
+    def get_option_height(self, columns, i, selected):
+        self.check_layout(columns)
+        option = self.options[i]
+        key = (option, columns, selected)
+        height = self.option_heights.get(key)
+        if height == None:
+            height = self.display_option(columns, option, selected, show = False)
+            self.option_heights[key] = height
+        return height
+
     def get_option_heights(self, columns, start, end):
-        option_heights = []
-        for i in range(start, end):
-            selected = i == self.current_option
-            option = self.options[i]
-            if (isinstance(option, str)):
-                option_heights.append(self.display_string_option(columns, option, selected, show = False))
-            elif (isinstance(option, User)):
-                option_heights.append(self.display_user_instance(columns, option, selected, show = False))
-            elif (isinstance(option, Request)):
-                option_heights.append(self.display_request_instance(columns, option, selected, show = False))
-            elif (isinstance(option, Message)):
-                option_heights.append(self.display_message_instance(columns, option, selected, show = False))
-        return option_heights
+        return [self.get_option_height(columns, i, i == self.current_option) for i in range(start, end)]
+
+    # Returns running sums of the heights of the options, unselected, at
+    # least up to option end: prefix[i] is the number of rows options
+    # 0..i - 1 take. They are kept until the width changes or reset_layout
+    # is called.
+    def get_height_prefix(self, columns, end):
+        self.check_layout(columns)
+        prefix = self.height_prefix
+        while len(prefix) <= end:
+            prefix.append(prefix[-1] + self.get_option_height(columns, len(prefix) - 1, False))
+        return prefix
+
+    # Forgets the heights if the width or the list of options has changed
+    def check_layout(self, columns):
+        if columns != self.prefix_columns or self.options is not self.prefix_options:
+            self.reset_layout()
+            self.prefix_columns = columns
+
+    # Call this after adding, removing or replacing options anywhere but at
+    # the end of self.options. It is also called when the width changes.
+    def reset_layout(self):
+        self.option_heights = {} # (option, columns, selected) -> rows, see get_option_height
+        self.height_prefix = [0]
+        self.prefix_columns = None
+        self.prefix_options = self.options
+
+    # Returns the number of rows options start..end - 1 take
+    def get_rows_between(self, columns, start, end):
+        prefix = self.get_height_prefix(columns, end)
+        rows = prefix[end] - prefix[start]
+        if start <= self.current_option < end:
+            rows += self.get_option_height(columns, self.current_option, True) - self.get_option_height(columns, self.current_option, False)
+        return rows
 
 
     def get_initial_display_window(self):
@@ -363,16 +403,8 @@ class Menu(object):
 
         space_for_options = rows - num_rows_printed - lines_after
 
-        # get the number of rows occupied by each option
-        option_heights = []
-        option_heights = self.get_option_heights(columns, 0, len(self.options))
-
         range_start = 0
-        range_end = 0
-        total_lines = 0
-        while (range_end < len(self.options) and (total_lines + option_heights[range_end] <= space_for_options)):
-            total_lines += option_heights[range_end]
-            range_end += 1
+        range_end = self.get_top_range_end(columns, range_start, space_for_options)
         return(range_start, range_end)
 
 
@@ -381,6 +413,7 @@ class Menu(object):
 
     def display(self):
         rows, columns = self.get_rows_columns()
+        Screen.get_instance().begin_frame(rows, columns)
         num_rows_printed = 0
         num_rows_printed += self.print_horizontal_bar(columns)
         num_rows_printed += self.display_screen_title(columns)
@@ -410,6 +443,81 @@ class Menu(object):
         num_rows_printed += n
         #print(num_rows_printed)
         self.fill_empty_space(rows, columns, num_rows_printed)
+        Screen.get_instance().end_frame()
+
+    # Override these two functions to load options lazily. load_more_options
+    # is called when the display window reaches the last option loaded so
+    # far, for as long as has_more_options returns True.
+    def has_more_options(self):
+        return False
+
+    def load_more_options(self):
+        pass
+
+    # Appends options to the end of the menu
+    def append_options(self, options):
+        self.options.extend(options)
+        self.no_options = len(self.options) + 1 if self.dismissable else len(self.options)
+
+    # Runs function(*args) on a worker thread while the menu stays usable,
+    # showing "Loading <description>..." until it finishes. Then, as soon as
+    # this menu is the one on screen, on_done(result) is called on the UI
+    # thread. Results for menus that have been dismissed are dropped.
+    def run_in_background(self, description, function, args = (), on_done = None):
+        if Menu.task_runner == None:
+            Menu.task_runner = TaskRunner(DatabaseHelper.get_settings()["worker_threads"])
+        self.tasks.append(Menu.task_runner.submit(description, function, args, on_done))
+
+    def process_finished_tasks(self):
+        finished = [task for task in self.tasks if task.done]
+        self.tasks = [task for task in self.tasks if not task.done]
+        for task in finished:
+            if task.error != None:
+                self.add_error("Could not finish " + task.description + ": " + str(task.error))
+            elif task.on_done != None:
+                task.on_done(task.result)
+
+    def cancel_tasks(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    # Returns the file descriptors that should interrupt waiting for a key
+    def get_wake_fds(self):
+        fds = []
+        if Menu.task_runner != None:
+            fds.append(Menu.task_runner.fileno())
+        if User.session_user != None:
+            fds += DatabaseHelper.get_instance().get_notification_fds()
+        return fds
+
+    # Handles whatever woke process_key up. Returns True if the menu needs
+    # to be displayed again.
+    def process_notifications(self):
+        if Menu.task_runner != None:
+            Menu.task_runner.clear_wake()
+        redisplay = any(task.done for task in self.tasks)
+        redisplay = TerminalGeometry.get_instance().take_resize() or redisplay
+        if User.session_user == None:
+            return redisplay
+        DatabaseHelper.get_instance().poll_notifications()
+        messages = User.session_user.take_message_alerts()
+        for message in messages:
+            title = "New message from " + str(message.sender_id)
+            if message.group_id:
+                title += " to " + message.group_id
+            self.add_notification(title + ": " + message.message)
+        return redisplay or len(messages) > 0
+
+    # Returns e.g. " (3 unread)" for the logged in user, or '' if there are
+    # no unread messages
+    def get_unread_badge(self):
+        if User.session_user == None:
+            return ''
+        unread = User.session_user.get_unread_count()
+        if unread == 0:
+            return ''
+        return " (" + str(unread) + " unread)"
 
     # Use this to add an errror which will be displayed, e.g.
     # self.add_error("Username does not exist")
@@ -424,31 +532,57 @@ class Menu(object):
     # to display the menu.
     def start(self):
         while not self.dismissed:
+            self.process_finished_tasks()
+            if self.dismissed:
+                break
             self.display()
             self.process_key()
+        self.cancel_tasks()
         self.on_dismiss()
 
     def process_key(self):
         while True:
-            key = IO.get()
-            if key == '\x1b[A' or key == '\x1b[D':
-                #self.current_option = (self.current_option - 1) % self.no_options
-                self.current_option = max(0, self.current_option - 1)
-                break;
-            elif key == '\x05':
-                if (self.options):
-                    self.current_option = max(0, len(self.options) - 1)
-                else:
-                    self.current_option = 0
-                break;
-            elif key == '\x1b[B' or key == '\x1b[C' or key == '\t':
-                #self.current_option = (self.current_option + 1) % self.no_options
-                self.current_option = min(self.no_options - 1, self.current_option + 1)
+            key = IO.get(self.get_wake_fds())
+            if key == None: # woken up by a notification
+                if self.process_notifications():
+                    break
+                continue
+            if self.move(key):
+                # the movement keys already pressed, e.g. while an arrow key
+                # is held down, are all applied before the next display
+                while self.move(IO.peek()):
+                    IO.get()
                 break;
             elif key == '\r':
                 self.process_selection_()
                 break;
 
+    # Moves the current option according to key. Returns False if key is not
+    # a movement key.
+    def move(self, key):
+        start, end = self.last_window
+        page = max(1, end - start)
+        if key == IO.UP or key == IO.LEFT:
+            #self.current_option = (self.current_option - 1) % self.no_options
+            self.current_option = max(0, self.current_option - 1)
+        elif key == IO.DOWN or key == IO.RIGHT or key == '\t':
+            #self.current_option = (self.current_option + 1) % self.no_options
+            self.current_option = min(self.no_options - 1, self.current_option + 1)
+        elif key == IO.PAGE_UP:
+            self.current_option = max(0, self.current_option - page)
+        elif key == IO.PAGE_DOWN:
+            self.current_option = min(self.no_options - 1, self.current_option + page)
+        elif key == IO.HOME:
+            self.current_option = 0
+        elif key == '\x05' or key == IO.END:
+            if (self.options):
+                self.current_option = max(0, len(self.options) - 1)
+            else:
+                self.current_option = 0
+        else:
+            return False
+        return True
+
     def process_selection_(self):
         self.error_messages = []
         self. notifications = []
@@ -513,6 +647,12 @@ class HomeMenu(Menu):
                                           "Log Out",\
                                           "Delete Account"],\
                                           dismissable = False)
+
+    def display(self):
+        self.options[1] = "Messaging" + self.get_unread_badge()
+        self.reset_layout()
+        super(HomeMenu, self).display()
+
     def process_selection(self):
         if (self.current_option == 0):
             friends_menu = FriendsMenu(self.user)
@@ -550,21 +690,34 @@ class AnalyticsMenu(Menu):
             if res == None:
                 return
             user1, user2 = res
-            db_helper = DatabaseHelper.get_instance()
-            db_result = db_helper.three_degrees(user1, user2)
-            self.add_notification("Result: "+str(db_result))
+            self.run_in_background("3Degrees for " + user1 + " and " + user2, self.db_helper.three_degrees,
+                                   (user1, user2), lambda path: self.show_path(user1, user2, path))
             return
         elif self.current_option == 1: #Top-k
             res = SearchForTopKForm().get_responses()
             if res == None:
                 return
             user1, user2 = res
-            db_helper = DatabaseHelper.get_instance()
-            db_result = db_helper.topUsers(user1, user2)
-            UserSearchResultsMenu(db_result).start()
+            self.run_in_background("top " + user1 + " users", self.db_helper.topUsers, (user1, user2),
+                                   self.show_top_users)
 			#self.add_notification("Result: "+str(db_result))
             return
 
+    def show_path(self, user1, user2, path):
+        if path == Status.DATABASE_ERROR:
+            self.add_notification(Status.error_string(path))
+        elif path == None:
+            self.add_notification(user1 + " and " + user2 + " are not within "\
+                                  + str(self.db_helper.three_degrees_max_hops) + " degrees.")
+        else:
+            self.add_notification(str(len(path) - 1) + " degree(s): " + " -> ".join(path))
+
+    def show_top_users(self, users):
+        if users == Status.DATABASE_ERROR:
+            self.add_error(Status.error_string(users))
+            return
+        UserSearchResultsMenu(users).start()
+
 class FriendsMenu(Menu):
     def __init__(self, user):
         super(FriendsMenu, self).__init__(user, "Friends",\
@@ -584,9 +737,9 @@ class FriendsMenu(Menu):
             if res == None:
                 return
             keyword, = res
-            db_helper = DatabaseHelper.get_instance()
-            users_found = User.get_user_objects(db_helper.search_for_user(keyword))
-            UserSearchResultsMenu(users_found).start()
+            search = UserSearch(keyword)
+            self.run_in_background("search for " + keyword, search.next_page,
+                                   on_done = lambda users: UserSearchResultsMenu(users, search = search).start())
             return
         if self.current_option == 1: # sending a friend request
             res = WhichFriendForm(self.user).get_responses()
@@ -650,6 +803,12 @@ class MessagingMenu(Menu):
 										  "Display New Messages",\
 										  "Display Messages"],\
                                           dismissable = True)
+
+    def display(self):
+        self.options[2] = "Display New Messages" + self.get_unread_badge()
+        self.reset_layout()
+        super(MessagingMenu, self).display()
+
     def process_selection(self):
         if self.current_option == 0: # Message a friend
             friends = self.user.get_friends()
@@ -681,18 +840,12 @@ class MessagingMenu(Menu):
                 self.add_notification("Success! Your message to " + groupID + " has been sent.")
             return
         elif self.current_option == 2: # Display New Messages
-            db_helper = DatabaseHelper.get_instance()
-            db_result = db_helper.display_new_messages(self.user.user_id)
-            messages = self.user.get_new_messages()
-            DisplayMessagesMenu(self.user, messages).start()
-			#self.add_notification("Result: "+str(db_result))
+            self.user.mark_messages_read()
+            DisplayMessagesMenu(self.user, self.user.get_message_feed(new_only = True)).start()
             return
         elif self.current_option == 3: # Display All Messages
-            db_helper = DatabaseHelper.get_instance()
-			#db_result = db_helper.display_messages(self.user.user_id)
-            messages = self.user.get_messages()
-            #self.add_notification("Result: "+ str(len(db_result)))
-            DisplayMessagesMenu(self.user, messages).start()
+            self.user.mark_messages_read()
+            DisplayMessagesMenu(self.user, self.user.get_message_feed()).start()
             return
 
 class SelectRecipientMenu(Menu):
@@ -715,8 +868,11 @@ class SelectRecipientMenu(Menu):
             self.last_selection = self.options[self.current_option]
             self.dismissed = True
 
+# search = a UserSearch to load further results from as the user scrolls, or
+# None if users holds every result
 class UserSearchResultsMenu(Menu):
-    def __init__(self, users):
+    def __init__(self, users, search = None):
+        self.search = search
         if users == None or len(users) == 0:
             name = "SEARCH RETURNED NO RESULTS"
             users = []
@@ -724,6 +880,12 @@ class UserSearchResultsMenu(Menu):
             name = "SEARCH RESULTS"
         super(UserSearchResultsMenu, self).__init__(None, name, users)
 
+    def has_more_options(self):
+        return self.search != None and not self.search.exhausted
+
+    def load_more_options(self):
+        self.append_options(self.search.next_page())
+
     def process_selection(self):
         if self.current_option < len(self.options):
             DisplayProfileMenu(self.options[self.current_option]).start()
@@ -751,23 +913,30 @@ class ConfirmRequestsMenu(Menu):
             self.add_error("No more requests to accept.")
             return
         to_delete = []
+        if self.options[0].group_id: # group requests
+            outcomes = self.user.accept_all_group_join_requests()
+        else: # friend requests
+            outcomes = self.user.accept_all_friend_requests()
         for i in range(len(self.options) - 2):
             request = self.options[i]
-            if (request.group_id): # a group request
-                if self.db_helper.check_group_limit_reached(request.group_id):
-                    continue
-                res = self.user.accept_group_join_request_from(request.requester_id, request.group_id)
-            else:
-                res = self.user.accept_friend_request_from(request.requester_id)
-            if res:
+            name = request.requester_f_name + " " + request.requester_l_name
+            outcome = None
+            if outcomes:
+                outcome = outcomes.get((request.requester_id, request.group_id) if request.group_id else request.requester_id)
+            if outcome == Status.INSERT_SUCCESS:
                 to_delete.append(request)
+            elif outcome == Status.GROUP_LIMIT_REACHED:
+                continue
+            elif outcome != None:
+                self.add_error("Could not accept request from " + name + ". " + Status.error_string(outcome))
             else:
-                self.add_error("Could not accept request from " + request.requester_f_name + " " + request.requester_l_name + ".")
+                self.add_error("Could not accept request from " + name + ".")
 
         for req in to_delete:
             self.options.remove(req)
             self.no_options -= 1
             self.current_option %= self.no_options
+        self.reset_layout()
         self.current_option = 0
         self.last_window = self.get_initial_display_window()
         notification = "Accepted all requests"
@@ -791,6 +960,7 @@ class ConfirmRequestsMenu(Menu):
         if res:
             request = self.options.pop(current_option)
             self.no_options -= 1
+            self.reset_layout()
             #self.current_option %= self.no_options
             if self.current_option >= len(self.options):
                 self.current_option -= max(0, self.current_option - 1)
@@ -804,13 +974,14 @@ class ConfirmRequestsMenu(Menu):
             self.add_error("No more requests to delete.")
             return
         to_delete = []
+        if self.options[0].group_id: # group requests
+            outcomes = self.user.delete_all_group_join_requests()
+        else: # friend requests
+            outcomes = self.user.delete_all_friend_requests()
         for i in range(len(self.options) - 2):
             request = self.options[i]
-            if (request.group_id): # a group request
-                res = self.user.delete_group_join_request_from(request.requester_id, request.group_id)
-            else:
-                res = self.user.delete_friend_request_from(request.requester_id)
-            if res:
+            key = (request.requester_id, request.group_id) if request.group_id else request.requester_id
+            if outcomes and outcomes.get(key) == Status.DELETE_SUCCESS:
                 to_delete.append(request)
             else:
                 self.add_error("Could not delete request from " + request.requester_f_name + " " + request.requester_l_name + ".")
@@ -819,6 +990,7 @@ class ConfirmRequestsMenu(Menu):
             self.options.remove(req)
             self.no_options -= 1
             self.current_option %= self.no_options
+        self.reset_layout()
 
         self.current_option = 0
         self.last_window = self.get_initial_display_window()
@@ -882,8 +1054,12 @@ class DisplayProfileMenu(Menu):
         if self.current_option < len(self.options):
             DisplayProfileMenu(self.options[self.current_option]).start()
 
+# Shows the messages of a MessageFeed, loading the next page whenever the
+# user scrolls to the end of the messages loaded so far.
 class DisplayMessagesMenu(Menu):
-    def __init__(self, user, messages):
+    def __init__(self, user, feed):
+        self.feed = feed
+        messages = feed.next_page()
         if not messages:
             name = "NO MESSAGES"
             messages = []
@@ -891,6 +1067,12 @@ class DisplayMessagesMenu(Menu):
             name = "YOUR MESSAGES"
         super(DisplayMessagesMenu, self).__init__(user, name, messages)
 
+    def has_more_options(self):
+        return not self.feed.exhausted
+
+    def load_more_options(self):
+        self.append_options(self.feed.next_page())
+
     def process_selection(self):
         pass
 
@@ -929,27 +1111,11 @@ class Form(object):
 
 
     def print_with_indent(self, indentation, text):
-        if (text == ''):
-            return 0
-        if (text[0] == '\n'):
-            text = text[1:]
-        rows, columns = os.popen('stty size', 'r').read().split()
-        columns = int(columns)
-        n_lines_printed = 0
-        text_width = columns - indentation - 2
-        lines = text.split('\n')
-        for line in lines:
-            while True:
-                line_to_print = '#' + ' ' * (indentation - 1)
-                line_to_print += line[0:text_width]
-                n_spaces = columns - len(line_to_print) - 2
-                line_to_print += (" " * n_spaces) + " #"
-                print(line_to_print)
-                n_lines_printed += 1
-                line = line[text_width:]
-                if (line == ''):
-                    break
-        return n_lines_printed
+        columns = TerminalGeometry.get_instance().get_columns()
+        rows = TextLayout.indented_rows(text, indentation, columns)
+        for row in rows:
+            self.emit(row)
+        return len(rows)
 
 
     def print_multiline(self, columns, field, text, highlighted, bulleted,
@@ -971,28 +1137,19 @@ class Form(object):
 
         if editing:
             text += self.cursor
+        to_append, rows = TextLayout.wrap(text, indentation, columns)
         # print the first line
-        text_width = indentation + 2 # ends with a ' #'
-        #text_width = len(line) + 2 # ends with a ' #'
-        word_start_index = 0
-        current_word_index = 0
-        first_new_line = text.find('\n', 0)
-        space_remaining = max(0, columns - text_width)
-
-        if (first_new_line == -1):
-            first_new_line = space_remaining
-        stop = min(first_new_line, space_remaining)
-        to_append = text[0 : stop]
         line += to_append
         n_spaces = columns - len(line) - 2
         if highlighted:
             n_spaces += (len(highlight_color) + len(IO.bcolors.ENDC))
         line += ' ' * n_spaces
         line += " #"
-        print(line)
+        self.emit(line)
         n_lines_printed += 1
-        text = text[stop : ]
-        n_lines_printed += self.print_with_indent(indentation, text)
+        for row in rows:
+            self.emit(row)
+        n_lines_printed += len(rows)
         return n_lines_printed
 
 
@@ -1019,26 +1176,27 @@ class Form(object):
             text_to_print = text[0: (cols_available_for_response)]
 
         n_spaces = cols_available_for_response - len(text_to_print)
-        print(start + text_to_print + ' ' * (n_spaces) + " #")
+        self.emit(start + text_to_print + ' ' * (n_spaces) + " #")
 
         return 1
 
 
     def get_rows_columns(self):
-        rows, columns = os.popen('stty size', 'r').read().split()
-        rows = int(rows)
-        columns = int(columns)
-        return (rows, columns)
+        return TerminalGeometry.get_instance().get_rows_columns()
 
 
+    # Adds a line to the frame being displayed, see Screen
+    def emit(self, line):
+        Screen.get_instance().emit(line)
+
     def print_horizontal_bar(self, columns):
-        print('#' * columns)
+        self.emit('#' * columns)
         return 1
 
     def print_centered(self, columns, string):
         n_spaces = (columns - 2 - len(string))/2
         remainder = (columns - 2 - len(string))%2
-        print('#' + ' ' * n_spaces + string + ' ' * (n_spaces + remainder) + "#")
+        self.emit('#' + ' ' * n_spaces + string + ' ' * (n_spaces + remainder) + "#")
         return 1
 
     def is_hidden_field(self, index):
@@ -1078,23 +1236,23 @@ class Form(object):
     def display_submit_button(self, columns):
         n_spaces = (columns - 3 - len(self.submit))
         if (self.current_selection == len(self.fields)):
-            print('#' + u'\u25b8' + IO.bcolors.OKGREEN + self.submit + IO.bcolors.ENDC + ' ' * (n_spaces) + "#")
+            self.emit('#' + u'\u25b8' + IO.bcolors.OKGREEN + self.submit + IO.bcolors.ENDC + ' ' * (n_spaces) + "#")
         else:
-            print('#' + ' ' + self.submit + ' ' * (n_spaces) + "#")
+            self.emit('#' + ' ' + self.submit + ' ' * (n_spaces) + "#")
         return 1
 
 
     def display_cancel_option(self, columns):
         n_spaces = (columns - 3 - len(self.cancel))
         if (self.current_selection == len(self.fields) + 1):
-            print('#' + u'\u25b8' + IO.bcolors.FAIL + self.cancel + IO.bcolors.ENDC + ' ' * (n_spaces) + "#")
+            self.emit('#' + u'\u25b8' + IO.bcolors.FAIL + self.cancel + IO.bcolors.ENDC + ' ' * (n_spaces) + "#")
         else:
-            print('#' + ' ' + self.cancel + ' ' * (n_spaces) + "#")
+            self.emit('#' + ' ' + self.cancel + ' ' * (n_spaces) + "#")
         return 1
 
 
     def print_empty_space(self, columns):
-        print('#' + " "*(columns - 2) + '#')
+        self.emit('#' + " "*(columns - 2) + '#')
         return 1
 
 
@@ -1117,6 +1275,7 @@ class Form(object):
 
     def display(self):
         rows, columns = self.get_rows_columns()
+        Screen.get_instance().begin_frame(rows, columns)
         num_rows_printed = 0
         num_rows_printed += self.print_horizontal_bar(columns)
         num_rows_printed += self.print_centered(columns, self.name.upper())
@@ -1126,6 +1285,7 @@ class Form(object):
         num_rows_printed += self.display_cancel_option(columns)
         num_rows_printed += self.display_error_messages(columns)
         num_rows_printed += self.fill_empty_space(rows, columns, num_rows_printed)
+        Screen.get_instance().end_frame()
 
     # Call this function after instantiation of a concrete class
     # to display the form and get user's responses. Will return an array of responses corresponding
@@ -1139,11 +1299,15 @@ class Form(object):
     def process_key(self):
         while True:
             key = IO.get()
-            if key == '\x1b[A' or key == '\x1b[D':
-                self.current_selection = (self.current_selection - 1) % self.no_options
-                break
-            elif key == '\x1b[B' or key == '\x1b[C' or key == '\t':
-                self.current_selection = (self.current_selection + 1) % self.no_options
+            if key == None: # woken up by a resize
+                if TerminalGeometry.get_instance().take_resize():
+                    break
+                continue
+            if self.edit(key):
+                # the keys already pressed, e.g. pasted text or an arrow key
+                # held down, are all applied before the next display
+                while self.edit(IO.peek()):
+                    IO.get()
                 break
             elif key == '\r': # enter
                 if self.is_multiline_field(self.current_selection):
@@ -1156,14 +1320,28 @@ class Form(object):
                     self.submitted = True
                     self.responses = None
                     break
-            elif self.current_selection < len(self.fields):
-                if key == '\x7f': # backspace
-                    str_len = len(self.responses[self.current_selection])
-                    self.responses[self.current_selection] = self.responses[self.current_selection][0 : str_len - 1]
-                    break;
-                elif key in string.printable:
-                    self.responses[self.current_selection] += key
-                    break;
+
+    # Moves the selection, or edits the selected field, according to key.
+    # Returns False if key does neither.
+    def edit(self, key):
+        if key == IO.UP or key == IO.LEFT:
+            self.current_selection = (self.current_selection - 1) % self.no_options
+        elif key == IO.DOWN or key == IO.RIGHT or key == '\t':
+            self.current_selection = (self.current_selection + 1) % self.no_options
+        elif key == IO.HOME or key == IO.PAGE_UP:
+            self.current_selection = 0
+        elif key == IO.END or key == IO.PAGE_DOWN:
+            self.current_selection = len(self.fields) # submit button
+        elif key == None or key == '\r' or self.current_selection >= len(self.fields):
+            return False
+        elif key == '\x7f': # backspace
+            str_len = len(self.responses[self.current_selection])
+            self.responses[self.current_selection] = self.responses[self.current_selection][0 : str_len - 1]
+        elif len(key) == 1 and key in string.printable:
+            self.responses[self.current_selection] += key
+        else:
+            return False
+        return True
 
     def process_submission_(self):
         self.error_messages = []
@@ -1451,6 +1629,9 @@ class SearchForTopKForm(Form):
             if self.responses[i] == '':
                 self.add_error("'" + field + "' cannot be empty.")
                 return False
+            if not self.responses[i].isdigit():
+                self.add_error("'" + field + "' must be a whole number.")
+                return False
         return True
 
 class MessageGroupForm(Form):
@@ -0,0 +1,445 @@
+import argparse
+import datetime
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import time
+import timeit
+import psycopg2
+from UserContext import DatabaseHelper, Status
+
+# Dataset sizes. friendships, pending_requests and messages are totals;
+# groups get between min_group_size and max_group_size members.
+TIERS = {"10k": {"users": 10000, "friendships": 50000, "pending_requests": 10000,
+                 "groups": 500, "min_group_size": 5, "max_group_size": 50, "messages": 200000},
+         "100k": {"users": 100000, "friendships": 500000, "pending_requests": 100000,
+                  "groups": 5000, "min_group_size": 5, "max_group_size": 100, "messages": 2000000},
+         "1m": {"users": 1000000, "friendships": 5000000, "pending_requests": 1000000,
+                "groups": 50000, "min_group_size": 5, "max_group_size": 200, "messages": 20000000},
+         "10m": {"users": 10000000, "friendships": 50000000, "pending_requests": 10000000,
+                 "groups": 500000, "min_group_size": 5, "max_group_size": 200, "messages": 200000000}}
+
+# Tables whose user triggers are disabled while loading. Their derived data
+# (message recipients, mailbox, activity counters, group member counts) is
+# filled in directly.
+LOAD_TABLES = ["profile", "friends", "pendingFriends", "groups", "groupMembership",
+               "pendingGroupMembers", "messages", "messageRecipient", "mailbox"]
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks")
+
+
+def read_words(file_name):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name)) as word_file:
+        return [line.strip() for line in word_file if line.strip()]
+
+
+# Builds a tier's dataset inside the database with generate_series, seeded
+# with setseed() so that the same tier and seed always give the same data.
+# Triggers are disabled while loading: checking every row one at a time (and
+# NOTIFYing every change) would take longer than the benchmark itself.
+def load_dataset(conn, tier, seed):
+    sizes = TIERS[tier]
+    cur = conn.cursor()
+    first_names = read_words("first_names.txt")
+    last_names = read_words("last_names.txt")
+    words = read_words("adjectives.txt") + read_words("nouns.txt")
+    lorem = " ".join(read_words("lorem_ipsum.txt"))
+
+    def step(description, SQL, data = None):
+        start = time.time()
+        cur.execute(SQL, data)
+        print("  " + description + ": " + str(max(cur.rowcount, 0)) + " rows, " + str(round(time.time() - start, 1)) + "s")
+        sys.stdout.flush()
+
+    print("Loading tier " + tier + " with seed " + str(seed))
+    for table in LOAD_TABLES:
+        cur.execute("ALTER TABLE " + table + " DISABLE TRIGGER USER;")
+    try:
+        step("truncate", "TRUNCATE profile, groups, userActivity RESTART IDENTITY CASCADE;")
+        # random() is deterministic after setseed() within this session
+        cur.execute("SELECT setseed(%s);", (seed / float(2 ** 31),))
+        step("profile",
+             "INSERT INTO profile (userID, fname, lname, email, password, DOB, lastlogin)\
+              SELECT i::text, f[1 + floor(random() * array_length(f, 1))::int], l[1 + floor(random() * array_length(l, 1))::int],\
+                     'u' || i || '@nyu.edu', 'password', date '1990-01-01' + floor(random() * 4500)::int,\
+                     now() - random() * interval '60 days'\
+              FROM generate_series(1, %s) AS i, CAST(%s AS text[]) AS f, CAST(%s AS text[]) AS l;",
+             (sizes["users"], first_names, last_names))
+        # userID1 < userID2 (as integers), so no pair appears in both directions
+        step("friends",
+             "INSERT INTO friends (userID1, userID2, friendshipDate)\
+              SELECT LEAST(a, b)::text, GREATEST(a, b)::text, CURRENT_DATE - floor(random() * 1000)::int\
+              FROM (SELECT 1 + floor(random() * %s)::int AS a, 1 + floor(random() * %s)::int AS b\
+                    FROM generate_series(1, %s)) AS pairs\
+              WHERE a <> b ON CONFLICT DO NOTHING;",
+             (sizes["users"], sizes["users"], sizes["friendships"]))
+        step("pendingFriends",
+             "INSERT INTO pendingFriends (userID1, userID2)\
+              SELECT LEAST(a, b)::text, GREATEST(a, b)::text\
+              FROM (SELECT 1 + floor(random() * %s)::int AS a, 1 + floor(random() * %s)::int AS b\
+                    FROM generate_series(1, %s)) AS pairs\
+              WHERE a <> b AND NOT EXISTS (SELECT 1 FROM friends WHERE userID1 = LEAST(a, b)::text AND userID2 = GREATEST(a, b)::text)\
+              ON CONFLICT DO NOTHING;",
+             (sizes["users"], sizes["users"], sizes["pending_requests"]))
+        step("groups",
+             "INSERT INTO groups (gID, name, lmt, description)\
+              SELECT i::text, w1 || '-' || w2, %s + floor(random() * (%s - %s + 1))::int, w1 || ' ' || w2 || '.'\
+              FROM (SELECT i, w[1 + floor(random() * array_length(w, 1))::int] AS w1, w[1 + floor(random() * array_length(w, 1))::int] AS w2\
+                    FROM generate_series(1, %s) AS i, CAST(%s AS text[]) AS w) AS names;",
+             (sizes["min_group_size"] + 2, sizes["max_group_size"], sizes["min_group_size"] + 2, sizes["groups"], words))
+        # the first member of each group is its manager; two places are left
+        # free for join requests
+        step("groupMembership",
+             "INSERT INTO groupMembership (gID, userID, role)\
+              SELECT gID, (1 + floor(random() * %s)::int)::text, CASE WHEN k = 1 THEN 'manager' ELSE 'member' END\
+              FROM groups CROSS JOIN LATERAL generate_series(1, lmt - 2) AS k\
+              ORDER BY gID, k ON CONFLICT DO NOTHING;",
+             (sizes["users"],))
+        step("pendingGroupMembers",
+             "INSERT INTO pendingGroupMembers (gID, userID, message)\
+              SELECT gID, (1 + floor(random() * %s)::int)::text, 'Please let me in!'\
+              FROM groups CROSS JOIN generate_series(1, 2)\
+              ORDER BY gID ON CONFLICT DO NOTHING;",
+             (sizes["users"],))
+        step("pendingGroupMembers (drop members)",
+             "DELETE FROM pendingGroupMembers p USING groupMembership m WHERE m.gID = p.gID AND m.userID = p.userID;")
+        # two thirds direct messages, one third group messages
+        step("messages",
+             "INSERT INTO messages (fromUserID, toUserID, toGroupID, message, dateSent)\
+              SELECT sender::text, CASE WHEN kind < 2 THEN recipient::text END, CASE WHEN kind = 2 THEN grp::text END,\
+                     substr(%s, 1 + floor(random() * 1000)::int, 1 + floor(random() * 199)::int),\
+                     now() - random() * interval '365 days'\
+              FROM (SELECT 1 + floor(random() * %s)::int AS sender, 1 + floor(random() * (%s - 1))::int AS offset_,\
+                           floor(random() * 3)::int AS kind, 1 + floor(random() * %s)::int AS grp\
+                    FROM generate_series(1, %s)) AS m,\
+                   LATERAL (SELECT 1 + (sender - 1 + offset_) %% %s AS recipient) AS r;",
+             (lorem, sizes["users"], sizes["users"], sizes["groups"], sizes["messages"], sizes["users"]))
+        step("messageRecipient (direct)",
+             "INSERT INTO messageRecipient (msgID, toUserID) SELECT msgID, toUserID FROM messages WHERE toUserID IS NOT NULL;")
+        step("messageRecipient (groups)",
+             "INSERT INTO messageRecipient (msgID, toUserID)\
+              SELECT msgID, groupMembership.userID FROM messages JOIN groupMembership ON groupMembership.gID = messages.toGroupID;")
+        step("mailbox", "SELECT backfill_mailbox();")
+        step("userActivity", "SELECT backfill_user_activity();")
+        step("group member counts", "SELECT backfill_group_member_count();")
+    finally:
+        # a failed step leaves the transaction aborted, and the triggers must
+        # be enabled again in a new one
+        conn.rollback()
+        for table in LOAD_TABLES:
+            cur.execute("ALTER TABLE " + table + " ENABLE TRIGGER USER;")
+    conn.commit()
+    conn.autocommit = True
+    step("analyze", "ANALYZE;")
+    conn.autocommit = False
+    cur.close()
+
+
+# A benchmarked call. setup(rng) returns the arguments for run, untimed;
+# cleanup(arguments) undoes what run changed, untimed, so that repeated
+# runs (and later benchmarks) see the same data.
+class Case(object):
+    def __init__(self, name, setup, run, cleanup = None):
+        self.name = name
+        self.setup = setup
+        self.run = run
+        self.cleanup = cleanup
+
+
+class Suite(object):
+
+    def __init__(self, db_helper, conn, sizes, seed):
+        self.db = db_helper
+        self.conn = conn
+        self.sizes = sizes
+        self.rng = random.Random(seed)
+        self.sample_data()
+
+    # Picks users, friend pairs, groups and search keywords to run the cases
+    # with, deterministically for a given seed and dataset.
+    def sample_data(self):
+        cur = self.conn.cursor()
+        self.users = [str(self.rng.randint(1, self.sizes["users"])) for i in range(1000)]
+        cur.execute("SELECT userID1, userID2 FROM friends WHERE userID1 = ANY(%s) ORDER BY 1, 2;", (self.users,))
+        self.friend_pairs = cur.fetchall() or [(self.users[0], self.users[1])]
+        cur.execute("SELECT userID, gID, role FROM groupMembership WHERE gID = ANY(%s) ORDER BY 2, 1;",
+                    ([str(self.rng.randint(1, self.sizes["groups"])) for i in range(200)],))
+        self.memberships = cur.fetchall()
+        cur.execute("SELECT fname, lname FROM profile WHERE userID = ANY(%s) ORDER BY userID;", (self.users[:50],))
+        names = cur.fetchall()
+        self.keywords = [name[0][:2] for name in names] + [name[1][:4] for name in names] + [name[0][1:4] for name in names]
+        self.conn.commit()
+        cur.close()
+
+    def user(self):
+        return self.rng.choice(self.users)
+
+    def two_users(self):
+        user1 = self.user()
+        user2 = self.user()
+        while user2 == user1:
+            user2 = self.user()
+        return (user1, user2)
+
+    def sql(self, SQL, data = None):
+        cur = self.conn.cursor()
+        cur.execute(SQL, data)
+        self.conn.commit()
+        cur.close()
+
+    # Creates a user that only the benchmark uses ("bench" + name), untimed,
+    # so that writes never run into the generated data's friendships and
+    # requests. remove_bench_users() deletes them and, by cascade, whatever
+    # the write benchmarks added for them.
+    def bench_user(self, name):
+        user_id = "bench" + str(name)
+        self.sql("INSERT INTO profile VALUES (%s, 'Bench', 'Mark', %s, 'password', '2000-01-01', now()) ON CONFLICT DO NOTHING;",
+                 (user_id, user_id + "@nyu.edu"))
+        return user_id
+
+    def bench_request(self, requester, user_id):
+        self.sql("INSERT INTO pendingFriends (userID1, userID2) VALUES (%s, %s);", (requester, user_id))
+
+    # Creates the benchmark's group, managed by a benchmark user, untimed.
+    # Returns (manager, group).
+    def bench_group(self):
+        manager = self.bench_user("manager")
+        self.sql("INSERT INTO groups (gID, name, lmt, description) VALUES ('benchgroup', 'Bench group', 10, 'Benchmarking.')\
+                  ON CONFLICT DO NOTHING;")
+        self.sql("INSERT INTO groupMembership (gID, userID, role) VALUES ('benchgroup', %s, 'manager') ON CONFLICT DO NOTHING;",
+                 (manager,))
+        return (manager, "benchgroup")
+
+    def bench_join_request(self, user_id, group_id):
+        self.sql("INSERT INTO pendingGroupMembers (gID, userID, message) VALUES (%s, %s, 'Let me in!');", (group_id, user_id))
+
+    def remove_bench_users(self):
+        self.sql("DELETE FROM groups WHERE gID = 'benchgroup';")
+        self.sql("DELETE FROM profile WHERE userID LIKE 'bench%';")
+
+    def delete_last_message_from(self, user_id):
+        self.sql("DELETE FROM messages WHERE msgID = (SELECT max(msgID) FROM messages WHERE fromUserID = %s);", (user_id,))
+
+    def setup_create_friendship(self, rng):
+        requester = self.bench_user("requester")
+        user_id = self.user()
+        self.bench_request(requester, user_id)
+        return (requester, user_id)
+
+    def setup_accept_all(self, rng):
+        user_id = self.bench_user("recipient")
+        for n in range(5):
+            self.bench_request(self.bench_user(n), user_id)
+        return (user_id,)
+
+    def setup_join_request(self, rng):
+        manager, group_id = self.bench_group()
+        user_id = self.bench_user("joiner")
+        self.bench_join_request(user_id, group_id)
+        return (user_id, group_id)
+
+    def setup_accept_all_group(self, rng):
+        manager, group_id = self.bench_group()
+        for n in range(5):
+            self.bench_join_request(self.bench_user(n), group_id)
+        return (manager,)
+
+    def setup_group_member(self, rng):
+        manager, group_id = self.bench_group()
+        user_id = self.bench_user("member")
+        self.sql("INSERT INTO groupMembership (gID, userID, role) VALUES (%s, %s, 'member');", (group_id, user_id))
+        return (user_id, group_id)
+
+    def cases(self):
+        db = self.db
+        cleanup = lambda args: self.remove_bench_users()
+        membership = lambda rng: rng.choice(self.memberships)
+        managers = [m for m in self.memberships if m[2] == "manager"] or self.memberships
+        return [
+            Case("check_username_exists", lambda rng: (self.user(),), db.check_username_exists),
+            Case("check_email_exists", lambda rng: ("u" + self.user() + "@nyu.edu",), db.check_email_exists),
+            Case("check_passwords_match", lambda rng: (self.user(), "password"), db.check_passwords_match),
+            Case("check_friendship_exists", lambda rng: rng.choice(self.friend_pairs), db.check_friendship_exists),
+            Case("get_all_friends", lambda rng: (self.user(),), db.get_all_friends),
+            Case("get_names_from_user_id", lambda rng: (self.user(),), db.get_names_from_user_id),
+            Case("get_group_name_from_group_id", lambda rng: (membership(rng)[1],), db.get_group_name_from_group_id),
+            Case("check_has_pending_friend_request_from", lambda rng: self.two_users(), db.check_has_pending_friend_request_from),
+            Case("check_is_group_manager", lambda rng: membership(rng)[:2], db.check_is_group_manager),
+            Case("check_is_group_member_or_manager", lambda rng: membership(rng)[:2], db.check_is_group_member_or_manager),
+            Case("check_is_group_member", self.setup_group_member, db.check_is_group_member, cleanup),
+            Case("check_has_pending_join_request_from", lambda rng: tuple(reversed(self.setup_join_request(rng))),
+                 db.check_has_pending_join_request_from, cleanup),
+            Case("get_friend_profiles", lambda rng: (rng.sample(self.users, 20),), db.get_friend_profiles),
+            Case("get_group_limit", lambda rng: (membership(rng)[1],), db.get_group_limit),
+            Case("get_group_member_count", lambda rng: (membership(rng)[1],), db.get_group_member_count),
+            Case("check_group_limit_reached", lambda rng: (membership(rng)[1],), db.check_group_limit_reached),
+            Case("search_for_user", lambda rng: (rng.choice(self.keywords), None, 25), db.search_for_user),
+            Case("get_unconfirmed_friend_requests", lambda rng: (self.user(),), db.get_unconfirmed_friend_requests),
+            Case("get_unconfirmed_group_join_requests", lambda rng: (rng.choice(managers)[0],), db.get_unconfirmed_group_join_requests),
+            Case("display_messages", lambda rng: (self.user(), None, 50), db.display_messages),
+            Case("display_new_messages", lambda rng: (self.user(), None, 50), db.display_new_messages),
+            Case("three_degrees", lambda rng: self.two_users(), db.three_degrees),
+            Case("topUsers_7_days", lambda rng: (10, 7), db.topUsers),
+            Case("topUsers_30_days", lambda rng: (10, 30), db.topUsers),
+            Case("create_new_user", lambda rng: ("benchnew", "Bench", "Mark", "benchnew@nyu.edu", "password", "2000-01-01"),
+                 db.create_new_user, cleanup),
+            Case("insert_friend_request", lambda rng: (self.bench_user("requester"), self.user(), "Hi!"),
+                 db.insert_friend_request, cleanup),
+            Case("create_friendship", self.setup_create_friendship, db.create_friendship, cleanup),
+            Case("accept_all_friend_requests", self.setup_accept_all, db.accept_all_friend_requests, cleanup),
+            Case("delete_friend_request", self.setup_create_friendship, db.delete_friend_request, cleanup),
+            Case("delete_all_friend_requests", self.setup_accept_all, db.delete_all_friend_requests, cleanup),
+            Case("insert_group_join_request", lambda rng: (self.bench_user("joiner"), self.bench_group()[1], "Let me in!"),
+                 db.insert_group_join_request, cleanup),
+            Case("add_group_member", lambda rng: (self.bench_user("joiner"), self.bench_group()[1]), db.add_group_member, cleanup),
+            Case("delete_group_join_request", self.setup_join_request, db.delete_group_join_request, cleanup),
+            Case("accept_all_group_join_requests", self.setup_accept_all_group, db.accept_all_group_join_requests, cleanup),
+            Case("delete_all_group_join_requests", self.setup_accept_all_group, db.delete_all_group_join_requests, cleanup),
+            Case("insert_message_to_group", lambda rng: self.bench_group() + ("Hello all!",), db.insert_message_to_group,
+                 cleanup),
+            Case("insert_message_to_user", lambda rng: self.two_users() + ("Hello!",), db.insert_message_to_user,
+                 lambda args: self.delete_last_message_from(args[0])),
+            Case("send_group_message_to", lambda rng: membership(rng)[:2] + ("Hello all!",), db.send_group_message_to,
+                 lambda args: self.delete_last_message_from(args[0])),
+            Case("create_group", lambda rng: (self.user(), "benchgroup", "Bench group", 10, "Benchmarking."), db.create_group,
+                 cleanup),
+            Case("update_last_login", lambda rng: (self.user(), datetime.datetime.now()), db.update_last_login),
+            Case("drop_user", lambda rng: (self.bench_user("dropped"),), db.drop_user, cleanup),
+            Case("drop_users_10", lambda rng: ([self.bench_user("dropped" + str(n)) for n in range(10)],), db.drop_users, cleanup),
+        ]
+
+    # Runs every case (or those named in only) iterations times after
+    # warmup untimed runs. Returns a dictionary of latency statistics in
+    # milliseconds per case.
+    def run(self, iterations, warmup, only = None):
+        results = {}
+        for case in self.cases():
+            if only and case.name not in only:
+                continue
+            times = []
+            for i in range(warmup + iterations):
+                args = case.setup(self.rng)
+                start = timeit.default_timer()
+                case.run(*args)
+                elapsed = (timeit.default_timer() - start) * 1000
+                if case.cleanup != None:
+                    case.cleanup(args)
+                if i >= warmup:
+                    times.append(elapsed)
+            results[case.name] = latency_statistics(times)
+            print("  %-40s p50 %9.3f ms   p95 %9.3f ms   p99 %9.3f ms" %
+                  (case.name, results[case.name]["p50"], results[case.name]["p95"], results[case.name]["p99"]))
+            sys.stdout.flush()
+        self.remove_bench_users()
+        return results
+
+
+def percentile(sorted_times, q):
+    return sorted_times[max(0, int(math.ceil(q * len(sorted_times))) - 1)]
+
+
+def latency_statistics(times):
+    times = sorted(times)
+    return {"n": len(times),
+            "mean": sum(times) / float(len(times)),
+            "min": times[0],
+            "p50": percentile(times, 0.50),
+            "p95": percentile(times, 0.95),
+            "p99": percentile(times, 0.99),
+            "max": times[-1]}
+
+
+# Returns (commit, True if the working tree has uncommitted changes)
+def git_revision():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"]).strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"]) != 0
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+
+def save_results(results_dir, report):
+    if not os.path.isdir(results_dir):
+        os.makedirs(results_dir)
+    name = report["tier"] + "-" + report["commit"] + ("-dirty" if report["dirty"] else "") + "-" +\
+           datetime.datetime.fromtimestamp(report["time"]).strftime("%Y%m%d%H%M%S") + ".json"
+    path = os.path.join(results_dir, name)
+    with open(path, "w") as results_file:
+        json.dump(report, results_file, indent = 2, sort_keys = True)
+    return path
+
+
+# Prints the p50/p95/p99 of every case in two result files side by side,
+# with the ratio new / old.
+def compare(old_path, new_path):
+    with open(old_path) as old_file:
+        old = json.load(old_file)
+    with open(new_path) as new_file:
+        new = json.load(new_file)
+    print("old: " + old["commit"] + " (" + old["tier"] + ")   new: " + new["commit"] + " (" + new["tier"] + ")")
+    for name in sorted(set(old["results"].keys()) | set(new["results"].keys())):
+        line = "%-40s" % name
+        for q in ["p50", "p95", "p99"]:
+            if name not in old["results"] or name not in new["results"]:
+                line += "   %s %21s" % (q, "n/a")
+                continue
+            a = old["results"][name][q]
+            b = new["results"][name][q]
+            line += "   %s %8.3f -> %8.3f x%-5.2f" % (q, a, b, b / a if a else float("inf"))
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmarks the DatabaseHelper API on generated datasets.")
+    parser.add_argument("database", nargs = "?")
+    parser.add_argument("user", nargs = "?")
+    parser.add_argument("password", nargs = "?")
+    parser.add_argument("--tier", choices = sorted(TIERS.keys()), default = "10k")
+    parser.add_argument("--seed", type = int, default = 42)
+    parser.add_argument("--iterations", type = int, default = 200)
+    parser.add_argument("--warmup", type = int, default = 10)
+    parser.add_argument("--skip-load", action = "store_true", help = "reuse the dataset already in the database")
+    parser.add_argument("--only", nargs = "*", help = "names of the cases to run")
+    parser.add_argument("--results-dir", default = RESULTS_DIR)
+    parser.add_argument("--compare", nargs = 2, metavar = ("OLD", "NEW"), help = "compare two result files and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if not (args.database and args.user and args.password):
+        parser.error("database, user and password are required")
+
+    DatabaseHelper.configure(database = args.database, user = args.user, password = args.password)
+    conn = psycopg2.connect(**DatabaseHelper.connection_arguments(DatabaseHelper.get_settings()))
+    if not args.skip_load:
+        load_dataset(conn, args.tier, args.seed)
+    cur = conn.cursor()
+    cur.execute("SHOW server_version;")
+    server_version, = cur.fetchone()
+    conn.commit()
+
+    print("Running benchmarks")
+    suite = Suite(DatabaseHelper.get_instance(), conn, TIERS[args.tier], args.seed)
+    results = suite.run(args.iterations, args.warmup, args.only)
+    commit, dirty = git_revision()
+    report = {"tier": args.tier,
+              "sizes": TIERS[args.tier],
+              "seed": args.seed,
+              "iterations": args.iterations,
+              "warmup": args.warmup,
+              "commit": commit,
+              "dirty": dirty,
+              "time": time.time(),
+              "server_version": server_version,
+              "settings": dict((key, value) for key, value in DatabaseHelper.get_settings().items() if key != "password"),
+              "results": results}
+    print("Results saved to " + save_results(args.results_dir, report))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+DROP TABLE IF EXISTS userActivity cascade;
+DROP TABLE IF EXISTS mailbox cascade;
 DROP TABLE IF EXISTS messageRecipient cascade;
 DROP TABLE IF EXISTS messages cascade;
 DROP TABLE IF EXISTS pendingGroupMembers cascade;
@@ -221,3 +223,14 @@ CREATE TRIGGER delete_messages AFTER DELETE ON profile
 
 CREATE TRIGGER delete_messages_groups AFTER DELETE ON groups
 	FOR EACH ROW EXECUTE PROCEDURE delete_messages();
+
+/* schema changes since the first release, also used to upgrade existing databases */
+\ir migrations/001_mailbox.sql
+\ir migrations/002_user_search.sql
+\ir migrations/003_user_activity.sql
+\ir migrations/004_graph_notify.sql
+\ir migrations/005_inbox_notify.sql
+\ir migrations/006_group_fanout.sql
+\ir migrations/007_group_member_count.sql
+\ir migrations/008_user_deletion.sql
+\ir migrations/009_group_join_order.sql
@@ -0,0 +1,69 @@
+/* Per-user mailbox: one row per (user, message, direction), 'S' for messages
+   the user sent and 'R' for messages they received, so that a user's messages
+   can be read newest first with a single index range scan instead of an
+   OR/IN scan over messages. Kept up to date by triggers on messages and
+   messageRecipient.
+   Safe to run on an existing database: psql -f migrations/001_mailbox.sql <DATABASE> */
+
+CREATE TABLE IF NOT EXISTS mailbox (
+	userID varchar(20),
+	msgID integer,
+	direction char(1),
+	dateSent timestamp,
+	PRIMARY KEY (userID, msgID, direction),
+	FOREIGN KEY (userID) REFERENCES profile ON DELETE CASCADE,
+	FOREIGN KEY (msgID) REFERENCES messages ON DELETE CASCADE,
+	CHECK (direction IN ('S', 'R'))
+);
+
+CREATE INDEX IF NOT EXISTS mailbox_user_date ON mailbox (userID, dateSent DESC, msgID DESC);
+CREATE INDEX IF NOT EXISTS mailbox_msg ON mailbox (msgID);
+
+/*sender's copy of a new message*/
+CREATE OR REPLACE FUNCTION mailbox_sent() RETURNS trigger AS $mailbox_sent$
+	BEGIN
+		INSERT INTO mailbox VALUES (NEW.fromUserID, NEW.msgID, 'S', NEW.dateSent);
+		RETURN NULL;
+	END;
+$mailbox_sent$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS mailbox_sent ON messages;
+CREATE TRIGGER mailbox_sent AFTER INSERT ON messages
+	FOR EACH ROW EXECUTE PROCEDURE mailbox_sent();
+
+/*recipient's copy, added alongside each messageRecipient row (see add_msg_recipients).
+  A sender receiving their own group message already has the 'S' row.*/
+CREATE OR REPLACE FUNCTION mailbox_received() RETURNS trigger AS $mailbox_received$
+	DECLARE
+		sender varchar(20);
+		sent timestamp;
+	BEGIN
+		SELECT fromUserID, dateSent INTO sender, sent FROM messages WHERE msgID = NEW.msgID;
+		IF sender IS DISTINCT FROM NEW.toUserID THEN
+			INSERT INTO mailbox VALUES (NEW.toUserID, NEW.msgID, 'R', sent) ON CONFLICT DO NOTHING;
+		END IF;
+		RETURN NULL;
+	END;
+$mailbox_received$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS mailbox_received ON messageRecipient;
+CREATE TRIGGER mailbox_received AFTER INSERT ON messageRecipient
+	FOR EACH ROW EXECUTE PROCEDURE mailbox_received();
+
+/*fills mailbox from existing messages, e.g. after a bulk load with triggers disabled*/
+CREATE OR REPLACE FUNCTION backfill_mailbox() RETURNS void AS $backfill_mailbox$
+	BEGIN
+		INSERT INTO mailbox (userID, msgID, direction, dateSent)
+			SELECT fromUserID, msgID, 'S', dateSent FROM messages WHERE fromUserID IS NOT NULL
+			ON CONFLICT DO NOTHING;
+		INSERT INTO mailbox (userID, msgID, direction, dateSent)
+			SELECT toUserID, msgID, 'R', dateSent FROM messages
+			WHERE toUserID IS NOT NULL AND fromUserID IS DISTINCT FROM toUserID
+			UNION
+			SELECT messageRecipient.toUserID, msgID, 'R', messages.dateSent FROM messageRecipient JOIN messages USING (msgID)
+			WHERE messages.fromUserID IS DISTINCT FROM messageRecipient.toUserID
+			ON CONFLICT DO NOTHING;
+	END;
+$backfill_mailbox$ LANGUAGE plpgsql;
+
+SELECT backfill_mailbox();
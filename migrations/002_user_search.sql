@@ -0,0 +1,16 @@
+/* Indexes for DatabaseHelper.search_for_user. Trigram indexes serve the
+   LIKE '%keyword%' matches, pattern-ops btree indexes the prefix matches
+   used for ranking and for keywords too short to have trigrams.
+   pg_trgm ships with PostgreSQL (contrib) and is trusted from version 13.
+   Safe to run on an existing database: psql -f migrations/002_user_search.sql <DATABASE> */
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS profile_userid_trgm ON profile USING gin (LOWER(userID) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS profile_fname_trgm ON profile USING gin (LOWER(fname) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS profile_lname_trgm ON profile USING gin (LOWER(lname) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS profile_email_trgm ON profile USING gin (LOWER(email) gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS profile_userid_prefix ON profile (LOWER(userID) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS profile_fname_prefix ON profile (LOWER(fname) text_pattern_ops);
+CREATE INDEX IF NOT EXISTS profile_lname_prefix ON profile (LOWER(lname) text_pattern_ops);
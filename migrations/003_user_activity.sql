@@ -0,0 +1,52 @@
+/* Per-user, per-day message counters for DatabaseHelper.topUsers, so that the
+   top users of the last x days are found by summing x days of counters
+   instead of scanning every message. Maintained from the mailbox rows written
+   by the triggers on messages and messageRecipient (see 001_mailbox.sql):
+   each mailbox row carries its user, direction and date, so a deleted message
+   can be taken off the right counter even after the message itself is gone.
+   Safe to run on an existing database: psql -f migrations/003_user_activity.sql <DATABASE> */
+
+CREATE TABLE IF NOT EXISTS userActivity (
+	day date,
+	userID varchar(20),
+	sent integer DEFAULT 0 NOT NULL,
+	received integer DEFAULT 0 NOT NULL,
+	PRIMARY KEY (day, userID),
+	FOREIGN KEY (userID) REFERENCES profile ON DELETE CASCADE
+);
+
+/*count a mailbox row in, or out of, its user's counters for its day*/
+CREATE OR REPLACE FUNCTION count_user_activity() RETURNS trigger AS $count_user_activity$
+	BEGIN
+		IF TG_OP = 'INSERT' THEN
+			INSERT INTO userActivity AS a (day, userID, sent, received)
+				VALUES (CAST(NEW.dateSent AS date), NEW.userID,
+				        CASE WHEN NEW.direction = 'S' THEN 1 ELSE 0 END,
+				        CASE WHEN NEW.direction = 'R' THEN 1 ELSE 0 END)
+				ON CONFLICT (day, userID) DO UPDATE SET sent = a.sent + EXCLUDED.sent,
+				                                        received = a.received + EXCLUDED.received;
+		ELSE
+			UPDATE userActivity SET sent = sent - CASE WHEN OLD.direction = 'S' THEN 1 ELSE 0 END,
+			                        received = received - CASE WHEN OLD.direction = 'R' THEN 1 ELSE 0 END
+				WHERE day = CAST(OLD.dateSent AS date) AND userID = OLD.userID;
+		END IF;
+		RETURN NULL;
+	END;
+$count_user_activity$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS count_user_activity ON mailbox;
+CREATE TRIGGER count_user_activity AFTER INSERT OR DELETE ON mailbox
+	FOR EACH ROW EXECUTE PROCEDURE count_user_activity();
+
+/*rebuilds the counters from mailbox, e.g. after a bulk load with triggers disabled*/
+CREATE OR REPLACE FUNCTION backfill_user_activity() RETURNS void AS $backfill_user_activity$
+	BEGIN
+		DELETE FROM userActivity;
+		INSERT INTO userActivity (day, userID, sent, received)
+			SELECT CAST(dateSent AS date), userID,
+			       count(*) FILTER (WHERE direction = 'S'), count(*) FILTER (WHERE direction = 'R')
+			FROM mailbox GROUP BY 1, 2;
+	END;
+$backfill_user_activity$ LANGUAGE plpgsql;
+
+SELECT backfill_user_activity();
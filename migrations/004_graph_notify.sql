@@ -0,0 +1,48 @@
+/* NOTIFY events for the application's in-memory graph cache (GraphCache.py).
+   Every row change to friends, pendingFriends and profile is sent on the
+   social_graph channel as a JSON payload {"table", "op", "id1", "id2"}; an
+   UPDATE is sent as a DELETE of the old row followed by an INSERT of the new
+   one. Notifications are only delivered when the transaction commits.
+   Safe to run on an existing database: psql -f migrations/004_graph_notify.sql <DATABASE> */
+
+CREATE OR REPLACE FUNCTION notify_graph_change() RETURNS trigger AS $notify_graph_change$
+	BEGIN
+		IF TG_LEVEL = 'STATEMENT' THEN
+			PERFORM pg_notify('social_graph', json_build_object('table', TG_TABLE_NAME, 'op', TG_OP)::text);
+			RETURN NULL;
+		END IF;
+		IF TG_TABLE_NAME = 'profile' THEN
+			PERFORM pg_notify('social_graph', json_build_object('table', TG_TABLE_NAME, 'op', TG_OP, 'id1', OLD.userID)::text);
+			RETURN NULL;
+		END IF;
+		IF TG_OP IN ('DELETE', 'UPDATE') THEN
+			PERFORM pg_notify('social_graph', json_build_object('table', TG_TABLE_NAME, 'op', 'DELETE', 'id1', OLD.userID1, 'id2', OLD.userID2)::text);
+		END IF;
+		IF TG_OP IN ('INSERT', 'UPDATE') THEN
+			PERFORM pg_notify('social_graph', json_build_object('table', TG_TABLE_NAME, 'op', 'INSERT', 'id1', NEW.userID1, 'id2', NEW.userID2)::text);
+		END IF;
+		RETURN NULL;
+	END;
+$notify_graph_change$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS notify_graph_change ON friends;
+CREATE TRIGGER notify_graph_change AFTER INSERT OR UPDATE OR DELETE ON friends
+	FOR EACH ROW EXECUTE PROCEDURE notify_graph_change();
+DROP TRIGGER IF EXISTS notify_graph_truncate ON friends;
+CREATE TRIGGER notify_graph_truncate AFTER TRUNCATE ON friends
+	FOR EACH STATEMENT EXECUTE PROCEDURE notify_graph_change();
+
+DROP TRIGGER IF EXISTS notify_graph_change ON pendingFriends;
+CREATE TRIGGER notify_graph_change AFTER INSERT OR UPDATE OR DELETE ON pendingFriends
+	FOR EACH ROW EXECUTE PROCEDURE notify_graph_change();
+DROP TRIGGER IF EXISTS notify_graph_truncate ON pendingFriends;
+CREATE TRIGGER notify_graph_truncate AFTER TRUNCATE ON pendingFriends
+	FOR EACH STATEMENT EXECUTE PROCEDURE notify_graph_change();
+
+/*profiles are cached too (see GraphCache.get_profiles), but new ones never are*/
+DROP TRIGGER IF EXISTS notify_graph_change ON profile;
+CREATE TRIGGER notify_graph_change AFTER UPDATE OR DELETE ON profile
+	FOR EACH ROW EXECUTE PROCEDURE notify_graph_change();
+DROP TRIGGER IF EXISTS notify_graph_truncate ON profile;
+CREATE TRIGGER notify_graph_truncate AFTER TRUNCATE ON profile
+	FOR EACH STATEMENT EXECUTE PROCEDURE notify_graph_change();
@@ -0,0 +1,26 @@
+/* Pushes every message a user receives to their "inbox:<userID>" channel as
+   it is delivered (each messageRecipient row written by add_msg_recipients),
+   so that a logged in client can show it without querying its mailbox. The
+   payload is the message as JSON, with dateSent in seconds since the epoch.
+   Notifications are only delivered when the transaction commits.
+   Safe to run on an existing database: psql -f migrations/005_inbox_notify.sql <DATABASE> */
+
+CREATE OR REPLACE FUNCTION notify_inbox() RETURNS trigger AS $notify_inbox$
+	DECLARE
+		m messages%ROWTYPE;
+	BEGIN
+		SELECT * INTO m FROM messages WHERE msgID = NEW.msgID;
+		IF m.fromUserID IS DISTINCT FROM NEW.toUserID THEN
+			PERFORM pg_notify('inbox:' || NEW.toUserID,
+			                  json_build_object('msgID', m.msgID, 'fromUserID', m.fromUserID,
+			                                    'toUserID', m.toUserID, 'toGroupID', m.toGroupID,
+			                                    'message', m.message,
+			                                    'dateSent', extract(epoch FROM m.dateSent))::text);
+		END IF;
+		RETURN NULL;
+	END;
+$notify_inbox$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS notify_inbox ON messageRecipient;
+CREATE TRIGGER notify_inbox AFTER INSERT ON messageRecipient
+	FOR EACH ROW EXECUTE PROCEDURE notify_inbox();
@@ -0,0 +1,121 @@
+/* Fan-out-on-read storage for group messages. By default (fan-out on write)
+   add_msg_recipients copies a group message into messageRecipient, and so
+   into mailbox, once per member. With social_club.group_fanout set to 'read'
+   (per database, role or session, e.g. ALTER DATABASE <DATABASE> SET
+   social_club.group_fanout = 'read'), a group message is stored once, marked
+   fanoutOnRead, and a member's mailbox finds it through their membership:
+   it is theirs if it was sent after they joined, i.e. if its msgID is above
+   their joinedAfter. Reads always look at both, so the mode can be changed
+   at any time, and mailbox queries and topUsers give the same results.
+   When a member leaves, or the group is deleted, the messages they would
+   lose are copied into messageRecipient, as fan-out on write would have done.
+   Safe to run on an existing database: psql -f migrations/006_group_fanout.sql <DATABASE> */
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS fanoutOnRead boolean DEFAULT false NOT NULL;
+
+/*the last message sent so far; joining a group is a point in the sequence of messages*/
+CREATE OR REPLACE FUNCTION last_message_id() RETURNS integer AS $last_message_id$
+	SELECT COALESCE(max(msgID), 0) FROM messages;
+$last_message_id$ LANGUAGE sql STABLE;
+
+ALTER TABLE groupMembership ADD COLUMN IF NOT EXISTS joinedAfter integer DEFAULT last_message_id() NOT NULL;
+
+CREATE INDEX IF NOT EXISTS groupMembership_user ON groupMembership (userID);
+CREATE INDEX IF NOT EXISTS messages_group_fanout ON messages (toGroupID, dateSent DESC, msgID DESC) WHERE fanoutOnRead;
+CREATE INDEX IF NOT EXISTS messages_fanout_date ON messages (dateSent) WHERE fanoutOnRead;
+
+/*a message's inbox notification payload (see 005_inbox_notify.sql)*/
+CREATE OR REPLACE FUNCTION inbox_payload(m messages) RETURNS text AS $inbox_payload$
+	SELECT json_build_object('msgID', m.msgID, 'fromUserID', m.fromUserID,
+	                         'toUserID', m.toUserID, 'toGroupID', m.toGroupID,
+	                         'message', m.message,
+	                         'dateSent', extract(epoch FROM m.dateSent))::text;
+$inbox_payload$ LANGUAGE sql STABLE;
+
+/*group messages are stored according to social_club.group_fanout when they are sent*/
+CREATE OR REPLACE FUNCTION message_fanout() RETURNS trigger AS $message_fanout$
+	BEGIN
+		NEW.fanoutOnRead := NEW.toGroupID IS NOT NULL AND current_setting('social_club.group_fanout', true) = 'read';
+		RETURN NEW;
+	END;
+$message_fanout$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS message_fanout ON messages;
+CREATE TRIGGER message_fanout BEFORE INSERT ON messages
+	FOR EACH ROW EXECUTE PROCEDURE message_fanout();
+
+/*as in initialise.sql, but members of the group of a fanoutOnRead message are only notified*/
+CREATE OR REPLACE FUNCTION add_msg_recipients() RETURNS trigger AS $add_msg_recipients$
+	BEGIN
+		IF NEW.fromUserID IS NULL THEN
+			RAISE EXCEPTION 'fromUserID cannot be NULL';
+		END IF;
+		IF NEW.toUserID IS NULL AND NEW.toGroupID IS NULL THEN
+			RAISE EXCEPTION 'toUserID and toGroupID cannot both be NULL, recipient is needed for a message';
+		END IF;
+		IF (NEW.toUserID IS NOT NULL) AND (NEW.toGroupID IS NOT NULL) THEN
+			RAISE EXCEPTION 'either toUserID or toGroupID must be NULL, cannot have multiple recipient types';
+		END IF;
+
+		IF NEW.toUserID IS NOT NULL THEN
+			INSERT INTO messageRecipient VALUES (NEW.msgID, NEW.toUserID);
+		END IF;
+		IF NEW.toGroupID IS NOT NULL AND NEW.fanoutOnRead THEN
+			PERFORM pg_notify('inbox:' || groupMembership.userID, inbox_payload(NEW)) FROM groupMembership
+				WHERE groupMembership.gID = NEW.toGroupID AND groupMembership.userID IS DISTINCT FROM NEW.fromUserID;
+		ELSIF NEW.toGroupID IS NOT NULL THEN
+			INSERT INTO messageRecipient(msgID, toUserID) SELECT NEW.msgID, groupMembership.userID FROM groupMembership WHERE groupMembership.gID = NEW.toGroupID;
+		END IF;
+		RETURN NEW;
+	END;
+$add_msg_recipients$ LANGUAGE plpgsql;
+
+/*as in 005_inbox_notify.sql, but not for the copies made by keep_group_messages*/
+CREATE OR REPLACE FUNCTION notify_inbox() RETURNS trigger AS $notify_inbox$
+	DECLARE
+		m messages%ROWTYPE;
+	BEGIN
+		SELECT * INTO m FROM messages WHERE msgID = NEW.msgID;
+		IF m.fromUserID IS DISTINCT FROM NEW.toUserID AND NOT m.fanoutOnRead THEN
+			PERFORM pg_notify('inbox:' || NEW.toUserID, inbox_payload(m));
+		END IF;
+		RETURN NULL;
+	END;
+$notify_inbox$ LANGUAGE plpgsql;
+
+/*a leaving member keeps the group's messages sent while they were in it
+  (unless their profile is being deleted, taking their messages with it)*/
+CREATE OR REPLACE FUNCTION keep_group_messages() RETURNS trigger AS $keep_group_messages$
+	BEGIN
+		IF EXISTS (SELECT 1 FROM profile WHERE userID = OLD.userID) THEN
+			INSERT INTO messageRecipient (msgID, toUserID)
+				SELECT msgID, OLD.userID FROM messages
+				WHERE toGroupID = OLD.gID AND fanoutOnRead AND msgID > OLD.joinedAfter
+				ON CONFLICT DO NOTHING;
+		END IF;
+		RETURN OLD;
+	END;
+$keep_group_messages$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS keep_group_messages ON groupMembership;
+CREATE TRIGGER keep_group_messages BEFORE DELETE ON groupMembership
+	FOR EACH ROW EXECUTE PROCEDURE keep_group_messages();
+
+/*so do all the members of a group being deleted, whose messages then no
+  longer depend on its membership*/
+CREATE OR REPLACE FUNCTION keep_deleted_group_messages() RETURNS trigger AS $keep_deleted_group_messages$
+	BEGIN
+		INSERT INTO messageRecipient (msgID, toUserID)
+			SELECT messages.msgID, groupMembership.userID FROM messages
+			JOIN groupMembership ON groupMembership.gID = messages.toGroupID AND messages.msgID > groupMembership.joinedAfter
+			JOIN profile ON profile.userID = groupMembership.userID
+			WHERE messages.toGroupID = OLD.gID AND messages.fanoutOnRead
+			ON CONFLICT DO NOTHING;
+		UPDATE messages SET fanoutOnRead = false WHERE toGroupID = OLD.gID AND fanoutOnRead;
+		RETURN OLD;
+	END;
+$keep_deleted_group_messages$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS keep_deleted_group_messages ON groups;
+CREATE TRIGGER keep_deleted_group_messages BEFORE DELETE ON groups
+	FOR EACH ROW EXECUTE PROCEDURE keep_deleted_group_messages();
@@ -0,0 +1,58 @@
+/* Number of members of each group, kept in groups.member_count, so that
+   checking a group's limit reads one row instead of counting its members.
+   group_lmt now maintains the count: it adds a member by incrementing it
+   only while it is below lmt, which locks the group's row until the end of
+   the transaction, so that concurrent inserts into the same group wait for
+   each other and cannot overfill it. It runs after the row is written, so
+   that rows skipped by ON CONFLICT DO NOTHING are not counted.
+   Safe to run on an existing database: psql -f migrations/007_group_member_count.sql <DATABASE> */
+
+ALTER TABLE groups ADD COLUMN IF NOT EXISTS member_count integer DEFAULT 0 NOT NULL;
+
+CREATE OR REPLACE FUNCTION group_lmt() RETURNS trigger AS $group_lmt$
+	BEGIN
+		IF TG_OP = 'UPDATE' AND NEW.gID IS NOT DISTINCT FROM OLD.gID THEN
+			RETURN NULL;
+		END IF;
+		IF TG_OP IN ('UPDATE', 'DELETE') THEN
+			UPDATE groups SET member_count = member_count - 1 WHERE gID = OLD.gID;
+		END IF;
+		IF TG_OP IN ('INSERT', 'UPDATE') THEN
+			UPDATE groups SET member_count = member_count + 1 WHERE gID = NEW.gID AND member_count < lmt;
+			IF NOT FOUND THEN
+				RAISE EXCEPTION 'group limit reached';
+			END IF;
+		END IF;
+		RETURN NULL;
+	END;
+$group_lmt$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS group_lmt ON groupMembership;
+CREATE TRIGGER group_lmt AFTER INSERT OR UPDATE OR DELETE ON groupMembership
+	FOR EACH ROW EXECUTE PROCEDURE group_lmt();
+
+/*number of members in a group should be less than or equal to limit and member should not already be in group*/
+CREATE OR REPLACE FUNCTION pending_group_lmt() RETURNS trigger AS $pending_group_lmt$
+	BEGIN
+		IF (SELECT member_count >= lmt FROM groups WHERE groups.gID = NEW.gID) THEN
+			RAISE EXCEPTION 'group limit reached';
+		END IF;
+		IF EXISTS (SELECT 1 FROM groupMembership WHERE gID = NEW.gID AND userID = NEW.userID) THEN
+			RAISE EXCEPTION 'member already in group';
+		END IF;
+		RETURN NEW;
+	END;
+$pending_group_lmt$ LANGUAGE plpgsql;
+
+/*recounts every group, e.g. after a bulk load with triggers disabled*/
+CREATE OR REPLACE FUNCTION backfill_group_member_count() RETURNS void AS $backfill_group_member_count$
+	BEGIN
+		UPDATE groups SET member_count = counts.members
+			FROM (SELECT groups.gID, count(groupMembership.userID) AS members
+			      FROM groups LEFT JOIN groupMembership ON groupMembership.gID = groups.gID
+			      GROUP BY groups.gID) AS counts
+			WHERE counts.gID = groups.gID AND groups.member_count <> counts.members;
+	END;
+$backfill_group_member_count$ LANGUAGE plpgsql;
+
+SELECT backfill_group_member_count();
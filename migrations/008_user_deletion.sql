@@ -0,0 +1,48 @@
+/* Deleting a profile or a group only touches that user's or group's rows.
+   Every foreign key to profile and groups gets an index on its referencing
+   columns, so that the cascades (and the SET NULLs on messages) are index
+   lookups instead of scans. Messages left without a sender or any recipient
+   are found through a partial index holding just those, and are purged once
+   per DELETE statement rather than once per deleted row, so deleting many
+   users at once (DatabaseHelper.drop_users) purges once.
+   Safe to run on an existing database: psql -f migrations/008_user_deletion.sql <DATABASE> */
+
+CREATE INDEX IF NOT EXISTS messages_from_user ON messages (fromUserID);
+CREATE INDEX IF NOT EXISTS messages_to_user ON messages (toUserID);
+CREATE INDEX IF NOT EXISTS messages_to_group ON messages (toGroupID);
+CREATE INDEX IF NOT EXISTS messages_orphaned ON messages (msgID)
+	WHERE fromUserID IS NULL AND toUserID IS NULL AND toGroupID IS NULL;
+CREATE INDEX IF NOT EXISTS messageRecipient_user ON messageRecipient (toUserID);
+CREATE INDEX IF NOT EXISTS friends_user2 ON friends (userID2);
+CREATE INDEX IF NOT EXISTS pendingFriends_user2 ON pendingFriends (userID2);
+CREATE INDEX IF NOT EXISTS pendingGroupMembers_user ON pendingGroupMembers (userID);
+CREATE INDEX IF NOT EXISTS userActivity_user ON userActivity (userID);
+
+/*delete messages if no owning resources left, once per statement*/
+CREATE OR REPLACE FUNCTION delete_messages() RETURNS trigger AS $delete_messages$
+	BEGIN
+		DELETE FROM messages WHERE messages.toUserID is NULL AND messages.fromUserID is NULL AND messages.toGroupID is NULL;
+		RETURN NULL;
+	END;
+$delete_messages$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS delete_messages ON profile;
+CREATE TRIGGER delete_messages AFTER DELETE ON profile
+	FOR EACH STATEMENT EXECUTE PROCEDURE delete_messages();
+
+DROP TRIGGER IF EXISTS delete_messages_groups ON groups;
+CREATE TRIGGER delete_messages_groups AFTER DELETE ON groups
+	FOR EACH STATEMENT EXECUTE PROCEDURE delete_messages();
+
+/*deletes up to batch_size messages with no owning resources left, e.g. those
+  left by deletions made with triggers disabled; returns how many*/
+CREATE OR REPLACE FUNCTION purge_orphan_messages(batch_size integer) RETURNS integer AS $purge_orphan_messages$
+	DECLARE
+		purged integer;
+	BEGIN
+		DELETE FROM messages WHERE msgID IN
+			(SELECT msgID FROM messages WHERE toUserID IS NULL AND fromUserID IS NULL AND toGroupID IS NULL LIMIT batch_size);
+		GET DIAGNOSTICS purged = ROW_COUNT;
+		RETURN purged;
+	END;
+$purge_orphan_messages$ LANGUAGE plpgsql;
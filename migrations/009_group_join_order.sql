@@ -0,0 +1,41 @@
+/* Orders joining a group and sending messages to it (see 006_group_fanout.sql).
+   A member's joinedAfter was the highest msgID committed when they joined, so
+   a group message sent before, but committed after, the join was shown to
+   them, and one given a lower msgID than a message already committed was
+   not. Now a group message takes a share lock on its group's row, and only
+   then its msgID, and a join takes the row's update lock, and only then its
+   joinedAfter. A join therefore waits for the group's messages in flight to
+   commit, and the group's messages sent meanwhile wait for the join, then
+   get msgIDs above its joinedAfter. group_lmt takes the same lock later in
+   the join's transaction, so joins to a group are not slowed any further.
+   Safe to run on an existing database: psql -f migrations/009_group_join_order.sql <DATABASE> */
+
+/*as in 006_group_fanout.sql, but a group message waits for joins to its group,
+  and is numbered after them*/
+CREATE OR REPLACE FUNCTION message_fanout() RETURNS trigger AS $message_fanout$
+	BEGIN
+		IF NEW.toGroupID IS NOT NULL THEN
+			PERFORM 1 FROM groups WHERE gID = NEW.toGroupID FOR SHARE;
+			NEW.msgID := nextval(pg_get_serial_sequence('messages', 'msgid'));
+		END IF;
+		NEW.fanoutOnRead := NEW.toGroupID IS NOT NULL AND current_setting('social_club.group_fanout', true) = 'read';
+		RETURN NEW;
+	END;
+$message_fanout$ LANGUAGE plpgsql;
+
+/*a member joins after the last message committed once the group's messages in
+  flight have been*/
+CREATE OR REPLACE FUNCTION group_join_order() RETURNS trigger AS $group_join_order$
+	BEGIN
+		IF TG_OP = 'UPDATE' AND NEW.gID IS NOT DISTINCT FROM OLD.gID THEN
+			RETURN NEW;
+		END IF;
+		PERFORM 1 FROM groups WHERE gID = NEW.gID FOR NO KEY UPDATE;
+		NEW.joinedAfter := last_message_id();
+		RETURN NEW;
+	END;
+$group_join_order$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS group_join_order ON groupMembership;
+CREATE TRIGGER group_join_order BEFORE INSERT OR UPDATE OF gID ON groupMembership
+	FOR EACH ROW EXECUTE PROCEDURE group_join_order();
@@ -4,9 +4,13 @@ import random
 import time
 import datetime
 import string
+import argparse
+import multiprocessing
+import hashlib
+from collections import deque
+from cStringIO import StringIO
+import GraphGenerators
 
-if (len(sys.argv) != 4):
-	print("Usage: python populate.py <DATABASE NAME> <USER> <PASSWORD>")
 fname_file = open('first_names.txt', 'r')
 lname_file = open('last_names.txt', 'r')
 noun_file = open('nouns.txt', 'r')
@@ -20,9 +24,8 @@ lname_file.close()
 adjective_file.close()
 noun_file.close()
 
-#conn = psycopg2.connect("dbname=" + sys.argv[1] +" host=127.0.0.1")
-conn = psycopg2.connect("dbname=" + sys.argv[1] + " user=" + sys.argv[2] + " password=" + sys.argv[3] + " host=127.0.0.1")
-cur = conn.cursor()
+conn = None
+cur = None
 
 
 # Inserts random users
@@ -53,23 +56,14 @@ def insertFriendships(n_users, n_friendships):
 	if (n_friendships > n_possible_friendships):
 		return -1
 
-	t = float(n_friendships) / n_possible_friendships
-	count = 0
-	while (count < n_friendships) :
-		for i in range(n_users - 1):
-			for j in range(i + 1, n_users):
-				x = random.uniform(0, 1)
-				if (x <= t):
-					userID1 = str(i + 1)#.zfill(20)
-					userID2 = str(j + 1)#.zfill(20)
-					ts = time.time()
-					friendshipDate = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d')
-					try:
-						cur.execute('INSERT INTO friends(userID1, userID2, friendshipDate) VALUES (%s, %s, %s)', (userID1, userID2, friendshipDate))
-						conn.commit()
-						count += 1;
-					except psycopg2.IntegrityError:
-						conn.rollback()
+	ts = time.time()
+	friendshipDate = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d')
+	for userID1, userID2 in GraphGenerators.uniform(random, n_users, n_friendships):
+		try:
+			cur.execute('INSERT INTO friends(userID1, userID2, friendshipDate) VALUES (%s, %s, %s)', (str(userID1), str(userID2), friendshipDate))
+			conn.commit()
+		except psycopg2.IntegrityError:
+			conn.rollback()
 	return 1
 
 def insertGroups(n_groups, n_users):
@@ -139,7 +133,277 @@ def insertMessages(n_users, n_groups, n_messages):
 			print(e)
 			conn.rollback()
 
-insertUsers(100)
-insertFriendships(100, 300)
-insertGroups(25, 100)
-insertMessages(100, 25, 400)
+
+# Bulk loading: rows are generated in batches, each from its own random
+# generator seeded with (seed, table, batch number), so that the same seed
+# always gives the same data however the batches are spread over worker
+# processes. Each batch is streamed into its table with COPY FROM STDIN in a
+# single transaction.
+# The user triggers on the loaded tables are disabled for the duration of
+# the load. The rows are generated so as to satisfy what those triggers
+# check (one recipient per message, no friendship in both directions, group
+# sizes within the limit), messageRecipient is filled in directly, and the
+# mailbox and userActivity tables and the group member counts are rebuilt at
+# the end. Foreign keys stay enforced.
+BULK_TABLES = ['profile', 'friends', 'groups', 'groupMembership', 'messages', 'messageRecipient', 'mailbox']
+MESSAGE_CHARACTERS = string.ascii_letters + string.digits + ' ' + '\n'
+
+dsn = None
+worker_conn = None
+
+def copy_escape(value):
+	if value == None:
+		return '\\N'
+	return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+# Random number generator for one batch of one table. It is seeded with an
+# integer, as Python 2 seeds with hash() of a string, which varies between
+# runs (PYTHONHASHSEED) and builds.
+def batch_random(seed, table, batch):
+	return random.Random(int(hashlib.md5('%d:%s:%d' % (seed, table, batch)).hexdigest(), 16))
+
+# Dates are generated relative to the start of the current day, so a given
+# seed gives the same data all day long
+def load_day():
+	return time.mktime(datetime.date.today().timetuple())
+
+def batch_ranges(n, batch_size):
+	return [(start, min(start + batch_size, n)) for start in range(0, n, batch_size)]
+
+# Streams rows (tuples) into table with COPY
+def copy_rows(cursor, table, columns, rows):
+	buf = StringIO()
+	for row in rows:
+		buf.write('\t'.join([copy_escape(value) for value in row]))
+		buf.write('\n')
+	buf.seek(0)
+	cursor.copy_expert('COPY ' + table + ' (' + ', '.join(columns) + ') FROM STDIN', buf)
+
+def connect_worker():
+	global worker_conn
+	worker_conn = psycopg2.connect(dsn)
+
+# Users start + 1 to end
+def bulkUsers(seed, batch, start, end):
+	rng = batch_random(seed, 'profile', batch)
+	lastlogin = datetime.datetime.fromtimestamp(load_day()).strftime('%Y-%m-%d %H:%M:%S')
+	rows = []
+	for i in xrange(start + 1, end + 1):
+		fname = rng.choice(first_names).strip()
+		lname = rng.choice(last_names).strip()
+		DOB = '%d-%d-%d' % (rng.randint(1990, 2002), rng.randint(1, 12), rng.randint(1, 28))
+		rows.append((i, fname, lname, fname[0].lower() + lname[0].lower() + str(i) + '@nyu.edu', 'password', DOB, lastlogin))
+	return [('profile', ('userID', 'fname', 'lname', 'email', 'password', 'DOB', 'lastlogin'), rows)]
+
+# The shape of a bulk loaded dataset: the graph model (see GraphGenerators),
+# and the hot spots to add to it
+DEFAULT_SHAPE = {'graph': 'uniform',
+				 'celebrities': 0,
+				 'celebrity_friends': 0,
+				 'huge_groups': 0,
+				 'huge_group_size': 0,
+				 'full_groups': 0.0,
+				 'sender_skew': 1.0,
+				 'bursts': 0.0}
+
+# Friendships of users start + 1 to end with users of a higher id. User i
+# gets 2 * d * (n_users - i) / n_users of them on average, so that with the
+# friendships it gets from lower ids every user ends up with about 2 * d
+# friends, for n_users * d friendships in all.
+def bulkFriendships(seed, batch, start, end, n_users, n_friendships):
+	rng = batch_random(seed, 'friends', batch)
+	d = float(n_friendships) / n_users
+	today = datetime.date.today().strftime('%Y-%m-%d')
+	rows = []
+	for i in xrange(start + 1, end + 1):
+		expected = 2 * d * (n_users - i) / n_users
+		k = min(int(expected) + (1 if rng.random() < expected - int(expected) else 0), n_users - i)
+		for j in rng.sample(xrange(i + 1, n_users + 1), k):
+			rows.append((i, j, today))
+	return [('friends', ('userID1', 'userID2', 'friendshipDate'), rows)]
+
+# Friendships generated beforehand, by a model that cannot be split into
+# independent batches
+def bulkFriendshipRows(seed, batch, start, end, pairs):
+	today = datetime.date.today().strftime('%Y-%m-%d')
+	return [('friends', ('userID1', 'userID2', 'friendshipDate'), [(i, j, today) for i, j in pairs])]
+
+# Batches of friendships of shape's graph model, generated in this process
+def friendshipBatches(seed, n_users, n_friendships, shape, batch_size):
+	pairs = []
+	batch = 0
+	for pair in GraphGenerators.friendships(shape['graph'], batch_random(seed, 'friends', 0), n_users, n_friendships,
+											shape['celebrities'], shape['celebrity_friends']):
+		pairs.append(pair)
+		if len(pairs) == batch_size:
+			yield ('bulkFriendshipRows', seed, batch, 0, len(pairs), pairs)
+			pairs = []
+			batch += 1
+	if pairs:
+		yield ('bulkFriendshipRows', seed, batch, 0, len(pairs), pairs)
+
+# Groups start + 1 to end and their members, the first of which is the
+# manager
+def bulkGroups(seed, batch, start, end, n_users, shape):
+	rng = batch_random(seed, 'groups', batch)
+	groups = []
+	members = []
+	for i in xrange(start + 1, end + 1):
+		word1 = rng.choice(adjectives).strip()
+		word2 = rng.choice(nouns).strip()
+		lmt, n_members = GraphGenerators.group_size(rng, i, n_users, shape['huge_groups'], shape['huge_group_size'], shape['full_groups'])
+		groups.append((i, word1 + '-' + word2, lmt, word1 + ' ' + word2 + '.'))
+		for k, member in enumerate(rng.sample(xrange(1, n_users + 1), n_members)):
+			members.append((i, member, 'manager' if k == 0 else 'member'))
+	return [('groups', ('gID', 'name', 'lmt', 'description'), groups),
+			('groupMembership', ('gID', 'userID', 'role'), members)]
+
+# Messages start + 1 to end, with explicit msgIDs so that their direct
+# recipients can be copied into messageRecipient along with them. Bodies are
+# slices of one random text per batch rather than built a character at a
+# time.
+def bulkMessages(seed, batch, start, end, n_users, n_groups, shape):
+	rng = batch_random(seed, 'messages', batch)
+	text = ''.join([rng.choice(MESSAGE_CHARACTERS) for j in xrange(4096)])
+	rand = rng.random
+	# dates are spread over the last fifth of the time since the epoch, as
+	# in insertMessages; the days are formatted once
+	now = load_day()
+	first_day = datetime.date.fromtimestamp(0.80 * now)
+	n_days = (datetime.date.fromtimestamp(now) - first_day).days
+	days = [(first_day + datetime.timedelta(days = k)).strftime('%Y-%m-%d ') for k in xrange(n_days)]
+	senders = GraphGenerators.BurstySenders(rng, n_users, n_days, shape['sender_skew'], shape['bursts'])
+	messages = []
+	recipients = []
+	for i in xrange(start + 1, end + 1):
+		user1, day, seconds = senders.next()
+		user2 = None
+		gID = None
+		if rand() < 2.0 / 3 or n_groups == 0:
+			#cannot send message to self
+			user2 = 1 + int(rand() * (n_users - 1))
+			if user2 >= user1:
+				user2 += 1
+			recipients.append((i, user2))
+		else:
+			# the groups with the low numbers (the huge ones) get as many
+			# more messages as the senders with the low numbers
+			gID = GraphGenerators.skewed_user(rand, n_groups, shape['sender_skew'])
+		offset = int(rand() * (len(text) - 200))
+		message = text[offset:offset + 1 + int(rand() * 200)]
+		date = days[day] + '%02d:%02d:%02d' % (seconds / 3600, seconds / 60 % 60, seconds % 60)
+		messages.append((i, user1, user2, gID, message, date))
+	return [('messages', ('msgID', 'fromUserID', 'toUserID', 'toGroupID', 'message', 'dateSent'), messages),
+			('messageRecipient', ('msgID', 'toUserID'), recipients)]
+
+# Loads one batch on the worker's connection; args is (function, seed,
+# batch, start, end, extra arguments...)
+def loadBatch(args):
+	function = globals()[args[0]]
+	seed, batch, start, end = args[1:5]
+	cursor = worker_conn.cursor()
+	for table, columns, rows in function(seed, batch, start, end, *args[5:]):
+		copy_rows(cursor, table, columns, rows)
+	if function == bulkMessages:
+		# group messages go to every member of the group, as the
+		# add_msg_recipients trigger would have done
+		cursor.execute('INSERT INTO messageRecipient (msgID, toUserID)\
+						SELECT msgID, groupMembership.userID FROM messages JOIN groupMembership ON groupMembership.gID = messages.toGroupID\
+						WHERE msgID > %s AND msgID <= %s;', (start, end))
+	worker_conn.commit()
+	cursor.close()
+	return end - start
+
+# Runs the batches on the pool, with at most window of them queued at a
+# time so that batches generated in this process are not all held in memory.
+# Returns the number of rows loaded.
+def runBatches(pool, batches, window):
+	loaded = 0
+	pending = deque()
+	for batch in batches:
+		pending.append(pool.apply_async(loadBatch, (batch,)))
+		if len(pending) >= window:
+			loaded += pending.popleft().get()
+	while pending:
+		loaded += pending.popleft().get()
+	return loaded
+
+def bulkLoad(n_users, n_friendships, n_groups, n_messages, seed, n_workers, batch_size, shape = DEFAULT_SHAPE):
+	n_friendships = min(n_friendships, (n_users * (n_users - 1)) / 2)
+	if shape['graph'] == 'uniform' and not shape['celebrities']:
+		friendships = [('bulkFriendships', seed, b, start, end, n_users, n_friendships) for b, (start, end) in enumerate(batch_ranges(n_users, batch_size))]
+	else:
+		friendships = friendshipBatches(seed, n_users, n_friendships, shape, batch_size)
+	phases = [('profile', [('bulkUsers', seed, b, start, end) for b, (start, end) in enumerate(batch_ranges(n_users, batch_size))]),
+			  ('friends', friendships),
+			  ('groups', [('bulkGroups', seed, b, start, end, n_users, shape) for b, (start, end) in enumerate(batch_ranges(n_groups, max(1, batch_size / 10)))]),
+			  ('messages', [('bulkMessages', seed, b, start, end, n_users, n_groups, shape) for b, (start, end) in enumerate(batch_ranges(n_messages if n_users > 1 else 0, batch_size))])]
+
+	conn.autocommit = True
+	cur.execute('TRUNCATE profile, groups, userActivity RESTART IDENTITY CASCADE;')
+	for table in BULK_TABLES:
+		cur.execute('ALTER TABLE ' + table + ' DISABLE TRIGGER USER;')
+	pool = multiprocessing.Pool(n_workers, connect_worker)
+	try:
+		for name, batches in phases:
+			started = time.time()
+			loaded = runBatches(pool, batches, 2 * n_workers)
+			print('%s: %d rows in %.1fs' % (name, loaded, time.time() - started))
+			sys.stdout.flush()
+		pool.close()
+		started = time.time()
+		cur.execute("SELECT setval(pg_get_serial_sequence('messages', 'msgid'), GREATEST(%s, 1), %s);", (n_messages, n_messages > 0))
+		cur.execute('SELECT backfill_mailbox();')
+		cur.execute('SELECT backfill_user_activity();')
+		cur.execute('SELECT backfill_group_member_count();')
+		print('mailbox, userActivity and group member counts: %.1fs' % (time.time() - started))
+	finally:
+		pool.terminate()
+		for table in BULK_TABLES:
+			cur.execute('ALTER TABLE ' + table + ' ENABLE TRIGGER USER;')
+	cur.execute('ANALYZE;')
+	conn.autocommit = False
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(usage = 'python populate.py <DATABASE NAME> <USER> <PASSWORD> [--bulk ...]')
+	parser.add_argument('database')
+	parser.add_argument('user')
+	parser.add_argument('password')
+	parser.add_argument('--bulk', action = 'store_true', help = 'replace the contents of the database with a COPY-loaded dataset')
+	parser.add_argument('--users', type = int, default = 1000000)
+	parser.add_argument('--friendships', type = int, default = 5000000)
+	parser.add_argument('--groups', type = int, default = 50000)
+	parser.add_argument('--messages', type = int, default = 50000000)
+	parser.add_argument('--seed', type = int, default = 0)
+	parser.add_argument('--workers', type = int, default = multiprocessing.cpu_count())
+	parser.add_argument('--batch-size', type = int, default = 100000)
+	parser.add_argument('--graph', choices = GraphGenerators.MODELS, default = 'uniform', help = 'model of the friendship graph')
+	parser.add_argument('--celebrities', type = int, default = 0, help = 'number of users (the first ones) with celebrity-friends friends')
+	parser.add_argument('--celebrity-friends', type = int, default = 100000)
+	parser.add_argument('--huge-groups', type = int, default = 0, help = 'number of groups (the first ones) with huge-group-size members')
+	parser.add_argument('--huge-group-size', type = int, default = 10000)
+	parser.add_argument('--full-groups', type = float, default = 0.0, help = 'fraction of the other groups filled to their limit')
+	parser.add_argument('--sender-skew', type = float, default = 1.0, help = '1 for uniform senders, higher to favour the first users and groups')
+	parser.add_argument('--bursts', type = float, default = 0.0, help = 'fraction of messages starting a burst of about 20 from the same sender')
+	args = parser.parse_args()
+
+	#conn = psycopg2.connect("dbname=" + sys.argv[1] +" host=127.0.0.1")
+	dsn = "dbname=" + args.database + " user=" + args.user + " password=" + args.password + " host=127.0.0.1"
+	conn = psycopg2.connect(dsn)
+	cur = conn.cursor()
+
+	if args.bulk:
+		shape = {'graph': args.graph,
+				 'celebrities': args.celebrities,
+				 'celebrity_friends': args.celebrity_friends,
+				 'huge_groups': args.huge_groups,
+				 'huge_group_size': args.huge_group_size,
+				 'full_groups': args.full_groups,
+				 'sender_skew': args.sender_skew,
+				 'bursts': args.bursts}
+		bulkLoad(args.users, args.friendships, args.groups, args.messages, args.seed, max(1, args.workers), max(1, args.batch_size), shape)
+	else:
+		insertUsers(100)
+		insertFriendships(100, 300)
+		insertGroups(25, 100)
+		insertMessages(100, 25, 400)